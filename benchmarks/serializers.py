@@ -0,0 +1,96 @@
+"""Compare session serializers.
+
+Encoding and decoding time (including BSON) and the size of the stored
+fields are measured for every built-in serializer, with and without
+compression, on a few typical sessions.
+
+Usage: python benchmarks/serializers.py [--number N]
+"""
+import optparse
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from bson import BSON
+
+from flask_mongo_sessions import serializers
+from flask_mongo_sessions.serializers import BSONSerializer
+from flask_mongo_sessions.serializers import JSONSerializer
+from flask_mongo_sessions.serializers import KeyedSerializer
+from flask_mongo_sessions.serializers import PickleSerializer
+
+
+SESSIONS = {
+    'small': {
+        'user_id': 12345,
+        'csrf_token': uuid.uuid4().hex,
+    },
+    'medium': {
+        'user_id': 12345,
+        'csrf_token': uuid.uuid4().hex,
+        'flashes': [['message', u'Profile saved']] * 3,
+        'last_seen': datetime(2013, 5, 1, 12, 30, 15),
+        'features': dict(('feature_%d' % i, i % 2 == 0) for i in range(50)),
+    },
+    'large': {
+        'user_id': 12345,
+        'cart': [{'sku': 'SKU-%06d' % i, 'qty': i % 5 + 1,
+                  'title': u'Item number %d' % i, 'price': 9.99 + i}
+                 for i in range(300)],
+        'features': dict(('feature_%d' % i, i % 2 == 0) for i in range(500)),
+    },
+}
+
+CODECS = [
+    ('pickle (protocol 0)', PickleSerializer(protocol=0), None),
+    ('pickle', PickleSerializer(), None),
+    ('pickle+zlib', PickleSerializer(), 0),
+    ('json', JSONSerializer(), None),
+    ('json+zlib', JSONSerializer(), 0),
+    ('bson', BSONSerializer(), None),
+    # Values are decoded on access, decoding only splits the keys.
+    ('keyed', KeyedSerializer(), None),
+]
+
+
+def measure(session, serializer, threshold, number):
+    # BSON encoding and decoding of the field is done by the driver anyway,
+    # it's included to compare native subdocuments fairly.
+    def encode():
+        fmt, value, size = serializers.encode(session, serializer, threshold)
+        return BSON.encode({'f': fmt, 'd': value})
+
+    def decode():
+        doc = BSON(stored).decode()
+        return serializers.decode(doc['f'], doc['d'])
+
+    stored = encode()
+    encode_time = timeit.timeit(encode, number=number) / number
+    decode_time = timeit.timeit(decode, number=number) / number
+    return encode_time, decode_time, len(stored)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=1000,
+                      help='iterations per measurement')
+    options, args = parser.parse_args()
+
+    row = '%-8s %-20s %12s %12s %12s'
+    print(row % ('session', 'codec', 'encode, us', 'decode, us', 'bytes'))
+    for name in ['small', 'medium', 'large']:
+        for codec, serializer, threshold in CODECS:
+            encode_time, decode_time, stored_bytes = measure(
+                SESSIONS[name], serializer, threshold, options.number)
+            print(row % (name, codec,
+                         '%.1f' % (encode_time * 1e6),
+                         '%.1f' % (decode_time * 1e6),
+                         stored_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Benchmark the cost of sessions per request.
+
+Requests are made with Flask test client to an application with
+MongoDBSessionInterface backed by the in-memory collection stand-in, so no
+MongoDB server is needed. Network round trip time can be simulated with
+--latency.
+
+For every configuration of the session interface and every workload,
+requests per second, median and 99th percentile latency, storage round
+trips per request and bytes written to and read from the storage per
+request are reported as JSON.
+
+Usage: python benchmarks/sessions.py [--requests N] [--latency SECONDS]
+           [--config NAME ...] [--workload NAME ...] [--output FILE]
+"""
+from __future__ import with_statement
+
+import json
+import optparse
+import os
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask import Flask
+from flask import session
+
+from flask_mongo_sessions import MongoDBSessionInterface
+from flask_mongo_sessions import SessionCache
+from flask_mongo_sessions.memory import MemoryDatabase
+
+
+# Options of the session interface, a factory is called for every run,
+# so stateful options (like caches) aren't shared.
+CONFIGS = {
+    'default': lambda: {},
+    'touch': lambda: {'touch_interval': timedelta(minutes=5)},
+    'optimized': lambda: {
+        'touch_interval': timedelta(minutes=5),
+        'lazy': True,
+        'cache': SessionCache(),
+        'delta_updates': True,
+    },
+}
+
+LARGE_CART = [{'sku': 'SKU-%06d' % i, 'qty': i % 5 + 1,
+               'title': u'Item number %d' % i}
+              for i in range(500)]
+
+# Workload: (initial session data or None for anonymous users, path).
+WORKLOADS = {
+    'read-only': ({'user_id': 12345}, '/read'),
+    'write-heavy': ({'user_id': 12345}, '/write'),
+    'anonymous': (None, '/read'),
+    'large-session': ({'user_id': 12345, 'cart': LARGE_CART}, '/write'),
+}
+
+
+def create_app(db, options):
+    app = Flask('benchmark')
+    app.config['SERVER_NAME'] = 'localhost:5000'
+    app.session_interface = MongoDBSessionInterface(app, db, 'sessions',
+                                                    **options)
+
+    @app.route('/init', methods=['POST'])
+    def init():
+        session.update(app.config['INITIAL_SESSION'])
+        return 'done'
+
+    @app.route('/read')
+    def read():
+        return str(session.get('user_id', ''))
+
+    @app.route('/write')
+    def write():
+        session['counter'] = session.get('counter', 0) + 1
+        return 'done'
+
+    return app
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(config, workload, requests, latency):
+    db = MemoryDatabase('benchmark', latency=latency, measure_bytes=True)
+    collection = db['sessions']
+    app = create_app(db, CONFIGS[config]())
+    client = app.test_client()
+    initial, path = WORKLOADS[workload]
+    if initial is not None:
+        app.config['INITIAL_SESSION'] = initial
+        client.post('/init')
+    collection.reset_calls()
+
+    timings = []
+    started = time.time()
+    for _ in range(requests):
+        request_started = time.time()
+        client.get(path)
+        timings.append(time.time() - request_started)
+    elapsed = time.time() - started
+
+    return {
+        'config': config,
+        'workload': workload,
+        'requests': requests,
+        'latency_ms': latency * 1000,
+        'requests_per_second': requests / elapsed,
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'round_trips_per_request': float(collection.round_trips) / requests,
+        'calls': collection.calls,
+        'bytes_written_per_request':
+            float(collection.bytes_written) / requests,
+        'bytes_read_per_request': float(collection.bytes_read) / requests,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--requests', type='int', default=1000,
+                      help='requests per run')
+    parser.add_option('--latency', type='float', default=0,
+                      help='simulated storage round trip time, seconds')
+    parser.add_option('--config', action='append', choices=sorted(CONFIGS),
+                      help='configuration of the session interface '
+                           '(all by default)')
+    parser.add_option('--workload', action='append',
+                      choices=sorted(WORKLOADS),
+                      help='workload (all by default)')
+    parser.add_option('--output', help='file to write results to')
+    options, args = parser.parse_args()
+
+    results = []
+    for config in options.config or sorted(CONFIGS):
+        for workload in options.workload or sorted(WORKLOADS):
+            results.append(run(config, workload, options.requests,
+                               options.latency))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
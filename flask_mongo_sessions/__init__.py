@@ -1,36 +1,1150 @@
-import pickle
+from __future__ import with_statement
+
+import copy
+import hashlib
+import hmac
+import logging
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
 
-from bson.binary import Binary
-
 from werkzeug.datastructures import CallbackDict
 from flask.sessions import SessionMixin
 from flask.sessions import SessionInterface
 
+from flask_mongo_sessions.breaker import CircuitBreaker
+from flask_mongo_sessions.breaker import CircuitOpenError
+from flask_mongo_sessions.breaker import unavailable_errors
+from flask_mongo_sessions.cache import CacheEntry
+from flask_mongo_sessions.cache import MissingSessionCache
+from flask_mongo_sessions.cache import SessionCache
+from flask_mongo_sessions import merge
+from flask_mongo_sessions import serializers
+from flask_mongo_sessions.metrics import SessionMetrics
+from flask_mongo_sessions.metrics import timed
+from flask_mongo_sessions.serializers import BSONSerializer
+from flask_mongo_sessions.serializers import FormatError
+from flask_mongo_sessions.serializers import JSONSerializer
+from flask_mongo_sessions.serializers import KeyedSerializer
+from flask_mongo_sessions.serializers import PickleSerializer
+from flask_mongo_sessions.sharedcache import SharedSessionCache
+from flask_mongo_sessions.sids import HashedPrefixSIDs
+from flask_mongo_sessions.sids import NAMESPACE_SEPARATOR
+from flask_mongo_sessions.sids import RandomSIDs
+from flask_mongo_sessions.sids import TimeOrderedSIDs
+from flask_mongo_sessions.sids import namespace_range
+from flask_mongo_sessions.sids import namespaced
+from flask_mongo_sessions.sweeper import Sweeper
+from flask_mongo_sessions.writebehind import WriteBehindQueue
+
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+logger = logging.getLogger(__name__)
+
+try:
+    _compare_digest = hmac.compare_digest
+except AttributeError:
+    def _compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+def _endpoint():
+    """Return the endpoint of the current request (for logs)."""
+    from flask import has_request_context
+    from flask import request
+
+    if has_request_context():
+        return request.endpoint
+    return None
+
+
+def _naive_utc(dt):
+    """Convert a datetime to a naive one in UTC, the way BSON stores it."""
+    if dt.tzinfo is not None:
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)
+    return dt
+
+
+def _is_field_name(key):
+    """Check if a session key can be used as a MongoDB field name."""
+    return isinstance(key, string_types) and key and \
+        '.' not in key and '\0' not in key and not key.startswith('$')
+
+
+def _decoding(method):
+    def wrapper(self, *args, **kwargs):
+        self.decode_all()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
 
 class MongoDBSession(CallbackDict, SessionMixin):
     def __init__(self, initial=None, sid=None, new=True):
         def on_update(this):
-            this.modified = True
-        if initial:
-            initial = pickle.loads(str(initial))
+            this._modified = True
         CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
         self.new = new
         self.modified = False
+        # Keys set and deleted during the request.
+        self.set_keys = set()
+        self.deleted_keys = set()
+        # Expiration time, version and format of the stored document
+        # (if it was loaded).
+        self.exp = None
+        self.version = 0
+        self.format = None
+        # If set, the session is stored in the cookie, not in the database.
+        self.in_cookie = False
+        # Key of the document of the spill collection with the data, False if
+        # it isn't spilled.
+        self.spilled = False
+        # Encoded values of keys decoded during the request (keyed format),
+        # they are stored again as they were unless the keys are set.
+        self.encoded_values = {}
+        # Set if the session couldn't be loaded from the database: 'cache'
+        # if it was served from the cache, 'anonymous' if it's empty.
+        self.degraded = None
+
+    def _get_modified(self):
+        return self._modified
+
+    def _set_modified(self, value):
+        # If the session is marked as modified explicitly (e.g. after
+        # a mutable value was changed in place) changes can't be tracked
+        # by keys any more.
+        self._modified = self.untracked_changes = bool(value)
+
+    modified = property(_get_modified, _set_modified)
+
+    def _track_set(self, key):
+        self.set_keys.add(key)
+        self.deleted_keys.discard(key)
+
+    def _track_delete(self, key):
+        self.deleted_keys.add(key)
+        self.set_keys.discard(key)
+
+    def _decoded(self, key):
+        """Return the value of the key, decoding it if it's still
+        encoded."""
+        value = dict.__getitem__(self, key)
+        if isinstance(value, serializers.EncodedValue):
+            self.encoded_values[key] = value
+            value = value.decode()
+            # Decoding isn't a modification.
+            dict.__setitem__(self, key, value)
+        return value
+
+    def decode_all(self):
+        for key, value in dict.items(self):
+            if isinstance(value, serializers.EncodedValue):
+                self._decoded(key)
+
+    def __getitem__(self, key):
+        return self._decoded(key)
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return self._decoded(key)
+        return default
+
+    values = _decoding(CallbackDict.values)
+    items = _decoding(CallbackDict.items)
+    copy = _decoding(CallbackDict.copy)
+    __eq__ = _decoding(CallbackDict.__eq__)
+    __ne__ = _decoding(CallbackDict.__ne__)
+    __repr__ = _decoding(CallbackDict.__repr__)
+    if hasattr(dict, 'iteritems'):
+        itervalues = _decoding(CallbackDict.itervalues)
+        iteritems = _decoding(CallbackDict.iteritems)
+
+    def __setitem__(self, key, value):
+        CallbackDict.__setitem__(self, key, value)
+        self._track_set(key)
+
+    def __delitem__(self, key):
+        CallbackDict.__delitem__(self, key)
+        self._track_delete(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._track_set(key)
+        else:
+            self._decoded(key)
+        return CallbackDict.setdefault(self, key, default)
+
+    def pop(self, key, *args):
+        if key in self:
+            self._decoded(key)
+            self._track_delete(key)
+        return CallbackDict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = CallbackDict.popitem(self)
+        self._track_delete(key)
+        return key, serializers.decoded_value(value)
+
+    def update(self, *args, **kwargs):
+        data = dict(*args, **kwargs)
+        for key in data:
+            self._track_set(key)
+        CallbackDict.update(self, data)
+
+    def clear(self):
+        for key in self:
+            self._track_delete(key)
+        CallbackDict.clear(self)
+
+    def can_update_keys(self):
+        """Check if changes of the session can be stored key by key."""
+        return not self.new and not self.untracked_changes and \
+            not self.spilled and self.format == BSONSerializer.format and \
+            all(_is_field_name(key)
+                for key in self.set_keys | self.deleted_keys)
+
+    def stored_data(self):
+        """Return a dict of the session data to store. Values of the keyed
+        format which weren't changed stay encoded."""
+        data = dict(dict.items(self))
+        if self.encoded_values and not self.untracked_changes:
+            # Values changed in place must be marked as modified, so
+            # values of keys which weren't set are unchanged.
+            for key, value in self.encoded_values.items():
+                if key in data and key not in self.set_keys:
+                    data[key] = value
+        return data
+
+    def pack(self, serializer=None, compress_threshold=None):
+        """Serialize the session, returns a Payload."""
+        return serializers.encode(self.stored_data(),
+                                  serializer or PickleSerializer(),
+                                  compress_threshold)
+
+    @staticmethod
+    def unpack(packed, fmt=None, accept=None):
+        return serializers.decode(fmt, packed, accept)
+
+
+# Keys of documents of the spill collection are the key of the session, this
+# separator and a random suffix: every write of a spilled session makes a new
+# document, the session document references it by its key.
+SPILL_SEPARATOR = '/'
+
+
+def _spill_key(sid):
+    return sid + SPILL_SEPARATOR + uuid.uuid4().hex
+
+
+def _spill_range(sid):
+    """Return the condition on `_id` matching spill documents of the
+    session."""
+    return {'$gt': sid + SPILL_SEPARATOR,
+            '$lt': sid + chr(ord(SPILL_SEPARATOR) + 1)}
+
+
+# A CacheEntry of a spilled session with only the values of its hot keys
+# (the names of which are in `hot_keys`).
+_HotEntry = namedtuple('_HotEntry', CacheEntry._fields + ('hot_keys',))
+
+
+class SessionTooLarge(ValueError):
+    """Raised when a session is larger than the size limit."""
+
+
+def _loading(name):
+    method = getattr(MongoDBSession, name)
+
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
 
-    def pack(self):
-        return Binary(pickle.dumps(dict(self)))
 
+def _loading_key(name):
+    method = getattr(MongoDBSession, name)
 
-class MongoDBSessionInterface(SessionInterface):
+    def wrapper(self, key, *args, **kwargs):
+        self.load_key(key)
+        return method(self, key, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+class LazyMongoDBSession(MongoDBSession):
+    """Session which is loaded from the database on the first access.
+
+    `loader` is called with the session to fill it with the stored data.
+    A spilled session may be filled only with its hot keys at first (see
+    :meth:`defer_spilled`), the rest of it is loaded on the first access to
+    another key.
+    """
+
+    def __init__(self, loader, sid=None):
+        MongoDBSession.__init__(self, sid=sid, new=False)
+        self._loader = loader
+        self.loaded = False
+        # Keys read from the session document of a spilled session (set
+        # while the rest of it isn't loaded).
+        self.hot_keys = None
+
+    def load(self):
+        while not self.loaded:
+            self.loaded = True
+            self._loader(self)
+
+    def load_hot(self):
+        """Load the session, only its hot keys if it's spilled."""
+        if not self.loaded and self.hot_keys is None:
+            self.loaded = True
+            self._loader(self)
+
+    def load_key(self, key):
+        """Load what's needed to read the key."""
+        self.load_hot()
+        if not self.loaded and key not in self.hot_keys:
+            self.load()
+
+    def defer_spilled(self, hot_keys, loader):
+        """Called by the loader which filled the session only with the hot
+        keys, `loader` loads the rest."""
+        self.hot_keys = frozenset(hot_keys)
+        self._loader = loader
+        self.loaded = False
+
+    __getitem__ = _loading_key('__getitem__')
+    __contains__ = _loading_key('__contains__')
+    __iter__ = _loading('__iter__')
+    __len__ = _loading('__len__')
+    __eq__ = _loading('__eq__')
+    __ne__ = _loading('__ne__')
+    __repr__ = _loading('__repr__')
+    get = _loading_key('get')
+    keys = _loading('keys')
+    values = _loading('values')
+    items = _loading('items')
+    copy = _loading('copy')
+    __setitem__ = _loading('__setitem__')
+    __delitem__ = _loading('__delitem__')
+    setdefault = _loading('setdefault')
+    pop = _loading('pop')
+    popitem = _loading('popitem')
+    update = _loading('update')
+    clear = _loading('clear')
+    if hasattr(dict, 'iteritems'):
+        iterkeys = _loading('iterkeys')
+        itervalues = _loading('itervalues')
+        iteritems = _loading('iteritems')
+        has_key = _loading('has_key')
+
+
+# MongoClient options by the config keys they are read from.
+_CLIENT_OPTIONS = [
+    ('MONGO_SESSIONS_MAX_POOL_SIZE', 'maxPoolSize'),
+    ('MONGO_SESSIONS_MIN_POOL_SIZE', 'minPoolSize'),
+    ('MONGO_SESSIONS_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('MONGO_SESSIONS_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+    ('MONGO_SESSIONS_SERVER_SELECTION_TIMEOUT_MS',
+     'serverSelectionTimeoutMS'),
+    ('MONGO_SESSIONS_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+    ('MONGO_SESSIONS_COMPRESSORS', 'compressors'),
+]
+
+
+def _client_options(config):
+    """Return MongoClient options from ``MONGO_SESSIONS_*`` config keys."""
+    options = dict(config.get('MONGO_SESSIONS_CLIENT_OPTIONS') or {})
+    for key, option in _CLIENT_OPTIONS:
+        if config.get(key) is not None:
+            options[option] = config[key]
+    return options
+
+
+class BaseMongoDBSessionInterface(object):
+    """Storage logic shared by the synchronous and asynchronous session
+    interfaces: document layout, serialization, expiration and cookies.
+    Subclasses do the I/O.
+    """
     session_class = MongoDBSession
+    # Prefix of cookies which contain the session itself.
+    cookie_session_prefix = 'c.'
+
+    def __init__(self, touch_interval=None, ttl_index=False, cache=None,
+                 serializer=None, compress_threshold=None,
+                 accept_formats=None, delta_updates=False, metrics=None,
+                 signed_sids=False, missing_cache=None, cookie_threshold=None,
+                 optimistic=False, merge_policy=None, conflict_retries=3,
+                 write_concern=None, touch_write_concern=None,
+                 read_preference=None, secondary_reads=None,
+                 recent_write_seconds=10, spill_threshold=None,
+                 spill_hot_keys=(), max_size=None, oversize='raise',
+                 user_key=None, sid_strategy=None, accept_sid_strategies=None,
+                 namespaces=False):
+        # If set, a TTL index on the expiration time is ensured, so MongoDB
+        # removes expired sessions by itself.
+        self._ttl_index = ttl_index
+        # If set, unmodified sessions aren't written back, only their
+        # expiration time is refreshed when it's older than this interval.
+        self._touch_interval = touch_interval
+        # Optional SessionCache (or an object with the same interface).
+        self._cache = cache
+        # Serializer for written sessions. Sessions are read in the format
+        # they were written in, if it's in accept_formats (when given).
+        if delta_updates:
+            serializer = serializer or BSONSerializer()
+            if serializer.format != BSONSerializer.format:
+                raise ValueError('Delta updates need BSON serializer')
+        self._serializer = serializer or PickleSerializer()
+        # If set, only changed keys of sessions are written (with $set and
+        # $unset of fields of the subdocument).
+        self._delta_updates = delta_updates
+        self._compress_threshold = compress_threshold
+        self._accept_formats = accept_formats
+        # Optional SessionMetrics (or an object with the same interface)
+        # which storage operations are reported to.
+        self._metrics = metrics
+        # If set, SIDs in cookies are signed with the secret key of the
+        # application, forged ones are rejected without a query.
+        self._signed_sids = signed_sids
+        # Optional MissingSessionCache of SIDs recently not found.
+        self._missing_cache = missing_cache
+        # If set, sessions which fit in a signed cookie of this size (in
+        # bytes) are stored in the cookie, larger ones in the database.
+        self._cookie_threshold = cookie_threshold
+        # If set, stored sessions are written only if their version is the
+        # one which was loaded. Otherwise changes are merged into the stored
+        # data with merge_policy and the write is retried, at most
+        # conflict_retries times before the last writer wins.
+        self._optimistic = optimistic
+        self._merge_policy = merge_policy or merge.reapply_changes
+        self._conflict_retries = conflict_retries
+        # Options of the collection handle (PyMongo 3.0+). Touches, which
+        # only bump expiration time, may use a cheaper write concern.
+        self._write_concern = write_concern
+        self._touch_write_concern = touch_write_concern
+        self._read_preference = read_preference
+        # If set, sessions are read with this read preference (e.g. from
+        # secondaries), except for recent_write_seconds after the session
+        # was written, when it's read from the primary.
+        self._secondary_reads = secondary_reads
+        self._recent_write_seconds = recent_write_seconds
+        # If set, sessions larger than this (in bytes) are stored in the
+        # spill collection, the session document keeps only spill_hot_keys.
+        self._spill_threshold = spill_threshold
+        self._spill_hot_keys = spill_hot_keys
+        # If set, sessions larger than this (in bytes) aren't stored, they
+        # are handled according to oversize policy: 'raise' SessionTooLarge
+        # or 'truncate' the session, removing its largest keys.
+        if oversize not in ('raise', 'truncate'):
+            raise ValueError('Unknown oversize policy %r' % oversize)
+        self._max_size = max_size
+        self._oversize = oversize
+        # If set, the value of this session key (the user the session
+        # belongs to) is stored in the indexed `u` field, so sessions of
+        # a user can be found.
+        self._user_key = user_key
+        # Strategy of making SIDs (RandomSIDs by default). Cookies with SIDs
+        # which couldn't be made by it or by accept_sid_strategies (e.g.
+        # the previous strategy) never reach the database.
+        self._sid_strategy = sid_strategy or RandomSIDs()
+        self._accept_sid_strategies = [self._sid_strategy] + \
+            list(accept_sid_strategies or [])
+        # If set, the interface can be shared by several applications:
+        # sessions are keyed by `namespace:sid`, where the namespace is
+        # MONGO_SESSIONS_NAMESPACE config key of the application or its
+        # name. The namespace isn't in cookies.
+        self._namespaces = namespaces
+        # Applications initialized with the interface by their namespaces,
+        # two applications can't share one.
+        self._registered_namespaces = {}
+
+    def _generate_sid(self):
+        return self._sid_strategy.generate()
+
+    def _namespace(self, app):
+        namespace = app.config.get('MONGO_SESSIONS_NAMESPACE') or app.name
+        if NAMESPACE_SEPARATOR in namespace:
+            raise ValueError('Session namespace %r contains %r' %
+                             (namespace, NAMESPACE_SEPARATOR))
+        return namespace
+
+    def _register_namespace(self, app):
+        """Check the namespace of the application initialized with the
+        interface and record it. Raises ValueError if it's invalid or
+        another application has it (e.g. two with the same name)."""
+        namespace = self._namespace(app)
+        registered = self._registered_namespaces.setdefault(namespace, app)
+        if registered is not app:
+            raise ValueError('Session namespace %r is used by applications '
+                             '%r and %r, set MONGO_SESSIONS_NAMESPACE' %
+                             (namespace, registered.name, app.name))
+
+    def _key(self, app, sid):
+        """Return the key of the session document (the `sid` attribute of
+        the session) with the SID from the cookie."""
+        if not self._namespaces:
+            return sid
+        return namespaced(self._namespace(app), sid)
+
+    def _new_key(self, app):
+        return self._key(app, self._generate_sid())
+
+    def _regenerated_key(self, key):
+        """Return a key with a new SID in the namespace of `key`."""
+        if not self._namespaces:
+            return self._generate_sid()
+        namespace = key.partition(NAMESPACE_SEPARATOR)[0]
+        return namespaced(namespace, self._generate_sid())
+
+    def _namespace_spec(self, namespace):
+        if namespace is None:
+            return {}
+        return {'_id': namespace_range(namespace)}
+
+    def _is_valid_sid(self, sid):
+        for strategy in self._accept_sid_strategies:
+            if strategy.is_valid(sid):
+                return True
+        return False
+
+    def _sid_signature(self, app, sid):
+        if not app.secret_key:
+            raise RuntimeError('Signed SIDs need the secret key of '
+                               'the application to be set')
+        key = app.secret_key
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return hmac.new(key, sid.encode('ascii'), hashlib.sha256).hexdigest()
+
+    def _cookie_value(self, app, key):
+        sid = key
+        if self._namespaces:
+            sid = key.partition(NAMESPACE_SEPARATOR)[2]
+        if self._signed_sids:
+            # The namespace is signed too, so the cookie is valid only for
+            # the application it was made by.
+            return sid + '.' + self._sid_signature(app, key)
+        return sid
+
+    def _sid_from_cookie(self, app, request):
+        """Return the key of the session in the session cookie of the
+        request, None if there is no cookie, it's malformed, forged or known
+        to be missing from the database."""
+        value = request.cookies.get(app.session_cookie_name)
+        if not value:
+            return None
+        sid = value
+        if self._signed_sids:
+            sid, _, signature = value.partition('.')
+        valid = self._is_valid_sid(sid)
+        if valid:
+            key = self._key(app, sid)
+        if not valid or \
+                (self._signed_sids and not _compare_digest(
+                    signature.encode('utf-8'),
+                    self._sid_signature(app, key).encode('ascii'))):
+            if self._metrics is not None:
+                self._metrics.incr('sid.rejected')
+            return None
+        if self._missing_cache is not None and key in self._missing_cache:
+            if self._metrics is not None:
+                self._metrics.incr('sid.missing')
+            return None
+        return key
+
+    def _cookie_serializer(self, app):
+        # Imported here, so Flask older than 0.10 works without
+        # `cookie_threshold`.
+        from flask.sessions import session_json_serializer
+        from itsdangerous import URLSafeTimedSerializer
+
+        if not app.secret_key:
+            raise RuntimeError('Sessions stored in cookies need the secret '
+                               'key of the application to be set')
+        return URLSafeTimedSerializer(app.secret_key,
+                                      salt='mongodb-session',
+                                      serializer=session_json_serializer)
+
+    def _cookie_session(self, app, request):
+        """Return the session stored in the cookie of the request, None if
+        the cookie doesn't contain a session."""
+        value = request.cookies.get(app.session_cookie_name)
+        if self._cookie_threshold is None or not value or \
+                not value.startswith(self.cookie_session_prefix):
+            return None
+        from itsdangerous import BadSignature
+
+        session = self.session_class(sid=self._new_key(app))
+        try:
+            data, signed = self._cookie_serializer(app).loads(
+                value[len(self.cookie_session_prefix):],
+                return_timestamp=True)
+        except BadSignature:
+            return session
+        if not isinstance(signed, datetime):
+            signed = datetime.utcfromtimestamp(signed)
+        # Cookie sessions expire the same way stored ones do.
+        if data.get('_permanent'):
+            exp = _naive_utc(signed) + app.permanent_session_lifetime
+        else:
+            exp = _naive_utc(signed) + timedelta(days=1)
+        if exp <= datetime.utcnow():
+            return session
+        dict.update(session, data)
+        session.new = False
+        session.in_cookie = True
+        session.exp = exp
+        return session
+
+    def _session_cookie(self, app, session, action):
+        """Return the cookie value containing the session if it must be
+        stored in the cookie, otherwise None."""
+        if self._cookie_threshold is None or action != 'write':
+            return None
+        try:
+            value = self._cookie_serializer(app).dumps(
+                serializers.decoded(session))
+        except (TypeError, ValueError):
+            # Values JSON can't represent are stored in the database.
+            return None
+        value = self.cookie_session_prefix + value
+        if len(value) > self._cookie_threshold:
+            return None
+        return value
+
+    def _with_options(self, collection, touch=False, secondary=False):
+        """Return the handle of the collection with the configured write
+        concern and read preference."""
+        options = {}
+        write_concern = self._write_concern
+        if touch and self._touch_write_concern is not None:
+            write_concern = self._touch_write_concern
+        if write_concern is not None:
+            options['write_concern'] = write_concern
+        if self._read_preference is not None:
+            options['read_preference'] = self._read_preference
+        if secondary and self._secondary_reads is not None:
+            options['read_preference'] = self._secondary_reads
+        if not options:
+            return collection
+        return collection.with_options(**options)
+
+    def _write_marker_name(self, app):
+        return app.session_cookie_name + '_w'
+
+    def _may_read_secondary(self, app, request):
+        """Check if the session of the request can be read from
+        a secondary. It can't if it was written recently, a secondary may
+        not have the write yet."""
+        return self._secondary_reads is not None and \
+            self._write_marker_name(app) not in request.cookies
+
+    def _is_checked(self, session, action):
+        """Check if saving the session must be conditional on its
+        version."""
+        return self._optimistic and action in ('write', 'remove') and \
+            not session.new and not session.in_cookie
+
+    def _version_spec(self, sid, version=None):
+        """Return the spec of the session document, of the given version if
+        it's not None."""
+        spec = {'_id': sid}
+        if version is not None:
+            # Documents written before versions were introduced have none.
+            spec['v'] = version or {'$exists': False}
+        return spec
+
+    def _merge_stored(self, session, doc):
+        """Merge the session into the stored document (changed since the
+        session was loaded) with the merge policy. Returns the action to
+        take: 'write' or 'remove' if nothing is left."""
+        try:
+            stored = self.session_class.unpack(doc['d'], doc.get('f'),
+                                               self._accept_formats)
+        except FormatError:
+            stored = {}
+        data = self._merge_policy(serializers.decoded(stored), session)
+        # Merged data isn't a modification of the request.
+        dict.clear(session)
+        session.encoded_values.clear()
+        dict.update(session, data)
+        session.version = doc.get('v', 0)
+        session.format = doc.get('f')
+        session.spilled = doc.get('spill') or False
+        if self._metrics is not None:
+            self._metrics.incr('save.conflict')
+        return 'write' if data else 'remove'
+
+    def _carry_changes(self, earlier, session):
+        """Make the session, which replaces the deferred write of the
+        `earlier` one, written as both of them: conditional on the version
+        the earlier one was loaded with, with changes of both tracked."""
+        session.version = earlier.version
+        # The earlier one may be a new session, which isn't stored yet.
+        session.new = session.new or earlier.new
+        session.untracked_changes = \
+            session.untracked_changes or earlier.untracked_changes
+        # Changes the session didn't see (it wasn't loaded with the earlier
+        # write) are lost.
+        session.set_keys |= set(
+            key for key in earlier.set_keys
+            if dict.__contains__(session, key) and
+            key not in session.deleted_keys)
+        session.deleted_keys |= set(
+            key for key in earlier.deleted_keys
+            if not dict.__contains__(session, key) and
+            key not in session.set_keys)
+
+    def _is_inserted(self, session):
+        """Check if writing the session may insert its document: it's new
+        or it was stored in the cookie."""
+        return session.new or session.in_cookie
+
+    def _gone(self, session):
+        """Return the action done with the session whose document was
+        removed (e.g. sessions of its user were invalidated) or expired
+        since the session was loaded: it isn't written back, so it's
+        removed."""
+        logger.info('Session %s was removed while it was used, it is not '
+                    'written back', session.sid)
+        self._missing(session.sid)
+        return 'remove'
+
+    def _missing(self, sid):
+        """Remember that the session isn't in the database."""
+        if self._missing_cache is not None:
+            self._missing_cache.add(sid)
+
+    def _lookup_spec(self, sid, now):
+        # Expired sessions are filtered out by the database, so they are
+        # never transferred.
+        return {'_id': sid, 'exp': {'$gt': now}}
+
+    def _cached_entry(self, sid, now):
+        """Return the cached session data with the given SID or None."""
+        if self._cache is None:
+            return None
+        entry = self._cache.get(sid)
+        if entry is not None and entry.exp <= now:
+            self._cache.delete(sid)
+            entry = None
+        if self._metrics is not None:
+            self._metrics.incr('cache.miss' if entry is None else 'cache.hit')
+        return entry
+
+    def _revalidated_entry(self, sid, entry, doc):
+        """Check a cached entry against the version of the stored document
+        (fetched with `_lookup_spec` and `_version_fields`)."""
+        if not doc:
+            self._cache.delete(sid)
+            self._missing(sid)
+            return None
+        if doc.get('v', 0) != entry.version:
+            return None
+        return entry._replace(exp=_naive_utc(doc['exp']))
+
+    _version_fields = {'v': True, 'exp': True}
+
+    def _entry_from_doc(self, sid, doc):
+        """Decode a stored session document into a CacheEntry and cache it.
+        Returns None if there is no document or its format isn't
+        accepted."""
+        if not doc:
+            self._missing(sid)
+            return None
+        started = time.time()
+        try:
+            data = self.session_class.unpack(doc['d'], doc.get('f'),
+                                             self._accept_formats)
+        except FormatError:
+            return None
+        if self._metrics is not None:
+            self._metrics.observe('payload.decode_time',
+                                  time.time() - started)
+        entry = CacheEntry(data, _naive_utc(doc['exp']), doc.get('v', 0),
+                           doc.get('f'), doc.get('spill') or False)
+        if self._cache is not None:
+            self._cache.set(sid, entry._replace(
+                data=copy.deepcopy(entry.data)))
+        return entry
+
+    def _hot_entry(self, doc):
+        """Return the _HotEntry of a spilled session document, None if its
+        format isn't accepted."""
+        try:
+            data = self.session_class.unpack(doc['h'], doc.get('hf'),
+                                             self._accept_formats)
+        except FormatError:
+            return None
+        return _HotEntry(data, _naive_utc(doc['exp']), doc.get('v', 0),
+                         doc.get('f'), doc['spill'], frozenset(doc['hk']))
 
-    def __init__(self, app, db, collection_name):
+    def _fill_session(self, session, entry):
+        """Fill the session with the stored data (a CacheEntry)."""
+        if entry is None:
+            # If the SID doesn't exist - create a new one to avoid possibility
+            # of user-generated SID with invalid format (e.g. "abc123").
+            session.sid = self._regenerated_key(session.sid)
+            session.new = True
+            return
+        # Stored data isn't a modification, so callbacks are bypassed.
+        dict.update(session, entry.data)
+        session.exp = entry.exp
+        session.version = entry.version
+        session.format = entry.format
+        session.spilled = entry.spilled
+
+    def _save_action(self, app, session):
+        """Decide how the session is saved.
+
+        Returns a tuple of the action (None, 'remove', 'touch' or 'write'),
+        expiration time of the cookie and of the stored session.
+        """
+        # A session which was never accessed can't be changed.
+        if not getattr(session, 'loaded', True) and \
+                getattr(session, 'hot_keys', None) is None:
+            return None, None, None
+
+        cookie_exp = self.get_expiration_time(app, session)
+        if not getattr(session, 'loaded', True):
+            # Only hot keys of a spilled session were read, so it wasn't
+            # changed and can only be touched.
+            session_exp = _naive_utc(cookie_exp) if cookie_exp else \
+                datetime.utcnow() + timedelta(days=1)
+            if self._touch_interval is not None and \
+                    session_exp - session.exp < self._touch_interval:
+                return None, cookie_exp, session_exp
+            return 'touch', cookie_exp, session_exp
+        if not session:
+            # A new session has never been stored, so there is nothing
+            # to remove.
+            if session.new:
+                return None, cookie_exp, None
+            return 'remove', cookie_exp, None
+
+        # If session isn't permanent if will be considered valid for 1 day
+        # (but not cookie which will be deleted by browser after exit).
+        if cookie_exp:
+            session_exp = _naive_utc(cookie_exp)
+        else:
+            session_exp = datetime.utcnow()+timedelta(days=1)
+        if session.in_cookie and not session.modified:
+            # There is no document to touch, the cookie is signed again.
+            if self._touch_interval is not None and \
+                    session_exp - session.exp < self._touch_interval:
+                return None, cookie_exp, session_exp
+            return 'write', cookie_exp, session_exp
+        if self._touch_interval is not None and not session.modified:
+            if session.exp is not None and \
+                    session_exp - session.exp < self._touch_interval:
+                return None, cookie_exp, session_exp
+            return 'touch', cookie_exp, session_exp
+        return 'write', cookie_exp, session_exp
+
+    def _touch_update(self, session, session_exp):
+        """Return the update refreshing expiration time and the entry
+        describing the session after it."""
+        # Only the expiration time is bumped. It must be written without
+        # upsert, a session removed in the meantime mustn't be resurrected
+        # without data.
+        entry = CacheEntry(session.stored_data(), session_exp,
+                           session.version, session.format, session.spilled)
+        return {'$set': {'exp': session_exp}}, entry
+
+    def _write_entry(self, session, session_exp):
+        """Return the entry describing the session after it's written."""
+        return CacheEntry(session.stored_data(), session_exp,
+                          session.version + 1, self._serializer.format,
+                          session.spilled)
+
+    def _full_update(self, session, session_exp):
+        """Return the update writing the session entirely and the document
+        of the spill collection if the session is spilled (None
+        otherwise). A spilled session gets a new spill document, its key is
+        `spill` of the update."""
+        payload, stored_size = self._pack(session)
+        if self._spill_threshold is None or \
+                stored_size <= self._spill_threshold:
+            update = {'$set': {'d': payload.value, 'f': payload.format,
+                               'exp': session_exp},
+                      '$inc': {'v': 1}}
+            if self._spill_threshold is not None:
+                update['$unset'] = {'spill': '', 'h': '', 'hf': '', 'hk': ''}
+            self._set_user(session, update)
+            return update, None
+
+        if self._metrics is not None:
+            self._metrics.incr('payload.spilled')
+        logger.info('Session of %d bytes is spilled (endpoint %s)',
+                    stored_size, _endpoint())
+        # Hot keys are serialized the same way, so any value can be one.
+        # '_permanent' is always hot, Flask reads it when saving a session.
+        hot_keys = list(self._spill_hot_keys) + ['_permanent']
+        hot = serializers.encode(
+            dict((key, value) for key, value in session.stored_data().items()
+                 if key in hot_keys), self._serializer)
+        update = {'$set': {'spill': _spill_key(session.sid),
+                           'h': hot.value, 'hf': hot.format,
+                           'hk': hot_keys,
+                           'f': payload.format, 'exp': session_exp},
+                  '$unset': {'d': ''},
+                  '$inc': {'v': 1}}
+        self._set_user(session, update)
+        spill = {'d': payload.value, 'f': payload.format, 'exp': session_exp}
+        return update, spill
+
+    def _set_user(self, session, update):
+        """Add the user of the session to the update writing it
+        entirely."""
+        if self._user_key is None:
+            return
+        if self._user_key in session:
+            update['$set']['u'] = session[self._user_key]
+        else:
+            update.setdefault('$unset', {})['u'] = ''
+
+    def _user_spec(self, user, expired=False, namespace=None):
+        """Return the spec of sessions of the user (in the namespace, if
+        it's given), including expired ones if `expired` is set."""
+        if self._user_key is None:
+            raise ValueError('Sessions of users can be found only with '
+                             'user_key option')
+        spec = self._namespace_spec(namespace)
+        spec['u'] = user
+        if not expired:
+            spec['exp'] = {'$gt': datetime.utcnow()}
+        return spec
+
+    def _invalidated(self, sids):
+        """Forget the removed sessions in the caches of the process."""
+        for sid in sids:
+            if self._cache is not None:
+                self._cache.delete(sid)
+            self._missing(sid)
+
+    def _pack(self, session):
+        """Serialize the session, enforcing the size limit. Returns the
+        Payload and its stored size (None if it's not needed)."""
+        payload = session.pack(self._serializer, self._compress_threshold)
+        if self._metrics is None and self._max_size is None and \
+                self._spill_threshold is None:
+            return payload, None
+        size, stored_size = self._payload_sizes(payload)
+        if self._metrics is not None:
+            self._metrics.observe('payload.size', size)
+            self._metrics.observe('payload.stored_size', stored_size)
+        if self._max_size is None or stored_size <= self._max_size:
+            return payload, stored_size
+
+        endpoint = _endpoint()
+        if self._oversize == 'raise':
+            raise SessionTooLarge('Session of %d bytes is larger than %d '
+                                  '(endpoint %s)' %
+                                  (stored_size, self._max_size, endpoint))
+        # The largest values are removed first, until the session fits.
+        sizes = []
+        for key, value in session.items():
+            key_payload = self._serializer.dumps({key: value})
+            sizes.append((self._payload_sizes(serializers.Payload(
+                None, key_payload, None))[1], key))
+        sizes.sort(reverse=True)
+        while stored_size > self._max_size and sizes:
+            _, key = sizes.pop(0)
+            logger.warning('Session of %d bytes is larger than %d, key %r '
+                           'is removed (endpoint %s)', stored_size,
+                           self._max_size, key, endpoint)
+            del session[key]
+            payload = session.pack(self._serializer,
+                                   self._compress_threshold)
+            stored_size = self._payload_sizes(payload)[1]
+        return payload, stored_size
+
+    def _payload_sizes(self, payload):
+        """Return the serialized and stored size of the payload."""
+        if not isinstance(payload.value, bytes):
+            # A subdocument is serialized by the driver, it's measured the
+            # same way.
+            from bson import BSON
+            size = len(BSON.encode(payload.value))
+            return size, size
+        return payload.size or len(payload.value), len(payload.value)
+
+    def _spill_collection_name(self):
+        return self._collection_name + '.spill'
+
+    def _spill_spec(self, sids):
+        """Return the spec of spill documents of the sessions."""
+        return {'$or': [{'_id': _spill_range(sid)} for sid in sids]}
+
+    def _unspilled(self, doc, spill_doc):
+        """Return the session document with the data from the spill
+        collection."""
+        doc = dict(doc)
+        doc['d'] = spill_doc['d']
+        doc['f'] = spill_doc['f']
+        return doc
+
+    def _delta_update(self, session, session_exp):
+        """Return the update writing only changed keys of the session or
+        None if the session must be written entirely."""
+        if not self._delta_updates or not session.can_update_keys():
+            return None
+        if self._metrics is not None or self._max_size is not None or \
+                self._spill_threshold is not None:
+            # The session is measured as a whole; one which crossed a limit
+            # is written entirely, which enforces it.
+            size = self._payload_sizes(session.pack(self._serializer))[1]
+            if (self._max_size is not None and size > self._max_size) or \
+                    (self._spill_threshold is not None and
+                     size > self._spill_threshold):
+                return None
+            if self._metrics is not None:
+                self._metrics.observe('payload.size', size)
+                self._metrics.observe('payload.stored_size', size)
+        update = {'$set': {'exp': session_exp}, '$inc': {'v': 1}}
+        for key in session.set_keys:
+            update['$set']['d.' + key] = session[key]
+        if session.deleted_keys:
+            update['$unset'] = dict(('d.' + key, '')
+                                    for key in session.deleted_keys)
+        if self._user_key in session.set_keys:
+            update['$set']['u'] = session[self._user_key]
+        elif self._user_key in session.deleted_keys:
+            update.setdefault('$unset', {})['u'] = ''
+        return update
+
+    def _saved(self, action, session, entry):
+        """Update the cache after the session was saved."""
+        if self._metrics is not None:
+            self._metrics.incr('save.' + (action or 'skipped'))
+        if action == 'cookie':
+            # A session which moved to the cookie isn't stored any more.
+            action = 'remove'
+        if action == 'write' and self._missing_cache is not None:
+            self._missing_cache.discard(session.sid)
+        if self._cache is None:
+            return
+        if action == 'remove':
+            self._cache.delete(session.sid)
+        elif action == 'touch':
+            self._cache.update_exp(session.sid, entry.exp)
+        elif action == 'write':
+            self._cache.set(session.sid, entry)
+
+    def _set_cookie(self, app, session, response, action, cookie_exp,
+                    value=None):
+        # cookie_domain = self.get_cookie_domain(app)
+        # cookie_path = self.get_cookie_path(app)
+        if action == 'remove':
+            if session.modified:
+                response.delete_cookie(key=app.session_cookie_name,
+                                       #path=cookie_path,
+                                       #domain=cookie_domain
+                                       )
+        elif action is not None:
+            response.set_cookie(key=app.session_cookie_name,
+                                value=value or
+                                self._cookie_value(app, session.sid),
+                                expires=cookie_exp,
+                                #path=cookie_path,
+                                #domain=cookie_domain,
+                                secure=self.get_cookie_secure(app),
+                                httponly=self.get_cookie_httponly(app))
+        # The marker makes the next requests read the session from the
+        # primary until the write is likely replicated. It's a cookie, so
+        # it works whichever process handles them.
+        if self._secondary_reads is not None and value is None and \
+                action in ('write', 'remove'):
+            response.set_cookie(key=self._write_marker_name(app),
+                                value='1',
+                                max_age=self._recent_write_seconds,
+                                secure=self.get_cookie_secure(app),
+                                httponly=True)
+
+
+class MongoDBSessionInterface(BaseMongoDBSessionInterface, SessionInterface):
+    """Session interface storing sessions in a MongoDB collection.
+
+    `db` is a PyMongo database. If it's None, the interface connects to
+    MongoDB itself when it's initialized for an application, with
+    ``MONGO_SESSIONS_*`` settings of the application config (see
+    :meth:`connect`).
+    """
+    lazy_session_class = LazyMongoDBSession
+
+    def __init__(self, app=None, db=None, collection_name=None, lazy=False,
+                 write_behind=None, sweeper=None, breaker=None,
+                 latency_budgets=None, degraded_mode='anonymous',
+                 max_deferred=10000, deferred_batch=10, **options):
+        BaseMongoDBSessionInterface.__init__(self, **options)
         self._db = db
+        self._client = None
         self._collection_name = collection_name
+        # Handles of the collections, made on the first use.
+        self.__handles = {}
+        # Set when indexes are ensured, an interface shared by applications
+        # does it once.
+        self.__indexed = False
+        # If set, sessions are loaded on the first access, so requests
+        # which don't use the session don't query the database.
+        self._lazy = lazy
+        # Optional WriteBehindQueue, sessions are written in the background
+        # if it's set.
+        if write_behind is not None and self._optimistic:
+            raise ValueError('Writes in the background can not be checked '
+                             'for conflicts')
+        self._write_behind = write_behind
+        if write_behind is not None:
+            write_behind.bind(self.__get_collection, self._metrics)
+        # Optional Sweeper, expired sessions are removed by it on
+        # a background thread of every process.
+        self._sweeper = sweeper
+        if sweeper is not None:
+            get_spill_collection = None
+            if self._spill_threshold is not None:
+                get_spill_collection = self.__get_spill_collection
+            sweeper.bind(self.__get_collection, self._metrics,
+                         get_spill_collection, self.__get_lease_collection)
+        # Optional CircuitBreaker, failed and slow storage calls are
+        # reported to it and no calls are made while it's open.
+        self._breaker = breaker
+        if breaker is not None:
+            breaker.add_listener(self.__breaker_changed)
+        # Seconds storage operations ('find_one', 'update', 'remove', ...)
+        # may take, slower calls count as failed. Reads get it as the
+        # server-side time limit.
+        self._latency_budgets = latency_budgets or {}
+        # How requests are served while the storage is unavailable:
+        # 'anonymous' (empty sessions, changes are lost), 'cache' (cached
+        # sessions read-only) or 'queue' (cached sessions, writes are
+        # deferred until the storage is available).
+        if degraded_mode not in ('anonymous', 'cache', 'queue'):
+            raise ValueError('Unknown degraded mode %r' % degraded_mode)
+        self._degraded_mode = degraded_mode
+        # Deferred writes by SID, at most `max_deferred` of them, the
+        # oldest are dropped.
+        self._max_deferred = max_deferred
+        # Deferred writes flushed by a request when the storage is available
+        # again (besides the write of its own session), so no request waits
+        # for all of them.
+        self._deferred_batch = deferred_batch
+        self.__deferred = OrderedDict()
+        self.__deferred_lock = threading.Lock()
 
         if app is not None:
             self.app = app
@@ -38,65 +1152,524 @@ class MongoDBSessionInterface(SessionInterface):
         else:
             self.app = None
 
+    @classmethod
+    def from_uri(cls, uri, app=None, collection_name='sessions',
+                 client_options=None, **options):
+        """Make an interface with its own MongoClient, connected to the
+        database in `uri`. `client_options` are passed to MongoClient."""
+        interface = cls(None, None, collection_name, **options)
+        interface.connect(uri, **(client_options or {}))
+        if app is not None:
+            interface.app = app
+            interface.init_app(app)
+        return interface
+
+    def connect(self, uri, **client_options):
+        """Connect to the database in `uri` with a new MongoClient, so the
+        sessions use a pool of their own."""
+        from pymongo import MongoClient
+
+        self._client = MongoClient(uri, **client_options)
+        self._db = self._client.get_default_database()
+        self.__handles = {}
+
     def init_app(self, app):
         if not hasattr(app, 'extensions'):
             app.extensions = {}
         app.extensions['mongodb-sessions'] = self
+        if self._db is None:
+            self.connect(app.config['MONGO_SESSIONS_URI'],
+                         **_client_options(app.config))
+        if self._collection_name is None:
+            self._collection_name = app.config.get(
+                'MONGO_SESSIONS_COLLECTION', 'sessions')
+        if self._namespaces:
+            self._register_namespace(app)
+        if not self.__indexed:
+            self.__indexed = True
+            self.__ensure_indexes()
+
+    def __ensure_indexes(self):
+        if self._ttl_index:
+            self.__get_collection().create_index('exp', expireAfterSeconds=0)
+            if self._spill_threshold is not None:
+                self.__get_spill_collection().create_index(
+                    'exp', expireAfterSeconds=0)
+        elif self._sweeper is not None:
+            self._sweeper.ensure_index()
+        if self._user_key is not None:
+            self.__get_collection().create_index('u', sparse=True)
 
     def open_session(self, app, request):
-        sid = request.cookies.get(app.session_cookie_name)
-        if not sid:
-            sid = self.__generate_sid()
-            return self.session_class(sid=sid)
-
-        doc = self.__get_collection().find_one({'_id': sid})
-        # Check if exists and not expired.
-        # It's ok to remove tzinfo here, because utcnow() returns UTC time,
-        # despite it's in naive form (without tzinfo).
-        if doc and doc['exp'].replace(tzinfo=None) > datetime.utcnow():
-            session = self.session_class(initial=doc['d'], sid=sid)
-        else:
-            # If the SID doesn't exist - create a new one to avoid possibility
-            # of user-generated SID with invalid format (e.g. "abc123").
-            sid = self.__generate_sid()
-            session = self.session_class(sid=sid)
-        return session
+        return timed(self._metrics, 'session.open',
+                     self.__open_session, app, request)
 
     def save_session(self, app, session, response):
-        # cookie_domain = self.get_cookie_domain(app)
-        # cookie_path = self.get_cookie_path(app)
-        cookie_exp = self.get_expiration_time(app, session)
+        return timed(self._metrics, 'session.save',
+                     self.__save_session, app, session, response)
 
-        if not session:
-            self.__get_collection().remove({'_id': session.sid})
+    def user_sessions(self, user, namespace=None):
+        """Return SIDs of unexpired sessions of the user (the value of the
+        `user_key` session key), in the namespace if it's given."""
+        cursor = self.__call('find', self._user_spec(user, False, namespace),
+                             {'_id': True})
+        return [doc['_id'] for doc in cursor]
+
+    def count_user_sessions(self, user, namespace=None):
+        """Return the number of unexpired sessions of the user."""
+        cursor = self.__call('find', self._user_spec(user, False, namespace),
+                             {'_id': True})
+        return timed(self._metrics, 'storage.count', cursor.count)
+
+    def invalidate_user_sessions(self, user, namespace=None):
+        """Find all sessions of the user and remove them (e.g. after
+        a password change), forgetting them in the caches of the process.
+        Returns the number of removed sessions."""
+        spec = self._user_spec(user, True, namespace)
+        if self._write_behind is not None:
+            # Queued writes mustn't bring the sessions back.
+            self._write_behind.flush()
+        cursor = self.__call('find', spec, {'_id': True})
+        sids = [doc['_id'] for doc in cursor]
+        result = self.__call('remove', spec)
+        if sids and self._spill_threshold is not None:
+            self.__spill_call('remove', self._spill_spec(sids))
+        self._invalidated(sids)
+        if isinstance(result, dict):
+            return result.get('n', len(sids))
+        return len(sids)
+
+    def count_sessions(self, namespace=None):
+        """Return the number of unexpired sessions (in the namespace, if
+        it's given)."""
+        spec = self._namespace_spec(namespace)
+        spec['exp'] = {'$gt': datetime.utcnow()}
+        cursor = self.__call('find', spec, {'_id': True})
+        return timed(self._metrics, 'storage.count', cursor.count)
+
+    def __open_session(self, app, request):
+        if self._sweeper is not None:
+            # Started lazily, so it runs in the process serving requests
+            # and not in the one which forked it.
+            self._sweeper.start()
+        session = self._cookie_session(app, request)
+        if session is not None:
+            return session
+        sid = self._sid_from_cookie(app, request)
+        if self.__deferred and self._breaker.state == 'closed':
+            self.__flush_deferred(sid)
+        if not sid:
+            return self.session_class(sid=self._new_key(app))
+
+        secondary = self._may_read_secondary(app, request)
+        if self._lazy or self._spill_hot_keys:
+            session = self.lazy_session_class(
+                lambda session: self.__load_session(session, secondary),
+                sid=sid)
+            if not self._lazy:
+                # Hot keys of a spilled session are read now, the rest on
+                # the first access to another key.
+                session.load_hot()
+            return session
+        session = self.session_class(sid=sid, new=False)
+        self.__load_session(session, secondary)
+        return session
+
+    def __save_session(self, app, session, response):
+        if self._metrics is not None and self._lazy and \
+                isinstance(session, LazyMongoDBSession):
+            self._metrics.incr('session.lazy_loaded' if session.loaded
+                               else 'session.lazy_unused')
+        if session.degraded == 'anonymous' or (
+                session.degraded == 'cache' and
+                self._degraded_mode != 'queue'):
+            # The stored session wasn't loaded, the cookie is kept.
             if session.modified:
-                response.delete_cookie(key=app.session_cookie_name,
-                                       #path=cookie_path,
-                                       #domain=cookie_domain
-                                       )
+                logger.warning('Session %s is read-only, the storage is '
+                               'unavailable; changes are lost', session.sid)
             return
+        try:
+            self.__store_session(app, session, response)
+        except self.__storage_errors():
+            self.__defer(app, session, response)
 
-        # If session isn't permanent if will be considered valid for 1 day
-        # (but not cookie which will be deleted by browser after exit).
-        session_exp = cookie_exp or datetime.utcnow()+timedelta(days=1)
-        self.__get_collection().update(
-            {'_id': session.sid},
-            {'$set': {
-                'd': session.pack(),
-                'exp': session_exp,
-            }},
-            upsert=True)
-
-        response.set_cookie(key=app.session_cookie_name,
-                            value=session.sid,
-                            expires=cookie_exp,
-                            #path=cookie_path,
-                            #domain=cookie_domain,
-                            secure=self.get_cookie_secure(app),
-                            httponly=self.get_cookie_httponly(app))
-
-    def __get_collection(self):
-        return self._db[self._collection_name]
-
-    def __generate_sid(self):
-        return uuid.uuid4().hex
+    def __store_session(self, app, session, response):
+        action, cookie_exp, session_exp = self._save_action(app, session)
+        cookie = self._session_cookie(app, session, action)
+        if cookie is not None:
+            # A session which shrank is moved from the database.
+            if not session.new and not session.in_cookie:
+                self.__remove(session.sid, spilled=session.spilled)
+            self._saved('cookie', session, None)
+            self._set_cookie(app, session, response, action, cookie_exp,
+                             cookie)
+            return
+        entry = None
+        if self._is_checked(session, action):
+            action = self.__save_checked(session, action, session_exp)
+            if action == 'write':
+                entry = self._write_entry(session, session_exp)
+        elif action == 'remove':
+            if not session.in_cookie:
+                self.__remove(session.sid, spilled=session.spilled)
+        elif action == 'touch':
+            if self._write_behind is not None and \
+                    not getattr(session, 'loaded', True):
+                # A queued write is read as the whole session.
+                session.load()
+            update, entry = self._touch_update(session, session_exp)
+            if not self.__update(session.sid, update, entry=entry,
+                                 touch=True):
+                action = self._gone(session)
+            elif session.spilled:
+                self.__spill_call('update', {'_id': session.spilled}, update,
+                                  touch=True)
+        elif action == 'write':
+            entry = self._write_entry(session, session_exp)
+            # Queued delta updates can't be checked if they matched, so
+            # sessions written in the background are rewritten entirely.
+            update = None
+            if self._write_behind is None:
+                update = self._delta_update(session, session_exp)
+            # The document could be removed in the meantime (e.g. sessions
+            # of the user were invalidated), so a delta update which doesn't
+            # match is retried entirely, but the session isn't inserted
+            # again.
+            if update is None or \
+                    not self.__update(session.sid, update, entry=entry):
+                matched, entry = self.__write_full(
+                    session, session_exp, upsert=self._is_inserted(session))
+                if not matched:
+                    action = self._gone(session)
+        self._saved(action, session, entry)
+        self._set_cookie(app, session, response, action, cookie_exp)
+
+    def __defer(self, app, session, response):
+        """Queue the write of the session until the storage is available
+        (in 'queue' degraded mode), drop it otherwise."""
+        action, cookie_exp, session_exp = self._save_action(app, session)
+        if action not in ('write', 'remove'):
+            return
+        if self._degraded_mode != 'queue':
+            logger.warning('Session %s is not saved, the storage is '
+                           'unavailable', session.sid)
+            return
+        with self.__deferred_lock:
+            previous = self.__deferred.pop(session.sid, None)
+            if previous is not None:
+                self._carry_changes(previous[1], session)
+            self.__deferred[session.sid] = (action, session, session_exp)
+            while len(self.__deferred) > self._max_deferred:
+                sid, _ = self.__deferred.popitem(last=False)
+                logger.warning('Deferred write of session %s is dropped',
+                               sid)
+        entry = None
+        if action == 'write':
+            entry = self._write_entry(session, session_exp)
+        if self._metrics is not None:
+            self._metrics.incr('save.deferred')
+        # Cached, so the session is served from the cache meanwhile.
+        self._saved(action, session, entry)
+        self._set_cookie(app, session, response, action, cookie_exp)
+
+    def __flush_deferred(self, sid=None):
+        """Write the deferred session with `sid` (read by the request, so
+        it reads its own write) and at most `deferred_batch` others, until
+        the storage fails again.
+
+        They are written only if the stored documents weren't changed since
+        the sessions were loaded, changes are merged otherwise (see
+        __save_checked).
+        """
+        flushed = 0
+        while True:
+            with self.__deferred_lock:
+                if sid is not None and sid in self.__deferred:
+                    key, write = sid, self.__deferred.pop(sid)
+                elif self.__deferred and flushed < self._deferred_batch:
+                    key, write = self.__deferred.popitem(last=False)
+                    flushed += 1
+                else:
+                    return
+            action, session, session_exp = write
+            try:
+                self.__save_checked(session, action, session_exp)
+            except self.__storage_errors():
+                with self.__deferred_lock:
+                    # Unless it was written again in the meantime.
+                    if key not in self.__deferred:
+                        self.__deferred[key] = write
+                return
+            except Exception:
+                # It would fail again, and it mustn't fail the request.
+                logger.exception('Deferred write of session %s failed, it '
+                                 'is dropped', key)
+
+    def __save_checked(self, session, action, session_exp):
+        """Write or remove the session if the stored document wasn't changed
+        since it was loaded, merge the changes and retry otherwise. Returns
+        the action which was done."""
+        merged = False
+        for _ in range(self._conflict_retries):
+            if action == 'remove':
+                if self.__remove(session.sid, session.version,
+                                 session.spilled):
+                    return action
+            else:
+                update = None
+                if not merged:
+                    update = self._delta_update(session, session_exp)
+                if update is not None:
+                    matched = self.__update(session.sid, update,
+                                            version=session.version)
+                else:
+                    matched, _ = self.__write_full(
+                        session, session_exp, upsert=False,
+                        version=session.version)
+                if matched:
+                    return action
+            doc = self.__find_session(self._lookup_spec(
+                session.sid, datetime.utcnow()))
+            if not doc:
+                # Removed or expired in the meantime, there is nothing to
+                # merge with.
+                if action == 'remove' or not self._is_inserted(session):
+                    return self._gone(session)
+                break
+            action = self._merge_stored(session, doc)
+            merged = True
+        else:
+            logger.warning('Session %s is changed concurrently, '
+                           'it is overwritten', session.sid)
+        if action == 'remove':
+            self.__remove(session.sid, spilled=session.spilled)
+        elif not self.__write_full(session, session_exp,
+                                   upsert=self._is_inserted(session))[0]:
+            return self._gone(session)
+        return action
+
+    def __write_full(self, session, session_exp, upsert=True, version=None):
+        """Write the session entirely, to the spill collection if it's
+        large. Returns a flag if the update matched a document and the
+        entry describing the session after it."""
+        update, spill = self._full_update(session, session_exp)
+        spilled = session.spilled
+        session.spilled = spill is not None and update['$set']['spill']
+        entry = self._write_entry(session, session_exp)
+        if spill is not None:
+            # The data is written to a new document before the reference to
+            # it, so a write which doesn't match (or a concurrent one)
+            # doesn't replace data the stored session references.
+            self.__spill_call('update', {'_id': session.spilled},
+                              {'$set': spill}, upsert=True)
+        matched = self.__update(session.sid, update, upsert=upsert,
+                                entry=entry, version=version)
+        if not matched:
+            if spill is not None:
+                self.__spill_call('remove', {'_id': session.spilled})
+            session.spilled = spilled
+        # A queued write would make the session reference removed data
+        # until it's flushed, the spilled data is left to expire then.
+        elif spilled and self._write_behind is None:
+            self.__spill_call('remove', {'_id': spilled})
+        return matched, entry
+
+    def __update(self, sid, update, upsert=False, entry=None, version=None,
+                 touch=False):
+        """Write the session, in the background if write-behind is on.
+
+        `entry` is what the session looks like after the write. If
+        `version` is given, only the document of this version is updated.
+        `touch` is set if only expiration time is updated. Returns False if
+        the update didn't match any document.
+        """
+        if self._write_behind is not None and \
+                self._write_behind.put(sid, update, upsert, entry):
+            return True
+        spec = self._version_spec(sid, version)
+        result = self.__storage('update', self.__get_collection(touch).update,
+                                spec, update, upsert=upsert)
+        # Unacknowledged writes return None, they are considered matched.
+        return not isinstance(result, dict) or bool(result.get('n'))
+
+    def __remove(self, sid, version=None, spilled=False):
+        """Remove the session, in the background if write-behind is on.
+
+        If `version` is given, only the document of this version is
+        removed. If `spilled` is set, the data in the spill collection is
+        removed too. Returns False if no document was removed.
+        """
+        if self._write_behind is not None and \
+                self._write_behind.put(sid, None):
+            removed = True
+        else:
+            spec = self._version_spec(sid, version)
+            result = self.__call('remove', spec)
+            removed = not isinstance(result, dict) or bool(result.get('n'))
+        if removed and spilled:
+            # Documents of writes which didn't match may be left too.
+            self.__spill_call('remove', {'_id': _spill_range(sid)})
+        return removed
+
+    def __load_session(self, session, secondary=False):
+        """Fill the session with the stored data. A lazy session which is
+        spilled is filled only with its hot keys."""
+        hot = bool(self._spill_hot_keys) and \
+            isinstance(session, LazyMongoDBSession)
+        try:
+            entry = self.__load_entry(session.sid, secondary, hot)
+        except self.__storage_errors():
+            self.__degrade(session)
+            return
+        self._fill_session(session, entry)
+        if isinstance(entry, _HotEntry):
+            session.defer_spilled(
+                entry.hot_keys,
+                lambda session: self.__load_spilled(session, secondary))
+
+    def __load_spilled(self, session, secondary=False):
+        """Fill the session which has only its hot keys with the data from
+        the spill collection."""
+        try:
+            collection = self.__get_spill_collection(secondary=secondary)
+            spill_doc = self.__storage('find_one', collection.find_one,
+                                       {'_id': session.spilled})
+            if spill_doc:
+                entry = self._entry_from_doc(session.sid, {
+                    'd': spill_doc['d'], 'f': spill_doc['f'],
+                    'exp': session.exp, 'v': session.version,
+                    'spill': session.spilled})
+            else:
+                # Written again (or removed) since the session document was
+                # read, it's read again.
+                entry = self.__load_entry(session.sid, secondary)
+        except self.__storage_errors():
+            self.__degrade(session)
+            return
+        if entry is None:
+            dict.clear(session)
+        self._fill_session(session, entry)
+
+    def __degrade(self, session):
+        """Fill the session while the storage is unavailable: from the
+        cache if the degraded mode allows it, or leave it empty."""
+        if self._metrics is not None:
+            self._metrics.incr('session.degraded')
+        if self._degraded_mode != 'anonymous' and self._cache is not None:
+            entry = self._cache.get(session.sid)
+            if entry is not None and entry.exp > datetime.utcnow():
+                self._fill_session(session, entry)
+                session.degraded = 'cache'
+                return
+        session.degraded = 'anonymous'
+
+    def __breaker_changed(self, old, new):
+        if self._metrics is not None:
+            self._metrics.incr('breaker.' + new)
+
+    def __storage_errors(self):
+        """Return exceptions of the storage being unavailable, which are
+        handled by degrading, none without a circuit breaker. Others are
+        raised."""
+        if self._breaker is None:
+            return ()
+        return (CircuitOpenError,) + unavailable_errors()
+
+    def __storage(self, operation, method, *args, **kwargs):
+        """Call a method of a collection, timing it and reporting the
+        outcome to the circuit breaker."""
+        if self._breaker is None:
+            return timed(self._metrics, 'storage.' + operation,
+                         method, *args, **kwargs)
+        if not self._breaker.allow():
+            raise CircuitOpenError('Session storage is unavailable')
+        budget = self._latency_budgets.get(operation)
+        if budget is not None and operation == 'find_one':
+            kwargs['max_time_ms'] = max(int(budget * 1000), 1)
+        started = time.time()
+        try:
+            result = timed(self._metrics, 'storage.' + operation,
+                           method, *args, **kwargs)
+        except Exception as e:
+            # Other errors are answers of the server, which is available.
+            self._breaker.record(not isinstance(e, unavailable_errors()))
+            raise
+        self._breaker.record(budget is None or
+                             time.time() - started <= budget)
+        return result
+
+    def __load_entry(self, sid, secondary=False, hot=False):
+        """Return the stored session data with the given SID as CacheEntry
+        or None if it doesn't exist or is expired. If `secondary` is set,
+        it may be read from a secondary. If `hot` is set, only hot keys of
+        a spilled session are read, as a _HotEntry."""
+        now = datetime.utcnow()
+        if self._write_behind is not None and \
+                self._write_behind.read_your_writes:
+            pending, entry = self._write_behind.get(sid)
+            if pending:
+                return entry
+
+        entry = self._cached_entry(sid, now)
+        if entry is not None and self._cache.revalidate:
+            doc = self.__find_one(self._lookup_spec(sid, now),
+                                  self._version_fields, secondary)
+            entry = self._revalidated_entry(sid, entry, doc)
+            if not doc:
+                return None
+        if entry is None:
+            doc = self.__find_session(self._lookup_spec(sid, now),
+                                      secondary, hot)
+            if doc and 'd' not in doc:
+                return self._hot_entry(doc)
+            entry = self._entry_from_doc(sid, doc)
+        return entry
+
+    def __call(self, operation, *args, **kwargs):
+        """Call a method of the collection, timing it."""
+        method = getattr(self.__get_collection(), operation)
+        return self.__storage(operation, method, *args, **kwargs)
+
+    def __spill_call(self, operation, *args, **kwargs):
+        """Call a method of the spill collection, timing it."""
+        collection = self.__get_spill_collection(kwargs.pop('touch', False))
+        return self.__storage(operation, getattr(collection, operation),
+                              *args, **kwargs)
+
+    def __find_one(self, spec, fields=None, secondary=False):
+        collection = self.__get_collection(secondary=secondary)
+        return self.__storage('find_one', collection.find_one, spec, fields)
+
+    def __find_session(self, spec, secondary=False, hot=False):
+        """Find the session document, with the data from the spill
+        collection if it's spilled (unless `hot` is set and the document
+        has hot keys)."""
+        doc = self.__find_one(spec, secondary=secondary)
+        for _ in range(2):
+            if not doc or not doc.get('spill') or (hot and 'hk' in doc):
+                return doc
+            collection = self.__get_spill_collection(secondary=secondary)
+            spill_doc = self.__storage('find_one', collection.find_one,
+                                       {'_id': doc['spill']})
+            if spill_doc:
+                return self._unspilled(doc, spill_doc)
+            # The session was written again and the data it referenced was
+            # removed in the meantime.
+            doc = self.__find_one(spec, secondary=secondary)
+        return None
+
+    def __get_collection(self, touch=False, secondary=False, spill=False):
+        key = (touch, secondary, spill)
+        if key not in self.__handles:
+            name = self._collection_name
+            if spill:
+                name = self._spill_collection_name()
+            self.__handles[key] = self._with_options(
+                self._db[name], touch=touch, secondary=secondary)
+        return self.__handles[key]
+
+    def __get_spill_collection(self, touch=False, secondary=False):
+        return self.__get_collection(touch, secondary, spill=True)
+
+    def __get_lease_collection(self):
+        return self._db[self._collection_name + '.leases']
@@ -0,0 +1,322 @@
+"""Asynchronous session interface for Quart (and other frameworks which
+await session interfaces), backed by Motor.
+
+Requires Python 3.5+. Any collection whose `find_one`, `update_one`,
+`delete_one` and `create_index` methods are coroutines can be used instead
+of a Motor collection (`find`, `count_documents` and `delete_many` are
+needed for sessions of users).
+"""
+import logging
+import time
+from datetime import datetime
+
+try:
+    from quart.sessions import SessionInterface
+except ImportError:
+    from flask.sessions import SessionInterface
+
+from flask_mongo_sessions import BaseMongoDBSessionInterface
+from flask_mongo_sessions import _spill_range
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMongoDBSessionInterface(BaseMongoDBSessionInterface,
+                                   SessionInterface):
+    """Session interface with the same document layout, expiration and
+    cookies as :class:`MongoDBSessionInterface`, doing I/O with awaitable
+    collection methods.
+
+    `db` is a Motor database. Options are the same as the synchronous
+    interface has, except of lazy sessions and write-behind. A TTL index
+    isn't ensured by :meth:`init_app`, await :meth:`ensure_indexes`
+    instead.
+    """
+
+    def __init__(self, app, db, collection_name, **options):
+        BaseMongoDBSessionInterface.__init__(self, **options)
+        self._db = db
+        self._collection_name = collection_name
+        # Handles of the collections, made on the first use.
+        self._handles = {}
+
+        if app is not None:
+            self.app = app
+            self.init_app(app)
+        else:
+            self.app = None
+
+    def init_app(self, app):
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['mongodb-sessions'] = self
+        if self._namespaces:
+            self._register_namespace(app)
+
+    async def ensure_indexes(self):
+        if self._ttl_index:
+            await self._get_collection().create_index(
+                'exp', expireAfterSeconds=0)
+            if self._spill_threshold is not None:
+                await self._get_collection(spill=True).create_index(
+                    'exp', expireAfterSeconds=0)
+        if self._user_key is not None:
+            await self._get_collection().create_index('u', sparse=True)
+
+    async def user_sessions(self, user, namespace=None):
+        """Return SIDs of unexpired sessions of the user (the value of the
+        `user_key` session key), in the namespace if it's given."""
+        return await self._find_sids(self._user_spec(user, False, namespace))
+
+    async def count_user_sessions(self, user, namespace=None):
+        """Return the number of unexpired sessions of the user."""
+        return await self._call('count', 'count_documents',
+                                self._user_spec(user, False, namespace))
+
+    async def invalidate_user_sessions(self, user, namespace=None):
+        """Remove all sessions of the user and forget them in the caches.
+        Returns the number of removed sessions."""
+        spec = self._user_spec(user, True, namespace)
+        sids = await self._find_sids(spec)
+        result = await self._call('remove', 'delete_many', spec)
+        if sids and self._spill_threshold is not None:
+            await self._call('remove', 'delete_many',
+                             self._spill_spec(sids), spill=True)
+        self._invalidated(sids)
+        if not getattr(result, 'acknowledged', True):
+            return len(sids)
+        return result.deleted_count
+
+    async def count_sessions(self, namespace=None):
+        """Return the number of unexpired sessions (in the namespace, if
+        it's given)."""
+        spec = self._namespace_spec(namespace)
+        spec['exp'] = {'$gt': datetime.utcnow()}
+        return await self._call('count', 'count_documents', spec)
+
+    async def open_session(self, app, request):
+        started = time.time()
+        try:
+            return await self._open_session(app, request)
+        finally:
+            self._observe_time('session.open', started)
+
+    async def save_session(self, app, session, response):
+        started = time.time()
+        try:
+            await self._save_session(app, session, response)
+        finally:
+            self._observe_time('session.save', started)
+
+    async def _open_session(self, app, request):
+        session = self._cookie_session(app, request)
+        if session is not None:
+            return session
+        sid = self._sid_from_cookie(app, request)
+        if not sid:
+            return self.session_class(sid=self._new_key(app))
+
+        session = self.session_class(sid=sid, new=False)
+        self._fill_session(session, await self._load_entry(
+            sid, self._may_read_secondary(app, request)))
+        return session
+
+    async def _save_session(self, app, session, response):
+        action, cookie_exp, session_exp = self._save_action(app, session)
+        cookie = self._session_cookie(app, session, action)
+        if cookie is not None:
+            # A session which shrank is moved from the database.
+            if not session.new and not session.in_cookie:
+                await self._remove(session.sid, spilled=session.spilled)
+            self._saved('cookie', session, None)
+            self._set_cookie(app, session, response, action, cookie_exp,
+                             cookie)
+            return
+        entry = None
+        if self._is_checked(session, action):
+            action = await self._save_checked(session, action, session_exp)
+            if action == 'write':
+                entry = self._write_entry(session, session_exp)
+        elif action == 'remove':
+            if not session.in_cookie:
+                await self._remove(session.sid, spilled=session.spilled)
+        elif action == 'touch':
+            update, entry = self._touch_update(session, session_exp)
+            if not await self._update(session.sid, update, touch=True):
+                action = self._gone(session)
+            elif session.spilled:
+                await self._call('update', 'update_one',
+                                 {'_id': session.spilled}, update,
+                                 touch=True, spill=True)
+        elif action == 'write':
+            entry = self._write_entry(session, session_exp)
+            update = self._delta_update(session, session_exp)
+            # The document could be removed in the meantime, so it's
+            # rewritten entirely when a delta update doesn't match, but it
+            # isn't inserted again.
+            if update is None or not await self._update(session.sid, update):
+                matched, entry = await self._write_full(
+                    session, session_exp, upsert=self._is_inserted(session))
+                if not matched:
+                    action = self._gone(session)
+        self._saved(action, session, entry)
+        self._set_cookie(app, session, response, action, cookie_exp)
+
+    async def _save_checked(self, session, action, session_exp):
+        """Write or remove the session if the stored document wasn't changed
+        since it was loaded, merge the changes and retry otherwise. Returns
+        the action which was done."""
+        merged = False
+        for _ in range(self._conflict_retries):
+            if action == 'remove':
+                if await self._remove(session.sid, session.version,
+                                      session.spilled):
+                    return action
+            else:
+                update = None
+                if not merged:
+                    update = self._delta_update(session, session_exp)
+                if update is not None:
+                    matched = await self._update(session.sid, update,
+                                                 version=session.version)
+                else:
+                    matched, _ = await self._write_full(
+                        session, session_exp, upsert=False,
+                        version=session.version)
+                if matched:
+                    return action
+            doc = await self._find_session(self._lookup_spec(
+                session.sid, datetime.utcnow()))
+            if not doc:
+                # Removed or expired in the meantime, there is nothing to
+                # merge with.
+                if action == 'remove' or not self._is_inserted(session):
+                    return self._gone(session)
+                break
+            action = self._merge_stored(session, doc)
+            merged = True
+        else:
+            logger.warning('Session %s is changed concurrently, '
+                           'it is overwritten', session.sid)
+        if action == 'remove':
+            await self._remove(session.sid, spilled=session.spilled)
+        elif not (await self._write_full(
+                session, session_exp, upsert=self._is_inserted(session)))[0]:
+            return self._gone(session)
+        return action
+
+    async def _write_full(self, session, session_exp, upsert=True,
+                          version=None):
+        """Write the session entirely, to the spill collection if it's
+        large. Returns a flag if the update matched a document and the
+        entry describing the session after it."""
+        update, spill = self._full_update(session, session_exp)
+        spilled = session.spilled
+        session.spilled = spill is not None and update['$set']['spill']
+        entry = self._write_entry(session, session_exp)
+        if spill is not None:
+            # The data is written to a new document before the reference to
+            # it (see MongoDBSessionInterface).
+            await self._call('update', 'update_one',
+                             {'_id': session.spilled}, {'$set': spill},
+                             upsert=True, spill=True)
+        matched = await self._update(session.sid, update, upsert=upsert,
+                                     version=version)
+        if not matched:
+            if spill is not None:
+                await self._call('remove', 'delete_one',
+                                 {'_id': session.spilled}, spill=True)
+            session.spilled = spilled
+        elif spilled:
+            await self._call('remove', 'delete_one', {'_id': spilled},
+                             spill=True)
+        return matched, entry
+
+    async def _update(self, sid, update, upsert=False, version=None,
+                      touch=False):
+        """Update the session document (of the given version, if it's not
+        None). Returns False if it didn't match any document."""
+        result = await self._call('update', 'update_one',
+                                  self._version_spec(sid, version), update,
+                                  upsert=upsert, touch=touch)
+        # Unacknowledged writes are considered matched.
+        return not getattr(result, 'acknowledged', True) or \
+            result.matched_count > 0
+
+    async def _remove(self, sid, version=None, spilled=False):
+        result = await self._call('remove', 'delete_one',
+                                  self._version_spec(sid, version))
+        removed = not getattr(result, 'acknowledged', True) or \
+            result.deleted_count > 0
+        if removed and spilled:
+            await self._call('remove', 'delete_many',
+                             {'_id': _spill_range(sid)}, spill=True)
+        return removed
+
+    async def _load_entry(self, sid, secondary=False):
+        now = datetime.utcnow()
+        entry = self._cached_entry(sid, now)
+        if entry is not None and self._cache.revalidate:
+            doc = await self._call('find_one', 'find_one',
+                                   self._lookup_spec(sid, now),
+                                   self._version_fields, secondary=secondary)
+            entry = self._revalidated_entry(sid, entry, doc)
+            if not doc:
+                return None
+        if entry is None:
+            doc = await self._find_session(self._lookup_spec(sid, now),
+                                           secondary)
+            entry = self._entry_from_doc(sid, doc)
+        return entry
+
+    async def _find_session(self, spec, secondary=False):
+        """Find the session document, with the data from the spill
+        collection if it's spilled."""
+        doc = await self._call('find_one', 'find_one', spec,
+                               secondary=secondary)
+        for _ in range(2):
+            if not doc or not doc.get('spill'):
+                return doc
+            spill_doc = await self._call('find_one', 'find_one',
+                                         {'_id': doc['spill']},
+                                         secondary=secondary, spill=True)
+            if spill_doc:
+                return self._unspilled(doc, spill_doc)
+            # Written again in the meantime, the data is read again.
+            doc = await self._call('find_one', 'find_one', spec,
+                                   secondary=secondary)
+        return None
+
+    async def _find_sids(self, spec):
+        started = time.time()
+        try:
+            cursor = self._get_collection().find(spec, {'_id': True})
+            return [doc['_id'] for doc in await cursor.to_list(None)]
+        finally:
+            self._observe_time('storage.find', started)
+
+    async def _call(self, operation, method, *args, touch=False,
+                    secondary=False, spill=False, **kwargs):
+        """Await a method of the collection, reporting its duration as
+        `operation` (named as in the synchronous interface)."""
+        collection = self._get_collection(touch, secondary, spill)
+        started = time.time()
+        try:
+            return await getattr(collection, method)(*args, **kwargs)
+        finally:
+            self._observe_time('storage.' + operation, started)
+
+    def _observe_time(self, name, started):
+        if self._metrics is not None:
+            self._metrics.observe(name, time.time() - started)
+
+    def _get_collection(self, touch=False, secondary=False, spill=False):
+        key = (touch, secondary, spill)
+        if key not in self._handles:
+            name = self._collection_name
+            if spill:
+                name = self._spill_collection_name()
+            self._handles[key] = self._with_options(
+                self._db[name], touch=touch, secondary=secondary)
+        return self._handles[key]
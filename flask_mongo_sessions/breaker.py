@@ -0,0 +1,107 @@
+"""Circuit breaker of session storage.
+
+While the database is unavailable or slow (e.g. during an election), every
+request would wait for the driver to time out. A :class:`CircuitBreaker`
+counts consecutive failed and slow storage calls; after
+`failure_threshold` of them it opens and calls fail at once with
+:class:`CircuitOpenError`, so the session interface serves requests in
+a degraded mode instead. After `reset_timeout` seconds it's half-open: one
+call at a time is let through, the breaker closes if it succeeds and opens
+again if it fails.
+"""
+from __future__ import with_statement
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """A storage call isn't made, the circuit breaker is open."""
+
+
+def unavailable_errors():
+    """Return PyMongo exceptions of the storage being unavailable or
+    slow, the failures a breaker counts. Others (e.g. a rejected write)
+    are raised by the server, which is available."""
+    # NetworkTimeout and ServerSelectionTimeoutError are AutoReconnect.
+    from pymongo.errors import AutoReconnect
+    from pymongo.errors import ExecutionTimeout
+    return (AutoReconnect, ExecutionTimeout)
+
+
+class CircuitBreaker(object):
+    """Thread-safe circuit breaker.
+
+    Listeners added with :meth:`add_listener` are called with the old and
+    the new state on every change of the state.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        # Consecutive failed calls.
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def allow(self):
+        """Check if a call may be made now."""
+        change = None
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self._opened < self.reset_timeout:
+                    return False
+                change = self._set_state(HALF_OPEN)
+            allowed = not self._trial
+            self._trial = True
+        self._notify(change)
+        return allowed
+
+    def record(self, success):
+        """Record the outcome of a call: False if it failed or was too
+        slow."""
+        change = None
+        with self._lock:
+            if success:
+                self.failures = 0
+                # Calls started before the breaker opened don't close it.
+                if self.state == HALF_OPEN:
+                    change = self._set_state(CLOSED)
+            else:
+                self.failures += 1
+                if self.state == HALF_OPEN or (
+                        self.state == CLOSED and
+                        self.failures >= self.failure_threshold):
+                    self._opened = time.time()
+                    change = self._set_state(OPEN)
+            self._trial = False
+        self._notify(change)
+
+    def _set_state(self, state):
+        change = (self.state, state)
+        self.state = state
+        return change
+
+    def _notify(self, change):
+        if change is None:
+            return
+        logger.warning('Session storage circuit breaker: %s -> %s', *change)
+        for listener in self._listeners:
+            listener(*change)
@@ -0,0 +1,135 @@
+from __future__ import with_statement
+
+import copy
+import threading
+import time
+from collections import namedtuple
+from collections import OrderedDict
+
+
+# Deserialized session data, expiration time of the stored document,
+# version and format of the document the data was read from or written to
+# and the key of the document of the spill collection with the data (False
+# if it isn't spilled).
+CacheEntry = namedtuple('CacheEntry', ['data', 'exp', 'version', 'format',
+                                       'spilled'])
+
+
+class SessionCache(object):
+    """Bounded in-process cache of sessions, keyed by SID.
+
+    Entries are evicted when the cache is full (least recently used first)
+    and when they are older than `ttl` seconds, which bounds how stale
+    a session read from the cache can be if other processes write it.
+
+    If `revalidate` is true, the session interface checks the version of
+    the stored document on every cache hit. This is still a round trip,
+    but session data isn't transferred and deserialized.
+    """
+
+    def __init__(self, max_size=1024, ttl=5, revalidate=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """Return a copy of the cached entry for `sid` or None."""
+        with self._lock:
+            item = self._entries.pop(sid, None)
+            if item is not None and time.time() - item[0] > self.ttl:
+                self.evictions += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries[sid] = item
+            self.hits += 1
+            entry = item[1]
+        # Views may mutate nested values without marking the session as
+        # modified, so they mustn't get the cached objects themselves.
+        return entry._replace(data=copy.deepcopy(entry.data))
+
+    def set(self, sid, entry):
+        with self._lock:
+            self._entries.pop(sid, None)
+            self._entries[sid] = (time.time(), entry)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update_exp(self, sid, exp):
+        """Update expiration time of the entry for `sid`, if it's cached."""
+        with self._lock:
+            item = self._entries.get(sid)
+            if item is not None:
+                self._entries[sid] = (item[0], item[1]._replace(exp=exp))
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+        }
+
+
+class MissingSessionCache(object):
+    """Bounded in-process set of SIDs recently found missing or expired.
+
+    Cookies with these SIDs get a new session without a database query
+    for `ttl` seconds. Keep `ttl` short: a session written by another
+    process in the meantime isn't seen by this one until it elapses.
+    """
+
+    def __init__(self, max_size=10000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self._sids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, sid):
+        with self._lock:
+            added = self._sids.get(sid)
+            if added is None:
+                return False
+            if time.time() - added > self.ttl:
+                del self._sids[sid]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, sid):
+        with self._lock:
+            self._sids.pop(sid, None)
+            self._sids[sid] = time.time()
+            while len(self._sids) > self.max_size:
+                self._sids.popitem(last=False)
+
+    def discard(self, sid):
+        with self._lock:
+            self._sids.pop(sid, None)
+
+    def clear(self):
+        with self._lock:
+            self._sids.clear()
+
+    def __len__(self):
+        return len(self._sids)
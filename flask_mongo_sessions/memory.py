@@ -0,0 +1,280 @@
+"""In-memory stand-in for PyMongo databases and collections.
+
+Only the subset of the collection API used by the session interface is
+implemented. It's meant for tests and benchmarks: every call is counted,
+so they can check how many storage round trips a request costs, a network
+round trip time can be simulated with `latency` and sizes of transferred
+documents can be measured.
+"""
+import copy
+import time
+from datetime import datetime
+
+from bson import BSON
+
+
+_databases = {}
+
+
+def get_database(name):
+    """Return a process-wide in-memory database with the given name."""
+    if name not in _databases:
+        _databases[name] = MemoryDatabase(name)
+    return _databases[name]
+
+
+def _to_bson(value):
+    """Copy a value the way a BSON round trip would.
+
+    Timezone-aware datetimes are stored as naive UTC ones.
+    """
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return (value - value.utcoffset()).replace(tzinfo=None)
+    if isinstance(value, dict):
+        return dict((k, _to_bson(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_bson(v) for v in value]
+    return copy.deepcopy(value)
+
+
+def _match_value(value, condition):
+    if isinstance(condition, dict) and condition and \
+            all(k.startswith('$') for k in condition):
+        for op, arg in condition.items():
+            if op == '$gt' and not (value is not None and value > arg):
+                return False
+            elif op == '$gte' and not (value is not None and value >= arg):
+                return False
+            elif op == '$lt' and not (value is not None and value < arg):
+                return False
+            elif op == '$lte' and not (value is not None and value <= arg):
+                return False
+            elif op == '$ne' and value == arg:
+                return False
+            elif op == '$in' and value not in arg:
+                return False
+            elif op == '$exists' and (value is not None) != bool(arg):
+                return False
+        return True
+    return value == condition
+
+
+def _get_path(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def matches(doc, spec):
+    for path, condition in spec.items():
+        if path == '$or':
+            if not any(matches(doc, alternative)
+                       for alternative in condition):
+                return False
+        elif not _match_value(_get_path(doc, path), condition):
+            return False
+    return True
+
+
+class MemoryCollection(object):
+    def __init__(self, name, latency=0, measure_bytes=False):
+        self.name = name
+        self.docs = []
+        self.indexes = []
+        self.calls = {}
+        # Seconds every call takes.
+        self.latency = latency
+        # If set, BSON sizes of written and read documents are summed up.
+        self.measure_bytes = measure_bytes
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.calls_with_options = []
+        # If set, every call raises it (e.g. AutoReconnect during an
+        # election).
+        self.error = None
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+
+    def _written(self, document):
+        if self.measure_bytes:
+            self.bytes_written += len(BSON.encode(document))
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        self.calls = {}
+        # Calls made with handles with options (method name, options).
+        self.calls_with_options = []
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def _find(self, spec):
+        spec = _to_bson(spec or {})
+        return [doc for doc in self.docs if matches(doc, spec)]
+
+    def find_one(self, spec=None, fields=None, *args, **kwargs):
+        self._count('find_one')
+        found = self._find(spec)
+        if not found:
+            return None
+        doc = copy.deepcopy(found[0])
+        if fields:
+            doc = dict((k, v) for k, v in doc.items()
+                       if k == '_id' or k in fields)
+        if self.measure_bytes:
+            self.bytes_read += len(BSON.encode(doc))
+        return doc
+
+    def find(self, spec=None, fields=None, *args, **kwargs):
+        self._count('find')
+        return MemoryCursor(self._find(spec), fields)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        self._count('update')
+        return self._update(spec, document, upsert, multi)
+
+    def _update(self, spec, document, upsert=False, multi=False):
+        self._written(document)
+        found = self._find(spec)
+        if not multi:
+            found = found[:1]
+        if not found and upsert:
+            doc = dict((k, _to_bson(v)) for k, v in spec.items()
+                       if not isinstance(v, (dict, list)))
+            if '_id' in doc and self._find({'_id': doc['_id']}):
+                from pymongo.errors import DuplicateKeyError
+                raise DuplicateKeyError('Duplicate _id %r' % (doc['_id'],))
+            self.docs.append(doc)
+            found = [doc]
+        for doc in found:
+            for path, value in document.get('$set', {}).items():
+                _set_path(doc, path, _to_bson(value))
+            for path in document.get('$unset', {}):
+                _unset_path(doc, path)
+            for path, value in document.get('$inc', {}).items():
+                _set_path(doc, path, (_get_path(doc, path) or 0) + value)
+        return {'n': len(found), 'updatedExisting': bool(found)}
+
+    def remove(self, spec=None, **kwargs):
+        self._count('remove')
+        return self._remove(spec)
+
+    def _remove(self, spec):
+        self._written(spec or {})
+        found = self._find(spec)
+        removed = set(id(doc) for doc in found)
+        self.docs = [doc for doc in self.docs if id(doc) not in removed]
+        return {'n': len(found)}
+
+    def bulk_write(self, requests, ordered=True):
+        # Requests are PyMongo's UpdateOne and DeleteOne objects.
+        self._count('bulk_write')
+        for request in requests:
+            if hasattr(request, '_doc'):
+                self._update(request._filter, request._doc, request._upsert)
+            else:
+                self._remove(request._filter)
+
+    def create_index(self, key, **kwargs):
+        self._count('create_index')
+        index = (key, kwargs)
+        if index not in self.indexes:
+            self.indexes.append(index)
+
+    def with_options(self, **options):
+        return MemoryCollectionHandle(self, options)
+
+
+class MemoryCursor(object):
+    def __init__(self, docs, fields=None):
+        self.docs = docs
+        self.fields = fields
+
+    def sort(self, key, direction=1):
+        self.docs = sorted(self.docs, key=lambda doc: _get_path(doc, key),
+                           reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def count(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        for doc in self.docs:
+            doc = copy.deepcopy(doc)
+            if self.fields:
+                doc = dict((k, v) for k, v in doc.items()
+                           if k == '_id' or k in self.fields)
+            yield doc
+
+
+class MemoryCollectionHandle(object):
+    """Handle of a MemoryCollection with options (write concern, read
+    preference), which are recorded with calls made with it."""
+
+    def __init__(self, collection, options):
+        self.collection = collection
+        self.options = options
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        def call(*args, **kwargs):
+            self.collection.calls_with_options.append((name, self.options))
+            return method(*args, **kwargs)
+        return call
+
+
+class MemoryDatabase(object):
+    def __init__(self, name, **options):
+        self.name = name
+        # Options of the collections (see MemoryCollection).
+        self.options = options
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name, **self.options)
+        return self._collections[name]
+
+    def drop(self):
+        # Collections are emptied in place, because the session interface
+        # may hold references to them.
+        for collection in self._collections.values():
+            collection.docs = []
+            collection.indexes = []
+            collection.reset_calls()
+            collection.error = None
@@ -0,0 +1,33 @@
+"""Merge policies for sessions changed by concurrent requests.
+
+With optimistic concurrency a session is written only if the stored
+document wasn't changed since the session was loaded. Otherwise the merge
+policy is called with the stored data (a dict) and the session, and
+returns the data to write. The session knows which keys were set
+(`set_keys`) and deleted (`deleted_keys`) during the request, and if it was
+marked as modified explicitly (`untracked_changes`), so these can't be
+trusted.
+"""
+
+
+def reapply_changes(stored, session):
+    """Apply keys set and deleted by the request to the stored data. If
+    changes weren't tracked, the session overwrites the stored data."""
+    if session.untracked_changes:
+        return dict(session)
+    data = dict(stored)
+    for key in session.set_keys:
+        data[key] = session[key]
+    for key in session.deleted_keys:
+        data.pop(key, None)
+    return data
+
+
+def overwrite(stored, session):
+    """The last writer wins."""
+    return dict(session)
+
+
+def keep_stored(stored, session):
+    """The first writer wins, changes of the request are discarded."""
+    return dict(stored)
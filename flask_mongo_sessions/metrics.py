@@ -0,0 +1,167 @@
+"""Instrumentation of session storage.
+
+A session interface given `metrics` reports what it does to it with two
+methods:
+
+- ``observe(name, value)`` for measured values: durations of storage
+  operations in seconds and payload sizes in bytes;
+- ``incr(name, count=1)`` for counted events: cache hits, saves by action.
+
+Any object with these methods can be used to send measurements to
+a monitoring system (statsd, Prometheus, etc). :class:`SessionMetrics`
+aggregates them in memory, with histograms of measured values.
+
+Reported names:
+
+- ``session.open``, ``session.save`` - time spent in the session
+  interface per request;
+- ``storage.find_one``, ``storage.find``, ``storage.update``,
+  ``storage.remove``, ``storage.bulk_write``, ``storage.count`` - duration
+  of each database round trip;
+- ``payload.size``, ``payload.stored_size`` - size of serialized session
+  data before and after compression;
+- ``payload.decode_time`` - time spent deserializing a session;
+- ``payload.spilled`` - sessions written to the spill collection;
+- ``save.write``, ``save.touch``, ``save.remove``, ``save.cookie``,
+  ``save.skipped`` - how sessions were saved; ``save.conflict`` - writes
+  which found the session changed concurrently; ``save.deferred`` - writes
+  deferred while the storage is unavailable;
+- ``session.lazy_loaded``, ``session.lazy_unused`` - lazy sessions which
+  were and weren't loaded by the request;
+- ``session.degraded`` - sessions served while the storage is
+  unavailable; ``breaker.open``, ``breaker.half-open``,
+  ``breaker.closed`` - changes of the state of the circuit breaker;
+- ``sid.rejected``, ``sid.missing`` - SIDs from cookies rejected without
+  a query and found missing in the cache of missing SIDs;
+- ``cache.hit``, ``cache.miss`` - lookups in the session cache;
+- ``sweep.removed``, ``sweep.time`` - sessions removed by sweeps and their
+  duration.
+"""
+from __future__ import with_statement
+
+import bisect
+import threading
+import time
+
+
+# Upper bounds of histogram buckets of durations (seconds) and of sizes
+# (bytes).
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536,
+                262144, 1048576, 4194304, 16777216)
+
+PERCENTILES = (50, 90, 99)
+
+
+def _percentile(stats, bounds, percent):
+    """Estimate a percentile as the upper bound of the bucket it falls in
+    (the maximum for the last one)."""
+    rank = stats['count'] * percent / 100.0
+    seen = 0
+    for bound, count in zip(bounds, stats['buckets']):
+        seen += count
+        if seen >= rank:
+            return min(bound, stats['max'])
+    return stats['max']
+
+
+class SessionMetrics(object):
+    """Thread-safe in-memory aggregation of session metrics.
+
+    Measured values are counted in histogram buckets: `size_buckets` for
+    sizes (names ending with ``size``), `time_buckets` for the rest.
+    """
+
+    def __init__(self, time_buckets=TIME_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.time_buckets = tuple(time_buckets)
+        self.size_buckets = tuple(size_buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def _bounds(self, name):
+        if name.endswith('size'):
+            return self.size_buckets
+        return self.time_buckets
+
+    def observe(self, name, value):
+        bounds = self._bounds(name)
+        bucket = bisect.bisect_left(bounds, value)
+        with self._lock:
+            stats = self._values.get(name)
+            if stats is None:
+                stats = self._values[name] = {
+                    'count': 1, 'sum': value, 'min': value, 'max': value,
+                    'buckets': [0] * (len(bounds) + 1)}
+            else:
+                stats['count'] += 1
+                stats['sum'] += value
+                stats['min'] = min(stats['min'], value)
+                stats['max'] = max(stats['max'], value)
+            stats['buckets'][bucket] += 1
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def snapshot(self):
+        """Return a dict of counters (numbers) and observed values by name.
+
+        Observed values are dicts with count, sum, min, max, mean, estimated
+        percentiles (p50, p90, p99) and buckets: a list of (upper bound,
+        cumulative count) tuples, the last bound is infinity.
+        """
+        with self._lock:
+            result = dict(self._counters)
+            for name, stats in self._values.items():
+                bounds = self._bounds(name) + (float('inf'),)
+                summary = dict(stats)
+                summary['mean'] = float(stats['sum']) / stats['count']
+                for percent in PERCENTILES:
+                    summary['p%d' % percent] = _percentile(stats, bounds,
+                                                           percent)
+                buckets = []
+                cumulative = 0
+                for bound, count in zip(bounds, stats['buckets']):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                summary['buckets'] = buckets
+                result[name] = summary
+        return result
+
+    def prometheus(self, prefix='flask_sessions'):
+        """Return the metrics in the Prometheus text format, to be served
+        for scraping: counters as ``<prefix>_<name>_total`` and histograms
+        of observed values (dots and dashes in names become
+        underscores)."""
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            metric = '%s_%s' % (prefix,
+                                name.replace('.', '_').replace('-', '_'))
+            if not isinstance(value, dict):
+                lines.append('# TYPE %s_total counter' % metric)
+                lines.append('%s_total %s' % (metric, value))
+                continue
+            lines.append('# TYPE %s histogram' % metric)
+            for bound, count in value['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{le="%s"} %d' % (metric, le, count))
+            lines.append('%s_sum %r' % (metric, value['sum']))
+            lines.append('%s_count %d' % (metric, value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._values = {}
+
+
+def timed(metrics, name, func, *args, **kwargs):
+    """Call `func` and report its duration to `metrics` (if not None)."""
+    if metrics is None:
+        return func(*args, **kwargs)
+    started = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.observe(name, time.time() - started)
@@ -0,0 +1,252 @@
+"""Re-encoding and moving of stored sessions.
+
+:class:`SessionMigrator` streams the sessions collection in batches ordered
+by `_id`, decodes every session with the format it was written in and
+encodes it with a new serializer (e.g. pickle to JSON, or with
+compression), writing batches back with unordered bulk writes. Sessions are
+written back only if they weren't changed in the meantime, and the session
+interface reads every registered format, so it's safe to run while the
+application serves requests. It can also copy sessions to another
+collection.
+
+A run can be limited to a range of `_id` (to run several processes in
+parallel, see :func:`id_ranges`) and resumed after the last `_id` it
+reached. From the command line::
+
+    python -m flask_mongo_sessions.migrate --to json --dry-run \\
+        mongodb://localhost/db sessions
+"""
+from __future__ import with_statement
+
+import logging
+import optparse
+import time
+from collections import namedtuple
+
+from flask_mongo_sessions import _is_field_name
+from flask_mongo_sessions import serializers
+from flask_mongo_sessions.metrics import timed
+
+
+logger = logging.getLogger(__name__)
+
+
+# Numbers of read sessions, re-encoded ones, ones left as they are (already
+# in the format, spilled or undecodable) and undecodable ones; stored size
+# of re-encoded sessions before and after, the last `_id` reached and
+# seconds the run took.
+MigrationResult = namedtuple('MigrationResult', [
+    'read', 'migrated', 'skipped', 'errors', 'size_before', 'size_after',
+    'last_id', 'elapsed'])
+
+
+def _stored_size(value):
+    if isinstance(value, bytes):
+        return len(value)
+    from bson import BSON
+    return len(BSON.encode(value))
+
+
+def id_ranges(collection, parts):
+    """Split the collection into `parts` ranges of `_id` with about the same
+    number of sessions. Returns a list of (start_after, end) tuples for
+    :meth:`SessionMigrator.run`."""
+    count = collection.find({}, {'_id': True}).count()
+    bounds = []
+    for part in range(1, parts):
+        docs = list(collection.find({}, {'_id': True}).sort('_id', 1)
+                    .skip(count * part // parts).limit(1))
+        if docs and (not bounds or docs[0]['_id'] > bounds[-1]):
+            bounds.append(docs[0]['_id'])
+    starts = [None] + bounds
+    return list(zip(starts, bounds + [None]))
+
+
+class SessionMigrator(object):
+    """Re-encoder of sessions in `collection` with `serializer` (and
+    compression of data longer than `compress_threshold` bytes).
+
+    Sessions are read and written `batch_size` at a time, at most
+    `max_rate` per second on average if it's set. If `target` (another
+    collection) is given, all sessions are copied there, re-encoded or not.
+    With `dry_run` nothing is written, only sizes are measured.
+
+    Sessions stored in the spill collection are skipped.
+    """
+
+    def __init__(self, collection, serializer, compress_threshold=None,
+                 target=None, batch_size=500, max_rate=None, dry_run=False,
+                 metrics=None):
+        self.collection = collection
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold
+        self.target = target
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.dry_run = dry_run
+        self._metrics = metrics
+
+    def run(self, start_after=None, end=None, progress=None):
+        """Migrate sessions with `_id` greater than `start_after` and up to
+        `end` (inclusive), None means no limit. `progress` is called with
+        the last `_id` after every batch, e.g. to save it for resuming.
+        Returns a MigrationResult."""
+        started = time.time()
+        totals = dict.fromkeys(MigrationResult._fields, 0)
+        totals['last_id'] = start_after
+        while True:
+            spec = {}
+            if totals['last_id'] is not None:
+                spec['$gt'] = totals['last_id']
+            if end is not None:
+                spec['$lte'] = end
+            cursor = self.collection.find({'_id': spec} if spec else {})
+            batch = list(cursor.sort('_id', 1).limit(self.batch_size))
+            if not batch:
+                break
+            batch_started = time.time()
+            self._migrate_batch(batch, totals)
+            totals['last_id'] = batch[-1]['_id']
+            if progress is not None:
+                progress(totals['last_id'])
+            if len(batch) < self.batch_size:
+                break
+            if self.max_rate:
+                pause = float(len(batch)) / self.max_rate - \
+                    (time.time() - batch_started)
+                if pause > 0:
+                    time.sleep(pause)
+        totals['elapsed'] = time.time() - started
+        result = MigrationResult(**totals)
+        logger.info('Read %d sessions, re-encoded %d, skipped %d, '
+                    '%d errors; %d bytes before, %d after', *result[:6])
+        return result
+
+    def _migrate_batch(self, batch, totals):
+        from pymongo import UpdateOne
+
+        requests = []
+        for doc in batch:
+            totals['read'] += 1
+            update = self._reencoded(doc, totals)
+            if update is None:
+                totals['skipped'] += 1
+            else:
+                totals['migrated'] += 1
+            if self.target is not None:
+                fields = dict(doc, **(update or {}))
+                del fields['_id']
+                requests.append(UpdateOne({'_id': doc['_id']},
+                                          {'$set': fields}, upsert=True))
+            elif update is not None:
+                # The session is written back only if it wasn't written in
+                # the meantime, the version is bumped by every write.
+                spec = {'_id': doc['_id'],
+                        'v': doc.get('v') or {'$exists': False}}
+                requests.append(UpdateOne(spec, {'$set': update}))
+        if requests and not self.dry_run:
+            collection = self.target
+            if collection is None:
+                collection = self.collection
+            timed(self._metrics, 'storage.bulk_write',
+                  collection.bulk_write, requests, ordered=False)
+
+    def _reencoded(self, doc, totals):
+        """Return the fields of the re-encoded session or None if it doesn't
+        need to be (or can't be) re-encoded."""
+        if doc.get('spill') or 'd' not in doc:
+            return None
+        try:
+            data = serializers.decode(doc.get('f'), doc['d'])
+        except Exception as e:
+            totals['errors'] += 1
+            logger.warning('Session %s can not be decoded: %s',
+                           doc['_id'], e)
+            return None
+        payload = serializers.encode(data, self.serializer,
+                                     self.compress_threshold)
+        if payload.format == (doc.get('f') or 'pickle'):
+            return None
+        if isinstance(payload.value, dict) and \
+                not all(_is_field_name(key) for key in payload.value):
+            totals['errors'] += 1
+            logger.warning('Session %s has keys which can not be stored '
+                           'as BSON', doc['_id'])
+            return None
+        totals['size_before'] += _stored_size(doc['d'])
+        totals['size_after'] += _stored_size(payload.value)
+        return {'d': payload.value, 'f': payload.format}
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='python -m flask_mongo_sessions.migrate URI COLLECTION')
+    parser.add_option('--to', default='pickle',
+                      help='format to re-encode sessions to: ' +
+                      ', '.join(sorted(serializers.serializers)))
+    parser.add_option('--compress-threshold', type='int',
+                      help='compress data longer than this many bytes')
+    parser.add_option('--target', metavar='COLLECTION',
+                      help='copy sessions to this collection')
+    parser.add_option('--batch-size', type='int', default=500,
+                      help='sessions read and written at a time')
+    parser.add_option('--max-rate', type='float',
+                      help='sessions migrated per second at most')
+    parser.add_option('--dry-run', action='store_true',
+                      help="don't write, only report sizes")
+    parser.add_option('--start-after', metavar='ID',
+                      help='resume after this _id')
+    parser.add_option('--end', metavar='ID',
+                      help='stop at this _id (inclusive)')
+    parser.add_option('--parts', type='int', default=1,
+                      help='split the collection into this many ranges')
+    parser.add_option('--part', type='int', default=0,
+                      help='number of the range to migrate, from 0')
+    parser.add_option('--state-file',
+                      help='file with the last _id, to resume from')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('URI of the database and collection name are needed')
+    if options.to not in serializers.serializers:
+        parser.error('Unknown format %r' % options.to)
+
+    from pymongo import MongoClient
+
+    logging.basicConfig(level=logging.INFO)
+    uri, collection_name = args
+    db = MongoClient(uri).get_default_database()
+    target = None
+    if options.target:
+        target = db[options.target]
+    migrator = SessionMigrator(
+        db[collection_name], serializers.serializers[options.to],
+        options.compress_threshold, target, options.batch_size,
+        options.max_rate, options.dry_run)
+
+    start_after, end = options.start_after, options.end
+    if options.parts > 1:
+        start_after, end = id_ranges(db[collection_name],
+                                     options.parts)[options.part]
+
+    def save_progress(last_id):
+        with open(options.state_file, 'w') as f:
+            f.write(str(last_id))
+
+    progress = None
+    if options.state_file:
+        try:
+            with open(options.state_file) as f:
+                start_after = f.read().strip() or start_after
+        except IOError:
+            pass
+        progress = save_progress
+    result = migrator.run(start_after, end, progress)
+    print('Read %d sessions, re-encoded %d, skipped %d, %d errors' %
+          result[:4])
+    print('Stored size of re-encoded sessions: %d bytes before, %d after' %
+          result[4:6])
+    print('Last _id: %s, %.1f s' % result[6:])
+
+
+if __name__ == '__main__':
+    main()
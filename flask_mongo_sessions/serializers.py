@@ -0,0 +1,266 @@
+"""Serializers of session data.
+
+A serializer turns the session dict into a value stored in the `d` field of
+the session document and back. Every serializer has a format name which is
+stored along with the data (the `f` field), so documents written with any
+registered serializer can be read whatever serializer is used for writing.
+Documents without the format field were written by older versions of the
+extension and are pickled.
+
+With :class:`KeyedSerializer` every top-level key is serialized separately,
+values are decoded on the first access and unchanged ones are stored again
+as they were read.
+"""
+import base64
+import json
+import struct
+import uuid
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from bson.binary import Binary
+
+try:
+    from markupsafe import Markup
+except ImportError:
+    Markup = None
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+COMPRESSED_SUFFIX = '+zlib'
+
+
+# Encoded session data: the format name, the value to store and the size
+# of serialized data before compression (None for subdocuments).
+Payload = namedtuple('Payload', ['format', 'value', 'size'])
+
+
+# A value of the keyed format which wasn't decoded yet: the format of the
+# serializer it was written with and the serialized value.
+class EncodedValue(namedtuple('EncodedValue', ['format', 'value'])):
+    __slots__ = ()
+
+    def decode(self):
+        return serializers[self.format].loads(self.value)
+
+
+class FormatError(ValueError):
+    """Stored session data has unknown or not accepted format."""
+
+
+class PickleSerializer(object):
+    """Pickle with the highest protocol available.
+
+    Unpickling data is unsafe if the collection can be written by anybody
+    else than the application.
+    """
+    format = 'pickle'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, data):
+        return pickle.dumps(data, self.protocol)
+
+    def loads(self, value):
+        return pickle.loads(bytes(value))
+
+
+class JSONSerializer(object):
+    """JSON with tags for types JSON doesn't support.
+
+    Tuples, bytes, datetimes, UUIDs and Markup strings are supported
+    besides JSON types, the same way as Flask's TaggedJSONSerializer
+    does it for cookie sessions. Timezone-aware datetimes are converted
+    to naive ones in UTC.
+    """
+    format = 'json'
+
+    def _tag(self, value):
+        if isinstance(value, tuple):
+            return {' t': [self._tag(x) for x in value]}
+        elif isinstance(value, uuid.UUID):
+            return {' u': value.hex}
+        elif callable(getattr(value, '__html__', None)):
+            return {' m': text_type(value.__html__())}
+        elif isinstance(value, text_type):
+            return value
+        elif isinstance(value, bytes):
+            if bytes is str:
+                # Byte strings of Python 2 are stored as text if possible.
+                try:
+                    return value.decode('utf-8')
+                except UnicodeError:
+                    pass
+            return {' b': base64.b64encode(value).decode('ascii')}
+        elif isinstance(value, list):
+            return [self._tag(x) for x in value]
+        elif isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = (value - value.utcoffset()).replace(tzinfo=None)
+            return {' d': value.isoformat()}
+        elif isinstance(value, dict):
+            return dict((k, self._tag(v)) for k, v in value.items())
+        return value
+
+    def _untag(self, obj):
+        if len(obj) != 1:
+            return obj
+        key, value = next(iter(obj.items()))
+        if key == ' t':
+            return tuple(value)
+        elif key == ' u':
+            return uuid.UUID(value)
+        elif key == ' b':
+            return base64.b64decode(value)
+        elif key == ' m' and Markup is not None:
+            return Markup(value)
+        elif key == ' d':
+            fmt = '%Y-%m-%dT%H:%M:%S'
+            if '.' in value:
+                fmt += '.%f'
+            return datetime.strptime(value, fmt)
+        return obj
+
+    def dumps(self, data):
+        return json.dumps(self._tag(data), separators=(',', ':')) \
+            .encode('utf-8')
+
+    def loads(self, value):
+        return json.loads(bytes(value).decode('utf-8'),
+                          object_hook=self._untag)
+
+
+class BSONSerializer(object):
+    """Session data is stored as a native BSON subdocument.
+
+    Keys must be strings without dots and not starting with '$', values
+    must be BSON-serializable. Data isn't compressed in this format.
+    """
+    format = 'bson'
+
+    def dumps(self, data):
+        return dict(data)
+
+    def loads(self, value):
+        return dict(value)
+
+
+class KeyedSerializer(object):
+    """Every top-level key and value is serialized separately with
+    `serializer` (pickle by default).
+
+    Stored data is split into keys and still encoded values
+    (:class:`EncodedValue`), so a request pays only for deserializing the
+    values it reads. Values which are passed in encoded are stored as they
+    are.
+    """
+    keyed = True
+    _length = struct.Struct('>I')
+
+    def __init__(self, serializer=None):
+        self.serializer = serializer or PickleSerializer()
+        self.format = 'keyed-' + self.serializer.format
+
+    def dumps(self, data):
+        chunks = []
+        for key, value in data.items():
+            if isinstance(value, EncodedValue) and \
+                    value.format == self.serializer.format:
+                value = value.value
+            else:
+                value = self.serializer.dumps(decoded_value(value))
+            key = self.serializer.dumps(key)
+            chunks.extend([self._length.pack(len(key)), key,
+                           self._length.pack(len(value)), bytes(value)])
+        return b''.join(chunks)
+
+    def loads(self, value):
+        value = bytes(value)
+        data = {}
+        size = self._length.size
+        position = 0
+        while position < len(value):
+            chunks = []
+            for _ in range(2):
+                length = self._length.unpack_from(value, position)[0]
+                position += size
+                chunks.append(value[position:position + length])
+                position += length
+            key = self.serializer.loads(chunks[0])
+            data[key] = EncodedValue(self.serializer.format, chunks[1])
+        return data
+
+
+def decoded_value(value):
+    """Decode the value if it's an EncodedValue."""
+    if isinstance(value, EncodedValue):
+        return value.decode()
+    return value
+
+
+def decoded(data):
+    """Return a copy of session data (a dict) with all values decoded."""
+    return dict((key, decoded_value(value))
+                for key, value in dict.items(data))
+
+
+serializers = {}
+
+
+def register_serializer(serializer):
+    """Register a serializer, so data stored in its format can be read."""
+    serializers[serializer.format] = serializer
+
+
+for _serializer in [PickleSerializer(), JSONSerializer(), BSONSerializer(),
+                    KeyedSerializer(), KeyedSerializer(JSONSerializer())]:
+    register_serializer(_serializer)
+
+
+def encode(data, serializer, compress_threshold=None):
+    """Serialize session data.
+
+    The data is compressed with zlib if it's serialized to more than
+    `compress_threshold` bytes. Returns a Payload.
+    """
+    if not getattr(serializer, 'keyed', False) and \
+            any(isinstance(value, EncodedValue) for value in data.values()):
+        data = decoded(data)
+    value = serializer.dumps(data)
+    fmt = serializer.format
+    size = None
+    if isinstance(value, bytes):
+        size = len(value)
+        if compress_threshold is not None and size > compress_threshold:
+            value = zlib.compress(value)
+            fmt += COMPRESSED_SUFFIX
+        value = Binary(value)
+    return Payload(fmt, value, size)
+
+
+def decode(fmt, value, accept=None):
+    """Deserialize stored session data.
+
+    `fmt` is the stored format name, None for documents written by older
+    versions. If `accept` is given, only formats listed in it are decoded.
+    """
+    fmt = fmt or PickleSerializer.format
+    compressed = fmt.endswith(COMPRESSED_SUFFIX)
+    if compressed:
+        fmt = fmt[:-len(COMPRESSED_SUFFIX)]
+    if fmt not in serializers or (accept is not None and fmt not in accept):
+        raise FormatError('Session format %r is not accepted' % fmt)
+    if compressed:
+        value = zlib.decompress(bytes(value))
+    return serializers[fmt].loads(value)
@@ -0,0 +1,298 @@
+"""Session cache shared by processes of one host.
+
+With a prefork server (e.g. gunicorn with several workers) consecutive
+requests of a user land on different processes, so a per-process
+:class:`~flask_mongo_sessions.cache.SessionCache` rarely hits.
+:class:`SharedSessionCache` keeps sessions in a memory-mapped file, which
+all processes on the host map.
+
+The file is a fixed-size hash table: `slots` slots of `slot_size` bytes,
+grouped in buckets of `ways` slots. A session is stored in a slot of the
+bucket its SID hashes to, replacing the oldest entry of the bucket if it's
+full, so memory is bounded by the size of the file. Sessions which don't fit
+in a slot aren't cached. A file made with another layout isn't reused.
+
+Writers lock a stripe of buckets (with ``fcntl`` byte-range locks between
+processes and thread locks within one). Readers don't lock: each slot has
+a sequence number, which is odd while the slot is written, and a read is
+retried if the number changed while the slot was copied.
+"""
+from __future__ import with_statement
+
+import calendar
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flask_mongo_sessions.cache import CacheEntry
+
+
+# Magic, number of slots and slot size. The layout of the file is checked
+# against it when the file is opened.
+_HEADER = struct.Struct('<8sII')
+_MAGIC = b'FMSCACHE'
+# Sequence number, SID length, SID, time of caching, expiration time,
+# version, spilled flag and length of the pickled data, format and key of
+# the spill document.
+_SLOT = struct.Struct('<IB64sddqBI')
+_SEQ = struct.Struct('<I')
+_MAX_SID = 64
+_READ_RETRIES = 8
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+class SharedSessionCache(object):
+    """Session cache in a memory-mapped file at `path`, shared by all
+    processes which open the same file (POSIX only).
+
+    `ttl` and `revalidate` have the same meaning as for
+    :class:`~flask_mongo_sessions.cache.SessionCache`. Counters (``hits``,
+    ``misses``, ``evictions``) are kept per process.
+    """
+
+    def __init__(self, path, slots=16384, slot_size=4096, ways=4,
+                 stripes=64, ttl=5, revalidate=False):
+        if fcntl is None:
+            raise RuntimeError('SharedSessionCache needs fcntl (POSIX)')
+        if slot_size <= _SLOT.size:
+            raise ValueError('slot_size must be larger than %d' % _SLOT.size)
+        self.path = path
+        self.ways = ways
+        self.buckets = max(slots // ways, 1)
+        self.slots = self.buckets * ways
+        self.slot_size = slot_size
+        self.stripes = stripes
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._size = _HEADER.size + self.slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._init_file()
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._map = mmap.mmap(self._fd, self._size)
+
+    def _init_file(self):
+        # Byte 0 is locked while the file is initialized, bytes from 1
+        # are stripe locks. The locks are advisory, they don't overlap
+        # anything but other locks.
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            header = os.read(self._fd, _HEADER.size)
+            if header:
+                # Other processes may have the file mapped, so it can't be
+                # truncated (they would get SIGBUS), another layout needs
+                # another file.
+                if len(header) != _HEADER.size or \
+                        _HEADER.unpack(header) != \
+                        (_MAGIC, self.slots, self.slot_size):
+                    raise ValueError(
+                        '%s was made with another layout or is not a session '
+                        'cache' % self.path)
+            else:
+                os.ftruncate(self._fd, self._size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, _HEADER.pack(_MAGIC, self.slots,
+                                                self.slot_size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _key(self, sid):
+        if not isinstance(sid, bytes):
+            sid = sid.encode('utf-8')
+        return sid
+
+    def _bucket(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % self.buckets
+
+    def _offsets(self, bucket):
+        start = _HEADER.size + bucket * self.ways * self.slot_size
+        return range(start, start + self.ways * self.slot_size,
+                     self.slot_size)
+
+    def _read_slot(self, offset):
+        """Return a consistent copy of the slot and its unpacked header,
+        or None if it's being written."""
+        for _ in range(_READ_RETRIES):
+            seq = _SEQ.unpack_from(self._map, offset)[0]
+            if seq % 2:
+                continue
+            data = self._map[offset:offset + self.slot_size]
+            if _SEQ.unpack_from(self._map, offset)[0] == seq:
+                return data, _SLOT.unpack_from(data)
+        return None
+
+    def _find(self, key, bucket):
+        for offset in self._offsets(bucket):
+            length, stored_key = _SLOT.unpack_from(self._map, offset)[1:3]
+            if length == len(key) and stored_key[:length] == key:
+                return offset
+        return None
+
+    def _lock(self, bucket):
+        stripe = bucket % self.stripes
+        self._locks[stripe].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe + 1)
+        except Exception:
+            self._locks[stripe].release()
+            raise
+        return stripe
+
+    def _unlock(self, stripe):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe + 1)
+        self._locks[stripe].release()
+
+    def _write(self, offset, values, blob=b''):
+        # The sequence number is odd while the slot is written.
+        seq = _SEQ.unpack_from(self._map, offset)[0]
+        _SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+        _SLOT.pack_into(self._map, offset, (seq + 1) & 0xffffffff, *values)
+        if blob:
+            start = offset + _SLOT.size
+            self._map[start:start + len(blob)] = blob
+        _SEQ.pack_into(self._map, offset, (seq + 2) & 0xffffffff)
+
+    def get(self, sid):
+        """Return the cached entry for `sid` or None."""
+        key = self._key(sid)
+        if len(key) > _MAX_SID:
+            self.misses += 1
+            return None
+        for offset in self._offsets(self._bucket(key)):
+            slot = self._read_slot(offset)
+            if slot is None:
+                continue
+            data, (_, length, stored_key, cached, exp, version, spilled,
+                   blob_size) = slot
+            if length != len(key) or stored_key[:length] != key:
+                continue
+            if time.time() - cached > self.ttl:
+                self.evictions += 1
+                break
+            start = _SLOT.size
+            session_data, fmt, spilled = pickle.loads(
+                data[start:start + blob_size])
+            self.hits += 1
+            return CacheEntry(session_data, datetime.utcfromtimestamp(exp),
+                              version, fmt, spilled)
+        self.misses += 1
+        return None
+
+    def set(self, sid, entry):
+        key = self._key(sid)
+        if len(key) > _MAX_SID:
+            return
+        # The key of the spill document is pickled with the data.
+        blob = pickle.dumps((entry.data, entry.format, entry.spilled),
+                            pickle.HIGHEST_PROTOCOL)
+        if _SLOT.size + len(blob) > self.slot_size:
+            # Too large to cache, the stale entry mustn't be served.
+            self.delete(sid)
+            return
+        bucket = self._bucket(key)
+        stripe = self._lock(bucket)
+        try:
+            offset = self._find(key, bucket)
+            if offset is None:
+                offset = self._victim(bucket)
+            self._write(offset, (len(key), key, time.time(),
+                                 _timestamp(entry.exp), entry.version,
+                                 bool(entry.spilled), len(blob)), blob)
+        finally:
+            self._unlock(stripe)
+
+    def _victim(self, bucket):
+        """Return the offset of an empty slot of the bucket or of the one
+        cached the longest time ago."""
+        oldest = None
+        for offset in self._offsets(bucket):
+            length, _, cached = _SLOT.unpack_from(self._map, offset)[1:4]
+            if not length:
+                return offset
+            if oldest is None or cached < oldest[0]:
+                oldest = (cached, offset)
+        self.evictions += 1
+        return oldest[1]
+
+    def update_exp(self, sid, exp):
+        """Update expiration time of the entry for `sid`, if it's cached."""
+        key = self._key(sid)
+        if len(key) > _MAX_SID:
+            return
+        bucket = self._bucket(key)
+        stripe = self._lock(bucket)
+        try:
+            offset = self._find(key, bucket)
+            if offset is not None:
+                values = list(_SLOT.unpack_from(self._map, offset)[1:])
+                values[3] = _timestamp(exp)
+                self._write(offset, values)
+        finally:
+            self._unlock(stripe)
+
+    def delete(self, sid):
+        key = self._key(sid)
+        if len(key) > _MAX_SID:
+            return
+        bucket = self._bucket(key)
+        stripe = self._lock(bucket)
+        try:
+            offset = self._find(key, bucket)
+            if offset is not None:
+                self._write(offset, (0, b'', 0, 0, 0, False, 0))
+        finally:
+            self._unlock(stripe)
+
+    def clear(self):
+        for bucket in range(self.buckets):
+            stripe = self._lock(bucket)
+            try:
+                for offset in self._offsets(bucket):
+                    if _SLOT.unpack_from(self._map, offset)[1]:
+                        self._write(offset, (0, b'', 0, 0, 0, False, 0))
+            finally:
+                self._unlock(stripe)
+
+    def __len__(self):
+        count = 0
+        for bucket in range(self.buckets):
+            for offset in self._offsets(bucket):
+                if _SLOT.unpack_from(self._map, offset)[1]:
+                    count += 1
+        return count
+
+    def stats(self):
+        """Return the cache counters of this process as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self),
+        }
@@ -0,0 +1,95 @@
+"""Strategies of making session IDs.
+
+A strategy makes new SIDs (``generate``) and checks if a SID from a cookie
+could have been made by it (``is_valid``), so malformed ones never reach
+the database. SIDs of built-in strategies are lowercase hex strings with at
+least 122 random bits (with default arguments).
+
+- :class:`RandomSIDs` (the default): random UUIDs. New sessions are
+  inserted all over the `_id` index.
+- :class:`TimeOrderedSIDs`: a timestamp followed by random bits, like
+  ObjectIds and ULIDs. New sessions are appended to the right edge of the
+  index, so only its recent part needs to be in memory.
+- :class:`HashedPrefixSIDs`: time-ordered SIDs after a short prefix derived
+  from them, for collections sharded by ranges of `_id`. Inserts are spread
+  over as many ranges as there are prefixes, and are time-ordered within
+  each one.
+
+When several applications share a collection, documents are keyed by
+``namespace:sid`` (see :func:`namespaced`).
+"""
+import binascii
+import hashlib
+import os
+import re
+import time
+import uuid
+
+
+NAMESPACE_SEPARATOR = ':'
+
+
+def namespaced(namespace, sid):
+    """Return the key of the document of the session in the namespace."""
+    return namespace + NAMESPACE_SEPARATOR + sid
+
+
+def namespace_range(namespace):
+    """Return the condition on `_id` matching keys in the namespace."""
+    # The separator is followed by ';' in ASCII.
+    return {'$gt': namespace + NAMESPACE_SEPARATOR,
+            '$lt': namespace + chr(ord(NAMESPACE_SEPARATOR) + 1)}
+
+
+class RandomSIDs(object):
+    """Random UUIDs as 32 hex digits."""
+    pattern = re.compile(r'^[0-9a-f]{32}\Z')
+
+    def generate(self):
+        return uuid.uuid4().hex
+
+    def is_valid(self, sid):
+        return bool(self.pattern.match(sid))
+
+
+class TimeOrderedSIDs(object):
+    """Milliseconds since the epoch (12 hex digits) followed by `random_bytes`
+    random bytes (16 by default, 32 hex digits)."""
+
+    def __init__(self, random_bytes=16):
+        self.random_bytes = random_bytes
+        self.pattern = re.compile(r'^[0-9a-f]{%d}\Z' %
+                                  (12 + 2 * random_bytes))
+
+    def generate(self):
+        random_part = binascii.hexlify(os.urandom(self.random_bytes))
+        return '%012x%s' % (int(time.time() * 1000),
+                            random_part.decode('ascii'))
+
+    def is_valid(self, sid):
+        return bool(self.pattern.match(sid))
+
+
+class HashedPrefixSIDs(TimeOrderedSIDs):
+    """Time-ordered SIDs prefixed with `prefix_length` hex digits of their
+    hash (2 by default, 256 ranges). The prefix is checked on validation,
+    so most made up SIDs are rejected without a query."""
+
+    def __init__(self, prefix_length=2, random_bytes=16):
+        TimeOrderedSIDs.__init__(self, random_bytes)
+        self.prefix_length = prefix_length
+        self.pattern = re.compile(r'^[0-9a-f]{%d}\Z' %
+                                  (prefix_length + 12 + 2 * random_bytes))
+
+    def _prefix(self, sid):
+        return hashlib.sha1(sid.encode('ascii')).hexdigest()[
+            :self.prefix_length]
+
+    def generate(self):
+        sid = TimeOrderedSIDs.generate(self)
+        return self._prefix(sid) + sid
+
+    def is_valid(self, sid):
+        return bool(self.pattern.match(sid)) and \
+            sid[:self.prefix_length] == self._prefix(
+                sid[self.prefix_length:])
@@ -0,0 +1,281 @@
+"""Removal of expired sessions without a TTL index.
+
+Expired sessions are never returned, but without a TTL index they stay in
+the collection. :class:`Sweeper` removes them in small batches, with
+pauses between batches, so cleanup doesn't load the primary with one huge
+delete. It can run on a background thread of the application or from the
+command line::
+
+    python -m flask_mongo_sessions.sweeper mongodb://localhost/db sessions
+
+Background threads of all processes (on all hosts) coordinate through
+a lease document, so only one of them sweeps at a time and `max_rate`
+limits the total rate.
+"""
+from __future__ import with_statement
+
+import logging
+import optparse
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from datetime import timedelta
+
+from flask_mongo_sessions.metrics import timed
+from flask_mongo_sessions.sids import namespace_range
+
+
+logger = logging.getLogger(__name__)
+
+
+# Number of removed sessions, number of batches and seconds a sweep took.
+SweepResult = namedtuple('SweepResult', ['removed', 'batches', 'elapsed'])
+
+
+class Sweeper(object):
+    """Remover of expired sessions.
+
+    Expired sessions are found in the order of expiration time (with an
+    index on it, see :meth:`ensure_index`) and removed `batch_size` at
+    a time. If `max_rate` is set, at most this many sessions are removed per
+    second on average. Pauses are randomized by `jitter` (a fraction of
+    them), so several sweepers don't run in lockstep.
+
+    On a background thread (:meth:`start`) a sweep is done every `interval`
+    seconds, by the process which holds the lease (if a lease collection is
+    bound). The holder renews it before every batch; if it dies, another
+    process takes over after `lease_timeout` seconds (twice the interval by
+    default).
+    """
+
+    lease_id = 'sweeper'
+
+    def __init__(self, batch_size=1000, max_rate=None, interval=60,
+                 jitter=0.2, lease_timeout=None):
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.interval = interval
+        self.jitter = jitter
+        self.lease_timeout = lease_timeout or 2 * interval
+        self.removed = 0
+        self.errors = 0
+        self._get_collection = None
+        self._get_spill_collection = None
+        self._get_lease_collection = None
+        # Identity of the process in the lease, made again after fork.
+        self._owner = self._make_owner()
+        # Set while the background thread sweeps under the lease.
+        self._leased = False
+        self._metrics = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def bind(self, get_collection, metrics=None, get_spill_collection=None,
+             get_lease_collection=None):
+        """Set a callable which returns the collection to sweep, optional
+        metrics which sweeps are reported to, a callable which returns
+        the spill collection of large sessions and one which returns the
+        collection of the lease."""
+        self._get_collection = get_collection
+        self._metrics = metrics
+        self._get_spill_collection = get_spill_collection
+        self._get_lease_collection = get_lease_collection
+
+    def _make_owner(self):
+        return '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                             uuid.uuid4().hex[:8])
+
+    def _acquire_lease(self):
+        """Take or renew the lease. Returns False if another process holds
+        it."""
+        if self._get_lease_collection is None:
+            return True
+        from pymongo.errors import DuplicateKeyError
+
+        now = datetime.utcnow()
+        spec = {'_id': self.lease_id,
+                '$or': [{'owner': self._owner}, {'until': {'$lt': now}}]}
+        until = now + timedelta(seconds=self.lease_timeout)
+        try:
+            # If another process holds the lease, the upsert conflicts with
+            # its document.
+            self._get_lease_collection().update(
+                spec, {'$set': {'owner': self._owner, 'until': until}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def _release_lease(self):
+        if self._get_lease_collection is not None:
+            self._get_lease_collection().remove({'_id': self.lease_id,
+                                                 'owner': self._owner})
+
+    def _collections(self):
+        collections = [self._get_collection()]
+        if self._get_spill_collection is not None:
+            collections.append(self._get_spill_collection())
+        return collections
+
+    def ensure_index(self):
+        """Ensure the index on expiration time sweeps use. Not needed if
+        there is a TTL index on it."""
+        for collection in self._collections():
+            collection.create_index('exp')
+
+    def sweep(self, now=None, namespace=None):
+        """Remove sessions expired before `now` (the current time by
+        default), only of applications in `namespace` if it's given.
+        Returns a SweepResult."""
+        started = time.time()
+        now = now or datetime.utcnow()
+        spec = {'exp': {'$lt': now}}
+        if namespace is not None:
+            spec['_id'] = namespace_range(namespace)
+        removed = batches = 0
+        for collection in self._collections():
+            count, collection_batches = self._sweep_collection(collection,
+                                                               spec)
+            removed += count
+            batches += collection_batches
+        result = SweepResult(removed, batches, time.time() - started)
+        self.removed += removed
+        if self._metrics is not None:
+            self._metrics.incr('sweep.removed', removed)
+            self._metrics.observe('sweep.time', result.elapsed)
+        logger.info('Removed %d expired sessions in %d batches, %.3f s',
+                    *result)
+        return result
+
+    def _sweep_collection(self, collection, spec):
+        removed = batches = 0
+        while not self._stopped.is_set():
+            if self._leased and batches and not self._acquire_lease():
+                logger.info('Sweeper lease is lost, sweep is interrupted')
+                break
+            cursor = collection.find(spec, {'_id': True})
+            sids = [doc['_id']
+                    for doc in cursor.sort('exp', 1).limit(self.batch_size)]
+            if not sids:
+                break
+            # Sessions refreshed since they were found are kept.
+            result = timed(self._metrics, 'storage.remove', collection.remove,
+                           dict(spec, _id={'$in': sids}))
+            count = len(sids)
+            if isinstance(result, dict):
+                count = result.get('n', count)
+            removed += count
+            batches += 1
+            if len(sids) < self.batch_size:
+                break
+            if self.max_rate:
+                self._pause(float(len(sids)) / self.max_rate)
+        return removed, batches
+
+    def start(self):
+        """Start sweeping on a background thread, if it isn't started in
+        this process yet."""
+        if self._is_running():
+            return
+        with self._lock:
+            if self._is_running():
+                return
+            self._stopped.clear()
+            self._pid = os.getpid()
+            self._owner = self._make_owner()
+            self._thread = threading.Thread(target=self._run,
+                                            name='session-sweeper')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, interrupting a sweep, and release
+        the lease."""
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+            try:
+                self._release_lease()
+            except Exception:
+                logger.exception('Releasing the sweeper lease failed')
+
+    def _is_running(self):
+        # The thread doesn't survive fork(), a child starts its own.
+        return self._pid == os.getpid() and self._thread is not None and \
+            self._thread.is_alive()
+
+    def _pause(self, seconds):
+        seconds *= 1 + random.uniform(-self.jitter, self.jitter)
+        self._stopped.wait(seconds)
+
+    def _run(self):
+        from pymongo.errors import PyMongoError
+
+        while True:
+            self._pause(self.interval)
+            if self._stopped.is_set():
+                return
+            try:
+                if self._acquire_lease():
+                    self._leased = True
+                    try:
+                        self.sweep()
+                    finally:
+                        self._leased = False
+            except PyMongoError:
+                self.errors += 1
+                logger.exception('Sweeping expired sessions failed')
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='python -m flask_mongo_sessions.sweeper URI COLLECTION')
+    parser.add_option('--batch-size', type='int', default=1000,
+                      help='sessions removed at a time')
+    parser.add_option('--max-rate', type='float',
+                      help='sessions removed per second at most')
+    parser.add_option('--jitter', type='float', default=0.2,
+                      help='randomization of pauses, a fraction of them')
+    parser.add_option('--ensure-index', action='store_true',
+                      help='create the indexes on expiration time')
+    parser.add_option('--lease', action='store_true',
+                      help="don't sweep while an application sweeper "
+                      "holds the lease")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('URI of the database and collection name are needed')
+
+    from pymongo import MongoClient
+
+    uri, collection_name = args
+    db = MongoClient(uri).get_default_database()
+    collection = db[collection_name]
+    sweeper = Sweeper(options.batch_size, options.max_rate,
+                      jitter=options.jitter)
+    # Data of spilled sessions (spill_threshold) expires with them.
+    spill = db[collection_name + '.spill']
+    leases = db[collection_name + '.leases']
+    sweeper.bind(lambda: collection, get_spill_collection=lambda: spill,
+                 get_lease_collection=(
+                     (lambda: leases) if options.lease else None))
+    if options.ensure_index:
+        sweeper.ensure_index()
+    if not sweeper._acquire_lease():
+        print('Another sweeper holds the lease')
+        return
+    try:
+        result = sweeper.sweep()
+    finally:
+        sweeper._release_lease()
+    print('Removed %d expired sessions in %d batches, %.3f s' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,60 @@
 from __future__ import with_statement
 
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 import uuid
 import re
 import time
+import pickle
+from datetime import datetime
 from datetime import timedelta
 
-import test_apps
+from bson import BSON
+from bson.binary import Binary
+from flask import Flask
+from flask import request
+from flask import session
+from pymongo import ReadPreference
+from pymongo import WriteConcern
+from pymongo.errors import AutoReconnect
+from pymongo.errors import OperationFailure
+
+from flask_mongo_sessions import memory
+from flask_mongo_sessions import CircuitBreaker
+from flask_mongo_sessions import MissingSessionCache
+from flask_mongo_sessions import MongoDBSession
+from flask_mongo_sessions import MongoDBSessionInterface
+from flask_mongo_sessions import _client_options
+from flask_mongo_sessions import SessionCache
+from flask_mongo_sessions import SessionMetrics
+from flask_mongo_sessions import SessionTooLarge
+from flask_mongo_sessions import SharedSessionCache
+from flask_mongo_sessions import Sweeper
+from flask_mongo_sessions import WriteBehindQueue
+from flask_mongo_sessions import merge
+from flask_mongo_sessions import migrate
+from flask_mongo_sessions import serializers
+from flask_mongo_sessions import BSONSerializer
+from flask_mongo_sessions import JSONSerializer
+from flask_mongo_sessions import HashedPrefixSIDs
+from flask_mongo_sessions import RandomSIDs
+from flask_mongo_sessions import TimeOrderedSIDs
+from flask_mongo_sessions import KeyedSerializer
+from flask_mongo_sessions import PickleSerializer
+from flask_mongo_sessions.tests import test_apps
+
+
+def get_session_sid(response):
+    cookies = [h[1] for h in response.headers
+               if h[0] == 'Set-Cookie' and h[1].startswith('session=')]
+    if not cookies:
+        return None
+    m = re.search('session=(\w{32})', cookies[0])
+    return m.group(1) if m else None
 
 
 class BaseTestCase(unittest.TestCase):
@@ -161,10 +209,1580 @@ class MultipleAppsCase(unittest.TestCase):
         self.assertEquals(r3.data, test_data3)
 
 
+class MemoryTestCase(unittest.TestCase):
+    """Base for cases checking storage I/O with the in-memory collection."""
+    options = {}
+
+    def setUp(self):
+        memory.get_database('__test-db__').drop()
+        self.app = test_apps.create_app('memory', **self.options)
+        self.client = self.app.test_client()
+        self.collection = memory.get_database('__test-db__')['sessions']
+
+    def _set(self, data):
+        r = self.client.get('/set?d='+data)
+        sid = get_session_sid(r)
+        self.assertTrue(sid)
+        self.client.set_cookie(self.app.config['SERVER_NAME'],
+                               key='session',
+                               value=sid)
+        return sid
+
+    def _get_cookie(self, response):
+        for name, value in response.headers:
+            if name == 'Set-Cookie' and value.startswith('session='):
+                return value.split(';')[0][len('session='):]
+
+    def _get_with_cookie(self, cookie):
+        self.client.set_cookie(self.app.config['SERVER_NAME'],
+                               key='session',
+                               value=cookie)
+        return self.client.get('/get')
+
+
+class WriteAvoidanceCase(MemoryTestCase):
+    options = {'touch_interval': timedelta(minutes=5)}
+
+    def test_unmodified_not_written(self):
+        self._set('data')
+        self.collection.reset_calls()
+        for _ in range(3):
+            r = self.client.get('/get')
+            self.assertEquals(r.data.decode('utf-8'), 'data')
+            self.assertFalse(get_session_sid(r))
+        self.assertEquals(self.collection.calls, {'find_one': 3})
+
+    def test_expiration_touched(self):
+        sid = self._set('data')
+        doc = self.collection.docs[0]
+        packed = doc['d']
+        doc['exp'] = datetime.utcnow() + timedelta(hours=1)
+        self.collection.reset_calls()
+        r = self.client.get('/get')
+        self.assertEquals(get_session_sid(r), sid)
+        self.assertEquals(self.collection.calls,
+                          {'find_one': 1, 'update': 1})
+        doc = self.collection.docs[0]
+        self.assertEquals(doc['d'], packed)
+        self.assertTrue(doc['exp'] > datetime.utcnow() + timedelta(hours=23))
+
+
+class AnonymousSessionCase(MemoryTestCase):
+    def test_no_io_for_anonymous(self):
+        r = self.client.get('/get')
+        self.assertFalse(get_session_sid(r))
+        self.client.get('/clear')
+        self.assertEquals(self.collection.calls, {})
+
+    def test_existing_session_removed(self):
+        self._set('data')
+        self.collection.reset_calls()
+        r = self.client.get('/clear')
+        self.assertEquals(self.collection.calls,
+                          {'find_one': 1, 'remove': 1})
+        self.assertEquals(self.collection.docs, [])
+        cookies = [h[1] for h in r.headers
+                   if h[0] == 'Set-Cookie' and h[1].startswith('session=;')]
+        self.assertTrue(cookies)
+
+
+class ServerSideExpirationCase(MemoryTestCase):
+    options = {'ttl_index': True}
+
+    def test_ttl_index(self):
+        self.assertEquals(self.collection.indexes,
+                          [('exp', {'expireAfterSeconds': 0})])
+
+    def test_expired_not_loaded(self):
+        sid = self._set('data')
+        self.collection.docs[0]['exp'] = datetime.utcnow()-timedelta(1)
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), '')
+        r = self.client.get('/set?d=new')
+        self.assertNotEquals(get_session_sid(r), sid)
+
+
+class CacheCase(MemoryTestCase):
+    def setUp(self):
+        self.cache = SessionCache(max_size=2, ttl=60)
+        self.options = {'cache': self.cache,
+                        'touch_interval': timedelta(minutes=5)}
+        super(CacheCase, self).setUp()
+
+    def test_read_through(self):
+        self._set('data')
+        self.collection.reset_calls()
+        for _ in range(3):
+            r = self.client.get('/get')
+            self.assertEquals(r.data.decode('utf-8'), 'data')
+        self.assertEquals(self.collection.calls, {})
+        self.assertEquals(self.cache.hits, 3)
+
+    def test_version_written(self):
+        self._set('data')
+        self.client.get('/set?d=other')
+        self.assertEquals(self.collection.docs[0]['v'], 2)
+
+    def test_invalidated_on_remove(self):
+        sid = self._set('data')
+        self.client.get('/clear')
+        self.assertEquals(self.cache.get(sid), None)
+
+    def test_lru_eviction(self):
+        sid = self._set('data')
+        for _ in range(2):
+            self.client.cookie_jar.clear()
+            self.client.get('/set?d=other')
+        self.assertEquals(self.cache.get(sid), None)
+        self.assertEquals(self.cache.evictions, 1)
+
+    def test_revalidate(self):
+        self.cache.revalidate = True
+        self._set('data')
+        self.collection.docs[0]['v'] = 5
+        self.collection.reset_calls()
+        self.client.get('/get')
+        self.assertEquals(self.collection.calls, {'find_one': 2})
+        self.collection.reset_calls()
+        self.client.get('/get')
+        self.assertEquals(self.collection.calls, {'find_one': 1})
+
+
+class SharedCacheCase(MemoryTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sessions.cache')
+        self.cache = SharedSessionCache(self.path, slots=8, slot_size=512,
+                                        ways=2, ttl=60)
+        self.options = {'cache': self.cache,
+                        'touch_interval': timedelta(minutes=5)}
+        super(SharedCacheCase, self).setUp()
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_shared_between_caches(self):
+        sid = self._set('data')
+        # Another worker maps the same file.
+        other = SharedSessionCache(self.path, slots=8, slot_size=512, ways=2)
+        try:
+            app = test_apps.create_app(
+                'memory', cache=other, touch_interval=timedelta(minutes=5))
+            client = app.test_client()
+            client.set_cookie(app.config['SERVER_NAME'], key='session',
+                              value=sid)
+            self.collection.reset_calls()
+            r = client.get('/get')
+            self.assertEquals(r.data.decode('utf-8'), 'data')
+            self.assertEquals(self.collection.calls, {})
+            self.assertEquals(other.hits, 1)
+        finally:
+            other.close()
+
+    def test_entry(self):
+        sid = self._set('data')
+        entry = self.cache.get(sid)
+        self.assertEquals(entry.data, {'data': 'data'})
+        self.assertEquals(entry.version, 1)
+        self.assertEquals(entry.exp.replace(microsecond=0),
+                          self.collection.docs[0]['exp'].replace(
+                              microsecond=0))
+        exp = datetime(2030, 1, 1)
+        self.cache.update_exp(sid, exp)
+        self.assertEquals(self.cache.get(sid).exp, exp)
+
+    def test_invalidated_on_remove(self):
+        sid = self._set('data')
+        self.client.get('/clear')
+        self.assertEquals(self.cache.get(sid), None)
+        self.assertEquals(len(self.cache), 0)
+
+    def test_too_large_not_cached(self):
+        sid = self._set('data')
+        self.client.get('/set?d=' + 'x' * 600)
+        self.assertEquals(self.cache.get(sid), None)
+
+    def test_bounded(self):
+        for _ in range(20):
+            self.client.cookie_jar.clear()
+            self.client.get('/set?d=data')
+        self.assertTrue(len(self.cache) <= 8)
+        self.assertTrue(self.cache.evictions > 0)
+
+    def test_layout_changed(self):
+        sid = self._set('data')
+        # The file is mapped by this cache, so it's refused rather than
+        # emptied under it.
+        self.assertRaises(ValueError, SharedSessionCache, self.path,
+                          slots=16, slot_size=512)
+        self.assertRaises(ValueError, SharedSessionCache, self.path,
+                          slots=8, slot_size=1024, ways=2)
+        self.assertEquals(self.cache.get(sid).data, {'data': 'data'})
+
+    def test_not_cache_file(self):
+        path = os.path.join(self.directory, 'other')
+        with open(path, 'wb') as f:
+            f.write(b'not a session cache')
+        self.assertRaises(ValueError, SharedSessionCache, path)
+        with open(path, 'rb') as f:
+            self.assertEquals(f.read(), b'not a session cache')
+
+
+class SerializersCase(unittest.TestCase):
+    data = {
+        'text': u'Alpenerstra\xdfe',
+        'number': 42,
+        'list': [1, 2.5, None, True],
+        'nested': {'a': {'b': u'c'}},
+        'time': datetime(2013, 5, 1, 12, 30, 15, 500000),
+    }
+
+    def _roundtrip(self, serializer, data, threshold=None):
+        fmt, value, size = serializers.encode(data, serializer, threshold)
+        return fmt, serializers.decode(fmt, value)
+
+    def test_roundtrip(self):
+        for serializer in [PickleSerializer(), JSONSerializer(),
+                           BSONSerializer()]:
+            fmt, data = self._roundtrip(serializer, self.data)
+            self.assertEquals(fmt, serializer.format)
+            self.assertEquals(data, self.data)
+
+    def test_json_tags(self):
+        data = {'tuple': (1, 2), 'uuid': uuid.uuid4(),
+                'bytes': b'\xff\x00', ' t': [1]}
+        fmt, decoded = self._roundtrip(JSONSerializer(), data)
+        self.assertEquals(decoded, data)
+
+    def test_compression(self):
+        data = {'data': 'x' * 1000}
+        fmt, value, size = serializers.encode(data, JSONSerializer(), 100)
+        self.assertEquals(fmt, 'json+zlib')
+        self.assertTrue(len(value) < 100)
+        self.assertEquals(serializers.decode(fmt, value), data)
+        fmt, value, size = serializers.encode(data, JSONSerializer(), 10000)
+        self.assertEquals(fmt, 'json')
+
+    def test_legacy_format(self):
+        value = Binary(pickle.dumps({'data': 'legacy'}))
+        self.assertEquals(serializers.decode(None, value),
+                          {'data': 'legacy'})
+
+    def test_not_accepted(self):
+        fmt, value, size = serializers.encode(self.data, PickleSerializer())
+        self.assertRaises(serializers.FormatError, serializers.decode,
+                          fmt, value, ['json'])
+
+    def test_keyed(self):
+        for serializer in [PickleSerializer(), JSONSerializer()]:
+            fmt, data = self._roundtrip(KeyedSerializer(serializer),
+                                        self.data)
+            self.assertEquals(fmt, 'keyed-' + serializer.format)
+            for value in data.values():
+                self.assertTrue(isinstance(value, serializers.EncodedValue))
+            self.assertEquals(serializers.decoded(data), self.data)
+
+
+class CountingSerializer(PickleSerializer):
+    def __init__(self):
+        PickleSerializer.__init__(self)
+        self.dumped = 0
+
+    def dumps(self, data):
+        self.dumped += 1
+        return PickleSerializer.dumps(self, data)
+
+
+class KeyedValuesCase(unittest.TestCase):
+    data = {'user': 42, 'cart': [{'sku': 'x', 'qty': 2}] * 10,
+            'flag': True}
+
+    def setUp(self):
+        self.serializer = CountingSerializer()
+        self.keyed = KeyedSerializer(self.serializer)
+        fmt, value, size = serializers.encode(self.data, self.keyed)
+        self.session = MongoDBSession(serializers.decode(fmt, value),
+                                      new=False)
+        self.serializer.dumped = 0
+
+    def test_decoded_on_access(self):
+        self.assertEquals(self.session['user'], 42)
+        self.assertTrue(isinstance(dict.__getitem__(self.session, 'cart'),
+                                   serializers.EncodedValue))
+        self.assertFalse(self.session.modified)
+        self.assertEquals(self.session, self.data)
+
+    def test_unchanged_not_encoded(self):
+        self.session.get('cart')
+        self.session['user'] = 43
+        payload = self.session.pack(self.keyed)
+        # Keys and the value which was set.
+        self.assertEquals(self.serializer.dumped, len(self.data) + 1)
+        data = serializers.decoded(serializers.decode(payload.format,
+                                                      payload.value))
+        self.assertEquals(data, dict(self.data, user=43))
+
+    def test_untracked_changes_encoded(self):
+        self.session['cart'].append({'sku': 'y', 'qty': 1})
+        self.session.modified = True
+        self.session.pack(self.keyed)
+        self.assertEquals(self.serializer.dumped, len(self.data) + 1)
+        self.assertEquals(len(self.session.stored_data()['cart']), 11)
+
+    def test_other_format(self):
+        payload = self.session.pack(PickleSerializer())
+        self.assertEquals(serializers.decode(payload.format, payload.value),
+                          self.data)
+
+
+class KeyedFormatCase(MemoryTestCase):
+    options = {'serializer': KeyedSerializer()}
+
+    def test_format_stored(self):
+        self._set('data')
+        self.client.get('/setkey/user?d=42')
+        self.assertEquals(self.collection.docs[0]['f'], 'keyed-pickle')
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+
+class SerializerOptionsCase(MemoryTestCase):
+    options = {'serializer': JSONSerializer(), 'compress_threshold': 10,
+               'accept_formats': ['json', 'bson']}
+
+    def test_format_stored(self):
+        self._set('data')
+        self.assertEquals(self.collection.docs[0]['f'], 'json+zlib')
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+    def test_not_accepted_format(self):
+        self._set('data')
+        self.collection.docs[0]['d'] = Binary(pickle.dumps({'data': 'x'}))
+        self.collection.docs[0]['f'] = 'pickle'
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), '')
+
+
+class DeltaUpdatesCase(MemoryTestCase):
+    options = {'delta_updates': True}
+
+    def setUp(self):
+        super(DeltaUpdatesCase, self).setUp()
+        self.updates = []
+        update = self.collection.update
+
+        def recording_update(spec, document, *args, **kwargs):
+            self.updates.append(document)
+            return update(spec, document, *args, **kwargs)
+        self.collection.update = recording_update
+
+    def tearDown(self):
+        # The collection is reused by other cases.
+        vars(self.collection).pop('update', None)
+        vars(self.collection).pop('find_one', None)
+
+    def test_changed_keys_only(self):
+        self._set('data')
+        self.client.get('/setkey/other?d=value')
+        self.client.get('/delkey/data')
+        self.assertEquals(set(self.updates[-2]['$set']),
+                          set(['d.other', 'exp']))
+        self.assertEquals(self.updates[-1]['$unset'], {'d.data': ''})
+        self.assertEquals(self.collection.docs[0]['d'], {'other': 'value'})
+
+    def test_size_limits(self):
+        self.app = test_apps.create_app(
+            'memory', delta_updates=True, max_size=500, spill_threshold=200,
+            oversize='truncate')
+        self.client = self.app.test_client()
+        spill = memory.get_database('__test-db__')['sessions.spill']
+        self._set('data')
+        for key in 'abcde':
+            self.client.get('/setkey/%s?d=%s' % (key, 'x' * 150))
+        doc = self.collection.docs[0]
+        self.assertTrue(doc['spill'])
+        self.assertFalse('d' in doc)
+        # Keys are removed until the session fits in the hard limit.
+        stored = spill.docs[0]['d']
+        self.assertTrue(300 < len(BSON.encode(stored)) <= 500)
+
+    def test_session_tracking(self):
+        session = MongoDBSession({'a': 1, 'b': 2}, new=False)
+        session.format = 'bson'
+        session['c'] = 3
+        session.pop('a')
+        session.update(d=4)
+        self.assertEquals(session.set_keys, set(['c', 'd']))
+        self.assertEquals(session.deleted_keys, set(['a']))
+        self.assertTrue(session.can_update_keys())
+        session['x.y'] = 5
+        self.assertFalse(session.can_update_keys())
+        del session['x.y']
+        session.modified = True
+        self.assertFalse(session.can_update_keys())
+
+    def test_removed_document_not_rewritten(self):
+        self._set('data')
+        find_one = self.collection.find_one
+
+        def find_and_remove(*args, **kwargs):
+            doc = find_one(*args, **kwargs)
+            self.collection.docs = []
+            return doc
+        self.collection.find_one = find_and_remove
+        r = self.client.get('/setkey/other?d=value')
+        # E.g. all sessions of the user were invalidated meanwhile.
+        self.assertEquals(self.collection.docs, [])
+        self.assertTrue('session=;' in r.headers['Set-Cookie'])
+
+
+class LazySessionCase(MemoryTestCase):
+    options = {'lazy': True}
+
+    def test_not_accessed(self):
+        self._set('data')
+        self.collection.reset_calls()
+        r = self.client.get('/nosession')
+        self.assertFalse(get_session_sid(r))
+        self.assertEquals(self.collection.calls, {})
+
+    def test_accessed(self):
+        self._set('data')
+        self.collection.reset_calls()
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        self.assertEquals(self.collection.calls['find_one'], 1)
+
+    def test_nonexistent_sid(self):
+        sid = uuid.uuid4().hex
+        self.client.set_cookie(self.app.config['SERVER_NAME'],
+                               key='session',
+                               value=sid)
+        r = self.client.get('/set?d=data')
+        self.assertNotEquals(get_session_sid(r), sid)
+
+
+class WriteBehindCase(MemoryTestCase):
+    def setUp(self):
+        self.queue = WriteBehindQueue(batch_size=100, flush_interval=60)
+        self.options = {'write_behind': self.queue}
+        super(WriteBehindCase, self).setUp()
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_written_in_background(self):
+        self._set('data')
+        self.client.get('/set?d=other')
+        self.assertEquals(self.collection.calls, {})
+        self.assertEquals(len(self.queue), 1)
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'other')
+        self.queue.flush()
+        self.assertEquals(self.collection.calls, {'bulk_write': 1})
+        self.assertEquals(self.collection.docs[0]['v'], 3)
+
+    def test_removal_coalesced(self):
+        self._set('data')
+        self.queue.flush()
+        self.client.get('/set?d=other')
+        self.client.get('/clear')
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), '')
+        self.queue.flush()
+        self.assertEquals(self.collection.docs, [])
+
+    def test_visible_while_flushed(self):
+        sid = self._set('data')
+        seen = []
+        bulk_write = self.collection.bulk_write
+
+        def checking_bulk_write(requests, ordered=True):
+            seen.append(self.queue.get(sid)[0])
+            return bulk_write(requests, ordered)
+        self.collection.bulk_write = checking_bulk_write
+        try:
+            self.queue.flush()
+        finally:
+            del self.collection.bulk_write
+        self.assertEquals(seen, [True])
+        self.assertEquals(self.queue.get(sid), (False, None))
+
+    def test_failed_batch_retried(self):
+        self._set('data')
+        self.collection.error = AutoReconnect()
+        self.queue.flush()
+        self.assertEquals(self.queue.errors, 1)
+        self.assertEquals(len(self.queue), 1)
+        self.client.get('/set?d=other')
+        self.collection.error = None
+        self.queue.flush()
+        self.assertEquals(len(self.queue), 0)
+        self.assertEquals(self.collection.docs[0]['v'], 2)
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'other')
+
+    def test_dropped_after_retries(self):
+        self.queue.max_retries = 2
+        self._set('data')
+        self.collection.error = AutoReconnect()
+        self.queue.flush()
+        self.queue.flush()
+        self.assertEquals(len(self.queue), 0)
+        self.assertEquals(self.queue.dropped, 1)
+
+    def test_batches_written_one_at_a_time(self):
+        sid = self._set('data')
+        writing, release = threading.Event(), threading.Event()
+        bulk_write = self.collection.bulk_write
+
+        def slow_bulk_write(requests, ordered=True):
+            if not writing.is_set():
+                writing.set()
+                release.wait(5)
+            return bulk_write(requests, ordered)
+        self.collection.bulk_write = slow_bulk_write
+        first = threading.Thread(target=self.queue.flush)
+        first.start()
+        writing.wait(5)
+        # A later write is flushed while the first batch is written.
+        self.client.get('/set?d=other')
+        second = threading.Thread(target=self.queue.flush)
+        second.start()
+        second.join(0.1)
+        release.set()
+        first.join()
+        second.join()
+        del self.collection.bulk_write
+        self.assertEquals(self.collection.calls, {'bulk_write': 2})
+        doc = self.collection.docs[0]
+        self.assertEquals(doc['_id'], sid)
+        self.assertEquals(serializers.decode(doc.get('f'), doc['d']),
+                          {'data': 'other'})
+
+    def test_overflow_sync(self):
+        self.queue.max_pending = 0
+        self.queue.overflow = 'sync'
+        self._set('data')
+        self.assertEquals(self.collection.calls, {'update': 1})
+
+
+class MetricsCase(MemoryTestCase):
+    def setUp(self):
+        self.metrics = SessionMetrics()
+        self.options = {'metrics': self.metrics,
+                        'cache': SessionCache(),
+                        'touch_interval': timedelta(minutes=5)}
+        super(MetricsCase, self).setUp()
+
+    def test_round_trips(self):
+        self._set('data')
+        self.client.get('/get')
+        stats = self.metrics.snapshot()
+        self.assertEquals(stats['storage.update']['count'], 1)
+        self.assertEquals(stats['session.open']['count'], 2)
+        self.assertEquals(stats['session.save']['count'], 2)
+        self.assertEquals(stats['save.write'], 1)
+        self.assertEquals(stats['save.skipped'], 1)
+        self.assertEquals(stats['cache.hit'], 1)
+        self.assertFalse('storage.find_one' in stats)
+
+    def test_payload_size(self):
+        self._set('data')
+        stats = self.metrics.snapshot()
+        size = len(self.collection.docs[0]['d'])
+        self.assertEquals(stats['payload.size']['max'], size)
+        self.assertEquals(stats['payload.stored_size']['max'], size)
+
+    def test_decode_time(self):
+        self._set('data')
+        self.client.application.session_interface._cache.clear()
+        self.client.get('/get')
+        stats = self.metrics.snapshot()
+        self.assertEquals(stats['storage.find_one']['count'], 1)
+        self.assertEquals(stats['cache.miss'], 1)
+        self.assertEquals(stats['payload.decode_time']['count'], 1)
+
+    def test_reset(self):
+        self._set('data')
+        self.metrics.reset()
+        self.assertEquals(self.metrics.snapshot(), {})
+
+    def test_histogram(self):
+        metrics = SessionMetrics(time_buckets=(0.01, 0.1))
+        for value in [0.005] * 8 + [0.05, 0.5]:
+            metrics.observe('storage.update', value)
+        metrics.observe('payload.size', 100)
+        stats = metrics.snapshot()['storage.update']
+        self.assertEquals(stats['buckets'],
+                          [(0.01, 8), (0.1, 9), (float('inf'), 10)])
+        self.assertEquals(stats['p50'], 0.01)
+        self.assertEquals(stats['p90'], 0.1)
+        self.assertEquals(stats['p99'], 0.5)
+        stats = metrics.snapshot()['payload.size']
+        self.assertEquals(stats['buckets'][0], (128, 1))
+
+    def test_prometheus(self):
+        metrics = SessionMetrics(time_buckets=(0.01,))
+        metrics.observe('storage.update', 0.005)
+        metrics.incr('save.write')
+        self.assertEquals(metrics.prometheus().splitlines(), [
+            '# TYPE flask_sessions_save_write_total counter',
+            'flask_sessions_save_write_total 1',
+            '# TYPE flask_sessions_storage_update histogram',
+            'flask_sessions_storage_update_bucket{le="0.01"} 1',
+            'flask_sessions_storage_update_bucket{le="+Inf"} 1',
+            'flask_sessions_storage_update_sum 0.005',
+            'flask_sessions_storage_update_count 1'])
+
+    def test_lazy(self):
+        app = test_apps.create_app('memory', lazy=True, metrics=self.metrics)
+        client = app.test_client()
+        r = client.get('/set?d=data')
+        client.set_cookie(app.config['SERVER_NAME'], key='session',
+                          value=get_session_sid(r))
+        client.get('/get')
+        client.get('/nosession')
+        stats = self.metrics.snapshot()
+        self.assertEquals(stats['session.lazy_loaded'], 1)
+        self.assertEquals(stats['session.lazy_unused'], 1)
+
+
+class SidValidationCase(MemoryTestCase):
+    def setUp(self):
+        self.missing = MissingSessionCache(ttl=60)
+        self.options = {'missing_cache': self.missing}
+        super(SidValidationCase, self).setUp()
+
+    def _get_with_sid(self, sid):
+        self.client.set_cookie(self.app.config['SERVER_NAME'],
+                               key='session',
+                               value=sid)
+        return self.client.get('/get')
+
+    def test_malformed_not_queried(self):
+        self._set('data')
+        self.collection.reset_calls()
+        for sid in ['abc', 'x' * 4096, uuid.uuid4().hex.upper(),
+                    uuid.uuid4().hex + '\n']:
+            r = self._get_with_sid(sid)
+            self.assertEquals(r.data.decode('utf-8'), '')
+        self.assertEquals(self.collection.calls, {})
+
+    def test_missing_cached(self):
+        sid = uuid.uuid4().hex
+        self._get_with_sid(sid)
+        self.collection.reset_calls()
+        self._get_with_sid(sid)
+        self.assertEquals(self.collection.calls, {})
+        self.assertEquals(self.missing.hits, 1)
+
+    def test_expired_cached(self):
+        sid = self._set('data')
+        self.collection.docs[0]['exp'] = datetime.utcnow() - timedelta(1)
+        self._get_with_sid(sid)
+        self.assertTrue(sid in self.missing)
+
+    def test_existing_not_cached(self):
+        sid = self._set('data')
+        r = self._get_with_sid(sid)
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        self.assertEquals(len(self.missing), 0)
+
+
+class SignedSidCase(MemoryTestCase):
+    options = {'signed_sids': True}
+
+    def setUp(self):
+        super(SignedSidCase, self).setUp()
+        self.app.secret_key = 'secret'
+
+    def test_roundtrip(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        sid, signature = cookie.split('.')
+        self.assertTrue(re.match('^[0-9a-f]{32}$', sid))
+        r = self._get_with_cookie(cookie)
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+    def test_forged_not_queried(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        sid, signature = cookie.split('.')
+        self.collection.reset_calls()
+        for forged in [sid, sid + '.' + '0' * 64,
+                       uuid.uuid4().hex + '.' + signature]:
+            r = self._get_with_cookie(forged)
+            self.assertEquals(r.data.decode('utf-8'), '')
+        self.assertEquals(self.collection.calls, {})
+
+    def test_other_secret_key(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        self.app.secret_key = 'other'
+        r = self._get_with_cookie(cookie)
+        self.assertEquals(r.data.decode('utf-8'), '')
+
+
+class HybridStorageCase(MemoryTestCase):
+    options = {'cookie_threshold': 200}
+
+    def setUp(self):
+        super(HybridStorageCase, self).setUp()
+        self.app.secret_key = 'secret'
+
+    def test_small_in_cookie(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        self.assertTrue(cookie.startswith('c.'))
+        self.assertEquals(self.collection.docs, [])
+        self.collection.reset_calls()
+        r = self._get_with_cookie(cookie)
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        self.assertEquals(self.collection.calls, {})
+
+    def test_moved_to_database_and_back(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        self._get_with_cookie(cookie)
+        # Random data, so it isn't compressed to fit in the cookie.
+        large = ''.join(uuid.uuid4().hex for _ in range(20))
+        cookie = self._get_cookie(self.client.get('/set?d=' + large))
+        self.assertTrue(re.match('^[0-9a-f]{32}$', cookie))
+        self.assertEquals(len(self.collection.docs), 1)
+        r = self._get_with_cookie(cookie)
+        self.assertEquals(r.data.decode('utf-8'), large)
+
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        self.assertTrue(cookie.startswith('c.'))
+        self.assertEquals(self.collection.docs, [])
+        r = self._get_with_cookie(cookie)
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+    def test_not_json_in_database(self):
+        def set_set():
+            session['s'] = set([1, 2])
+            return 'set'
+        self.app.add_url_rule('/setset', 'setset', set_set)
+        r = self.client.get('/setset')
+        self.assertEquals(r.status_code, 200)
+        self.assertTrue(re.match('^[0-9a-f]{32}$', self._get_cookie(r)))
+        self.assertEquals(len(self.collection.docs), 1)
+
+    def test_tampered(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        r = self._get_with_cookie(cookie[:-2] + 'xx')
+        self.assertEquals(r.data.decode('utf-8'), '')
+
+    def test_cleared(self):
+        cookie = self._get_cookie(self.client.get('/set?d=data'))
+        self._get_with_cookie(cookie)
+        self.collection.reset_calls()
+        r = self.client.get('/clear')
+        self.assertEquals(self._get_cookie(r), '')
+        self.assertEquals(self.collection.calls, {})
+
+
+class OptimisticConcurrencyCase(MemoryTestCase):
+    options = {'optimistic': True}
+
+    def _open(self, sid):
+        interface = self.app.session_interface
+        with self.app.test_request_context(
+                '/', headers={'Cookie': 'session=' + sid}):
+            return interface.open_session(self.app, request)
+
+    def _save(self, session):
+        interface = self.app.session_interface
+        with self.app.test_request_context('/'):
+            interface.save_session(self.app, session,
+                                   self.app.response_class())
+
+    def _stored(self):
+        return pickle.loads(self.collection.docs[0]['d'])
+
+    def test_concurrent_keys_kept(self):
+        sid = self._set('data')
+        first = self._open(sid)
+        self.client.get('/setkey/other?d=value')
+        first['mine'] = 'value'
+        self._save(first)
+        self.assertEquals(self._stored(), {'data': 'data', 'mine': 'value',
+                                           'other': 'value'})
+        self.assertEquals(self.collection.docs[0]['v'], 3)
+
+    def test_no_conflict(self):
+        self._set('data')
+        self.collection.reset_calls()
+        self.client.get('/setkey/other?d=value')
+        self.assertEquals(self.collection.calls,
+                          {'find_one': 1, 'update': 1})
+
+    def test_spilled_concurrent_keys_kept(self):
+        self.app.session_interface._spill_threshold = 100
+        spill = memory.get_database('__test-db__')['sessions.spill']
+        sid = self._set('x' * 200)
+        first = self._open(sid)
+        self.client.get('/setkey/other?d=value')
+        first['mine'] = 'value'
+        self._save(first)
+        # The write which didn't match left the data of the other one.
+        self.assertEquals(len(spill.docs), 1)
+        data = serializers.decode(spill.docs[0]['f'], spill.docs[0]['d'])
+        self.assertEquals(sorted(data), ['data', 'mine', 'other'])
+        self.assertEquals(spill.docs[0]['_id'],
+                          self.collection.docs[0]['spill'])
+
+    def test_legacy_document(self):
+        self._set('data')
+        del self.collection.docs[0]['v']
+        self.collection.reset_calls()
+        self.client.get('/setkey/other?d=value')
+        self.assertEquals(self.collection.calls,
+                          {'find_one': 1, 'update': 1})
+
+    def test_cleared_concurrently(self):
+        sid = self._set('data')
+        first = self._open(sid)
+        self.client.get('/setkey/other?d=value')
+        first.clear()
+        self._save(first)
+        self.assertEquals(self._stored(), {'other': 'value'})
+
+    def test_removed_concurrently(self):
+        sid = self._set('data')
+        first = self._open(sid)
+        self.client.get('/clear')
+        first['mine'] = 'value'
+        self._save(first)
+        self.assertEquals(self.collection.docs, [])
+
+    def test_merge_policy(self):
+        self.app.session_interface._merge_policy = merge.overwrite
+        sid = self._set('data')
+        first = self._open(sid)
+        self.client.get('/setkey/other?d=value')
+        first['mine'] = 'value'
+        self._save(first)
+        self.assertEquals(self._stored(), {'data': 'data', 'mine': 'value'})
+
+    def test_write_behind_rejected(self):
+        self.assertRaises(ValueError, test_apps.create_app, 'memory',
+                          optimistic=True, write_behind=WriteBehindQueue())
+
+
+class OptimisticDeltaUpdatesCase(OptimisticConcurrencyCase):
+    options = {'optimistic': True, 'delta_updates': True}
+
+    def _stored(self):
+        return self.collection.docs[0]['d']
+
+
+class CollectionOptionsCase(MemoryTestCase):
+    options = {'write_concern': WriteConcern(w='majority'),
+               'touch_write_concern': WriteConcern(w=0),
+               'read_preference': ReadPreference.PRIMARY_PREFERRED,
+               'touch_interval': timedelta(0)}
+
+    def test_write_concerns(self):
+        self._set('data')
+        self.assertEquals(self.collection.calls_with_options, [
+            ('update', {'write_concern': WriteConcern(w='majority'),
+                        'read_preference': ReadPreference.PRIMARY_PREFERRED}),
+        ])
+        self.collection.reset_calls()
+        self.client.get('/get')
+        self.assertEquals(self.collection.calls_with_options, [
+            ('find_one', {'write_concern': WriteConcern(w='majority'),
+                          'read_preference':
+                              ReadPreference.PRIMARY_PREFERRED}),
+            ('update', {'write_concern': WriteConcern(w=0),
+                        'read_preference': ReadPreference.PRIMARY_PREFERRED}),
+        ])
+
+    def test_config(self):
+        app = Flask('testapp')
+        app.config['MONGO_SESSIONS_URI'] = 'mongodb://localhost/sessions-db'
+        app.config['MONGO_SESSIONS_COLLECTION'] = 'web-sessions'
+        interface = MongoDBSessionInterface(app)
+        self.assertEquals(interface._db.name, 'sessions-db')
+        self.assertEquals(interface._collection_name, 'web-sessions')
+        interface._client.close()
+
+    def test_client_options(self):
+        self.assertEquals(_client_options({
+            'MONGO_SESSIONS_MAX_POOL_SIZE': 20,
+            'MONGO_SESSIONS_SERVER_SELECTION_TIMEOUT_MS': 500,
+            'MONGO_SESSIONS_COMPRESSORS': 'zlib',
+            'MONGO_SESSIONS_CLIENT_OPTIONS': {'appname': 'sessions'},
+        }), {'maxPoolSize': 20, 'serverSelectionTimeoutMS': 500,
+             'compressors': 'zlib', 'appname': 'sessions'})
+
+
+class SecondaryReadsCase(MemoryTestCase):
+    options = {'secondary_reads': ReadPreference.NEAREST,
+               'touch_interval': timedelta(minutes=5)}
+
+    def _get_marker(self, response):
+        for name, value in response.headers:
+            if name == 'Set-Cookie' and value.startswith('session_w='):
+                return value
+
+    def test_marker_set_on_write(self):
+        r = self.client.get('/set?d=data')
+        self.assertTrue('Max-Age=10' in self._get_marker(r))
+        self.client.set_cookie(self.app.config['SERVER_NAME'],
+                               key='session',
+                               value=get_session_sid(r))
+        r = self.client.get('/get')
+        self.assertEquals(self._get_marker(r), None)
+
+    def test_primary_after_write(self):
+        self._set('data')
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        self.assertEquals(self.collection.calls_with_options, [])
+
+    def test_secondary(self):
+        self._set('data')
+        self.client.delete_cookie(self.app.config['SERVER_NAME'],
+                                  'session_w')
+        self.collection.reset_calls()
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        self.assertEquals(self.collection.calls_with_options, [
+            ('find_one', {'read_preference': ReadPreference.NEAREST}),
+        ])
+
+
+class SweeperCase(MemoryTestCase):
+    def setUp(self):
+        self.sweeper = Sweeper(batch_size=2, max_rate=1000, interval=60)
+        self.options = {'sweeper': self.sweeper}
+        super(SweeperCase, self).setUp()
+
+    def tearDown(self):
+        self.sweeper.stop()
+
+    def test_sweep(self):
+        for i in range(5):
+            self.client.cookie_jar.clear()
+            self.client.get('/set?d=data')
+        for doc in self.collection.docs[:3]:
+            doc['exp'] = datetime.utcnow() - timedelta(1)
+        self.collection.reset_calls()
+        result = self.sweeper.sweep()
+        self.assertEquals(result.removed, 3)
+        self.assertEquals(result.batches, 2)
+        self.assertEquals(len(self.collection.docs), 2)
+        self.assertEquals(self.collection.calls, {'find': 2, 'remove': 2})
+
+    def test_refreshed_kept(self):
+        self._set('data')
+        now = datetime.utcnow()
+        self.collection.docs[0]['exp'] = now - timedelta(1)
+        remove = self.collection.remove
+
+        def refresh_and_remove(spec):
+            self.collection.docs[0]['exp'] = now + timedelta(1)
+            return remove(spec)
+        self.collection.remove = refresh_and_remove
+        try:
+            result = self.sweeper.sweep(now)
+        finally:
+            del self.collection.remove
+        self.assertEquals(result.removed, 0)
+        self.assertEquals(len(self.collection.docs), 1)
+
+    def test_started_with_interface(self):
+        self.assertEquals(self.collection.indexes, [('exp', {})])
+        self.client.get('/nosession')
+        self.assertTrue(self.sweeper._is_running())
+
+    def test_lease(self):
+        leases = memory.get_database('__test-db__')['sessions.leases']
+        other = Sweeper()
+        other.bind(lambda: self.collection,
+                   get_lease_collection=lambda: leases)
+        self.assertTrue(self.sweeper._acquire_lease())
+        self.assertTrue(self.sweeper._acquire_lease())
+        self.assertFalse(other._acquire_lease())
+        # Taken over when it expires.
+        leases.docs[0]['until'] = datetime.utcnow() - timedelta(1)
+        self.assertTrue(other._acquire_lease())
+        self.assertFalse(self.sweeper._acquire_lease())
+        self.assertEquals(len(leases.docs), 1)
+
+    def test_lease_released(self):
+        leases = memory.get_database('__test-db__')['sessions.leases']
+        self.client.get('/nosession')
+        self.assertTrue(self.sweeper._acquire_lease())
+        self.sweeper.stop()
+        self.assertEquals(leases.docs, [])
+
+
+class SpillCase(MemoryTestCase):
+    options = {'spill_threshold': 200, 'spill_hot_keys': ['user'],
+               'max_size': 2000}
+
+    def setUp(self):
+        super(SpillCase, self).setUp()
+        self.spill = memory.get_database('__test-db__')['sessions.spill']
+        # Random data, so it isn't compressed.
+        self.large = ''.join(uuid.uuid4().hex for _ in range(10))
+
+    def test_small_inline(self):
+        self._set('data')
+        self.assertTrue('d' in self.collection.docs[0])
+        self.assertEquals(self.spill.docs, [])
+
+    def test_large_spilled(self):
+        self._set('data')
+        self.client.get('/setkey/user?d=42')
+        self.client.get('/set?d=' + self.large)
+        doc = self.collection.docs[0]
+        self.assertFalse('d' in doc)
+        self.assertTrue(doc['spill'])
+        self.assertEquals(pickle.loads(doc['h']), {'user': '42'})
+        self.assertEquals(len(self.spill.docs), 1)
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), self.large)
+
+    def _get_user(self):
+        return self.client.get('/getkey/user').data.decode('utf-8')
+
+    def test_hot_keys_read(self):
+        self.app.session_interface._touch_interval = timedelta(minutes=5)
+        self._set(self.large)
+        self.client.get('/setkey/user?d=42')
+        self.collection.reset_calls()
+        self.spill.reset_calls()
+        self.assertEquals(self._get_user(), '42')
+        self.assertEquals(self.collection.calls, {'find_one': 1})
+        self.assertEquals(self.spill.calls, {})
+        # Other keys are read from the spill collection.
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), self.large)
+        self.assertEquals(self.spill.calls, {'find_one': 1})
+
+    def test_hot_keys_not_bson(self):
+        self.app.session_interface._spill_hot_keys = ['data']
+        def set_set():
+            session['data'] = set([1])
+            return 'set'
+        self.app.add_url_rule('/setset', 'setset', set_set)
+        self._set(self.large)
+        self.client.get('/setkey/user?d=' + self.large)
+        r = self.client.get('/setset')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(pickle.loads(self.collection.docs[0]['h']),
+                          {'data': set([1])})
+
+    def test_hot_keys_touched(self):
+        self._set(self.large)
+        self.client.get('/setkey/user?d=42')
+        self.collection.docs[0]['exp'] -= timedelta(minutes=10)
+        self.spill.reset_calls()
+        self.assertEquals(self._get_user(), '42')
+        self.assertEquals(self.spill.calls, {'update': 1})
+        self.assertEquals(pickle.loads(self.spill.docs[0]['d'])['data'],
+                          self.large)
+
+    def test_shrunk(self):
+        self._set(self.large)
+        self.client.get('/set?d=data')
+        self.assertTrue('d' in self.collection.docs[0])
+        self.assertFalse('spill' in self.collection.docs[0])
+        self.assertEquals(self.spill.docs, [])
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+    def test_removed(self):
+        self._set(self.large)
+        self.client.get('/clear')
+        self.assertEquals(self.collection.docs, [])
+        self.assertEquals(self.spill.docs, [])
+
+    def test_too_large(self):
+        self.app.testing = True
+        self.assertRaises(SessionTooLarge, self.client.get,
+                          '/set?d=' + self.large * 10)
+
+    def test_truncated(self):
+        self.app.session_interface._oversize = 'truncate'
+        self._set('data')
+        self.client.get('/setkey/user?d=42')
+        self.client.get('/setkey/data?d=' + self.large * 10)
+        self.assertEquals(pickle.loads(self.collection.docs[0]['d']),
+                          {'user': '42'})
+
+
+class UserSessionsCase(MemoryTestCase):
+    def setUp(self):
+        self.cache = SessionCache()
+        self.options = {'user_key': 'user', 'cache': self.cache}
+        super(UserSessionsCase, self).setUp()
+
+    def _log_in(self, user):
+        self.client.cookie_jar.clear()
+        sid = self._set('data')
+        self.client.get('/setkey/user?d=' + user)
+        return sid
+
+    def test_user_stored(self):
+        self._log_in('alice')
+        self.assertEquals(self.collection.docs[0]['u'], 'alice')
+        self.assertTrue(('u', {'sparse': True}) in self.collection.indexes)
+        self.client.get('/delkey/user')
+        self.assertFalse('u' in self.collection.docs[0])
+
+    def test_list_and_count(self):
+        sids = [self._log_in('alice') for _ in range(2)]
+        self._log_in('bob')
+        interface = self.app.session_interface
+        self.assertEquals(sorted(interface.user_sessions('alice')),
+                          sorted(sids))
+        self.assertEquals(interface.count_user_sessions('alice'), 2)
+        self.collection.docs[0]['exp'] = datetime.utcnow() - timedelta(1)
+        self.assertEquals(interface.count_user_sessions('alice'), 1)
+
+    def test_invalidate(self):
+        sid = self._log_in('alice')
+        self._log_in('bob')
+        interface = self.app.session_interface
+        self.assertEquals(interface.invalidate_user_sessions('alice'), 1)
+        self.assertEquals(len(self.collection.docs), 1)
+        self.assertEquals(self.cache.get(sid), None)
+        r = self._get_with_cookie(sid)
+        self.assertEquals(r.data.decode('utf-8'), '')
+
+    def test_not_written_back_by_other_process(self):
+        sid = self._log_in('alice')
+        # Another worker, which has the session cached.
+        other = test_apps.create_app('memory', user_key='user',
+                                     cache=SessionCache())
+        client = other.test_client()
+        client.set_cookie('localhost:5000', key='session', value=sid)
+        client.get('/get')
+        self.app.session_interface.invalidate_user_sessions('alice')
+        r = client.get('/setkey/other?d=value')
+        self.assertTrue('session=;' in r.headers['Set-Cookie'])
+        self.assertEquals(self.collection.docs, [])
+        self.assertEquals(
+            self.app.session_interface.user_sessions('alice'), [])
+
+    def test_without_user_key(self):
+        self.app.session_interface._user_key = None
+        self.assertRaises(ValueError,
+                          self.app.session_interface.user_sessions, 'alice')
+
+
+class SidStrategiesCase(unittest.TestCase):
+    def test_random(self):
+        sid = RandomSIDs().generate()
+        self.assertEquals(len(sid), 32)
+        self.assertTrue(RandomSIDs().is_valid(sid))
+
+    def test_time_ordered(self):
+        strategy = TimeOrderedSIDs()
+        first = strategy.generate()
+        time.sleep(0.002)
+        second = strategy.generate()
+        self.assertEquals(len(first), 44)
+        self.assertTrue(first < second)
+        self.assertTrue(strategy.is_valid(first))
+        self.assertFalse(strategy.is_valid(RandomSIDs().generate()))
+        self.assertFalse(strategy.is_valid(first.upper()))
+
+    def test_hashed_prefix(self):
+        strategy = HashedPrefixSIDs()
+        sids = [strategy.generate() for _ in range(100)]
+        for sid in sids:
+            self.assertEquals(len(sid), 46)
+            self.assertTrue(strategy.is_valid(sid))
+        self.assertTrue(len(set(sid[:2] for sid in sids)) > 1)
+        # A changed SID doesn't match its prefix.
+        sid = sids[0][:-1] + ('0' if sids[0][-1] != '0' else '1')
+        self.assertFalse(strategy.is_valid(sid))
+
+
+class SidStrategyCase(MemoryTestCase):
+    options = {'sid_strategy': TimeOrderedSIDs(),
+               'accept_sid_strategies': [RandomSIDs()]}
+
+    def test_roundtrip(self):
+        r = self.client.get('/set?d=data')
+        sid = self._get_cookie(r)
+        self.assertEquals(len(sid), 44)
+        self.assertEquals(self.collection.docs[0]['_id'], sid)
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+    def test_previous_strategy_accepted(self):
+        sid = uuid.uuid4().hex
+        self.collection.docs.append({'_id': sid, 'd': Binary(pickle.dumps(
+            {'data': 'old'})), 'exp': datetime.utcnow() + timedelta(1)})
+        r = self._get_with_cookie(sid)
+        self.assertEquals(r.data.decode('utf-8'), 'old')
+
+    def test_malformed_not_queried(self):
+        self.collection.reset_calls()
+        r = self._get_with_cookie('0' * 43)
+        self.assertEquals(r.data.decode('utf-8'), '')
+        self.assertEquals(self.collection.calls, {})
+
+
+class MigrationCase(MemoryTestCase):
+    def setUp(self):
+        super(MigrationCase, self).setUp()
+        self.sids = []
+        for i in range(3):
+            self.client.cookie_jar.clear()
+            self.sids.append(self._set('data%d' % i))
+        self.sids.sort()
+
+    def test_reencoded(self):
+        result = migrate.SessionMigrator(self.collection,
+                                         JSONSerializer()).run()
+        self.assertEquals(result.migrated, 3)
+        self.assertEquals(result.last_id, self.sids[-1])
+        self.assertEquals(set(doc['f'] for doc in self.collection.docs),
+                          set(['json']))
+        result = migrate.SessionMigrator(self.collection,
+                                         JSONSerializer()).run()
+        self.assertEquals((result.migrated, result.skipped), (0, 3))
+        r = self._get_with_cookie(self.sids[0])
+        self.assertEquals(r.data.decode('utf-8')[:4], 'data')
+
+    def test_dry_run(self):
+        migrator = migrate.SessionMigrator(
+            self.collection, PickleSerializer(), compress_threshold=0,
+            dry_run=True)
+        result = migrator.run()
+        self.assertEquals(result.migrated, 3)
+        self.assertTrue(result.size_before > 0)
+        self.assertTrue(result.size_after > 0)
+        self.assertEquals(set(doc['f'] for doc in self.collection.docs),
+                          set(['pickle']))
+
+    def test_resumed(self):
+        migrator = migrate.SessionMigrator(self.collection, JSONSerializer(),
+                                           batch_size=1)
+        progress = []
+        result = migrator.run(end=self.sids[0], progress=progress.append)
+        self.assertEquals(result.migrated, 1)
+        self.assertEquals(progress, [self.sids[0]])
+        result = migrator.run(start_after=self.sids[0])
+        self.assertEquals(result.migrated, 2)
+
+    def test_ranges(self):
+        ranges = migrate.id_ranges(self.collection, 2)
+        self.assertEquals(len(ranges), 2)
+        migrator = migrate.SessionMigrator(self.collection, JSONSerializer())
+        migrated = [migrator.run(*bounds).migrated for bounds in ranges]
+        self.assertEquals(sum(migrated), 3)
+        self.assertTrue(all(migrated))
+
+    def test_written_meanwhile(self):
+        batch = list(self.collection.find())
+        self.client.get('/set?d=new')
+        migrator = migrate.SessionMigrator(self.collection, JSONSerializer())
+        migrator._migrate_batch(batch, dict.fromkeys(
+            migrate.MigrationResult._fields, 0))
+        formats = [doc['f'] for doc in self.collection.docs]
+        self.assertEquals(sorted(formats), ['json', 'json', 'pickle'])
+
+    def test_copied(self):
+        target = memory.get_database('__test-db__')['sessions.new']
+        migrator = migrate.SessionMigrator(self.collection, JSONSerializer(),
+                                           target=target)
+        migrator.run()
+        self.assertEquals(sorted(doc['_id'] for doc in target.docs),
+                          self.sids)
+        self.assertEquals(target.docs[0]['f'], 'json')
+        self.assertEquals(self.collection.docs[0]['f'], 'pickle')
+
+
+class NamespacesCase(MemoryTestCase):
+    options = {'namespaces': True, 'ttl_index': True}
+
+    def setUp(self):
+        super(NamespacesCase, self).setUp()
+        self.interface = self.app.session_interface
+        self.app2 = Flask('otherapp')
+        self.app2.config['SERVER_NAME'] = 'localhost:5000'
+        self.app2.view_functions = self.app.view_functions
+        self.app2.url_map = self.app.url_map
+        self.app2.session_interface = self.interface
+        self.interface.init_app(self.app2)
+        self.client2 = self.app2.test_client()
+
+    def test_namespaced_keys(self):
+        r = self.client.get('/set?d=data')
+        sid = self._get_cookie(r)
+        self.assertEquals(len(sid), 32)
+        self.assertEquals(self.collection.docs[0]['_id'], 'testapp:' + sid)
+        r = self._get_with_cookie(sid)
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+
+    def test_isolated(self):
+        sid = self._set('data')
+        self.client2.set_cookie('localhost:5000', key='session', value=sid)
+        r = self.client2.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), '')
+        self.client2.get('/set?d=other')
+        keys = sorted(doc['_id'] for doc in self.collection.docs)
+        self.assertEquals(keys[0].partition(':')[0], 'otherapp')
+        self.assertNotEquals(keys[0].partition(':')[2], sid)
+        self.assertEquals(keys[1], 'testapp:' + sid)
+
+    def test_indexes_ensured_once(self):
+        self.assertEquals(self.collection.indexes,
+                          [('exp', {'expireAfterSeconds': 0})])
+        self.assertEquals(self.collection.calls.get('create_index'), 1)
+
+    def test_count_and_sweep(self):
+        self._set('data')
+        self.client2.get('/set?d=data')
+        self.assertEquals(self.interface.count_sessions(), 2)
+        self.assertEquals(self.interface.count_sessions('otherapp'), 1)
+        for doc in self.collection.docs:
+            doc['exp'] = datetime.utcnow() - timedelta(1)
+        sweeper = Sweeper()
+        sweeper.bind(lambda: self.collection)
+        self.assertEquals(sweeper.sweep(namespace='testapp').removed, 1)
+        self.assertEquals(self.collection.docs[0]['_id'][:9], 'otherapp:')
+
+    def test_configured_namespace(self):
+        app = Flask('thirdapp')
+        app.config['MONGO_SESSIONS_NAMESPACE'] = 'third'
+        self.assertEquals(self.interface._key(app, 'x'), 'third:x')
+        app.config['MONGO_SESSIONS_NAMESPACE'] = 'a:b'
+        self.assertRaises(ValueError, self.interface.init_app, app)
+
+    def test_namespace_reused(self):
+        # Initializing the same application again is fine.
+        self.interface.init_app(self.app2)
+        app = Flask('otherapp')
+        self.assertRaises(ValueError, self.interface.init_app, app)
+        app.config['MONGO_SESSIONS_NAMESPACE'] = 'third'
+        self.interface.init_app(app)
+        self.assertEquals(sorted(self.interface._registered_namespaces),
+                          ['otherapp', 'testapp', 'third'])
+
+
+class CircuitBreakerCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        self.changes = []
+        self.breaker.add_listener(lambda old, new:
+                                  self.changes.append((old, new)))
+
+    def test_opens_after_failures(self):
+        self.breaker.reset_timeout = 60
+        self.breaker.record(False)
+        self.breaker.record(True)
+        self.breaker.record(False)
+        self.assertEquals(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEquals(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEquals(self.changes, [('closed', 'open')])
+
+    def test_half_open(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        # One trial call at a time.
+        self.assertTrue(self.breaker.allow())
+        self.assertEquals(self.breaker.state, 'half-open')
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEquals(self.breaker.state, 'closed')
+        self.assertEquals(self.changes, [('closed', 'open'),
+                                         ('open', 'half-open'),
+                                         ('half-open', 'closed')])
+
+    def test_failed_trial(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.breaker.allow()
+        self.breaker.record(False)
+        self.assertEquals(self.breaker.state, 'open')
+        self.assertTrue(self.breaker.allow())
+
+
+class DegradedTestCase(MemoryTestCase):
+    """Base for cases of the session storage becoming unavailable."""
+    mode = 'anonymous'
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.metrics = SessionMetrics()
+        # Revalidated, so every request reads the database.
+        self.options = {'breaker': self.breaker, 'degraded_mode': self.mode,
+                        'cache': SessionCache(ttl=60, revalidate=True),
+                        'metrics': self.metrics,
+                        'touch_interval': timedelta(minutes=5)}
+        super(DegradedTestCase, self).setUp()
+
+
+class DegradedCase(DegradedTestCase):
+    def test_anonymous(self):
+        sid = self._set('data')
+        self.collection.error = AutoReconnect()
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), '')
+        r = self.client.get('/set?d=other')
+        # The cookie isn't replaced.
+        self.assertFalse(get_session_sid(r))
+        self.assertEquals(self.breaker.state, 'open')
+        self.collection.reset_calls()
+        self.client.get('/get')
+        self.assertEquals(self.collection.calls, {})
+        stats = self.metrics.snapshot()
+        self.assertEquals(stats['breaker.open'], 1)
+        self.assertEquals(stats['session.degraded'], 3)
+        self.collection.error = None
+        self.assertEquals(len(self.collection.docs), 1)
+        self.assertEquals(self.collection.docs[0]['_id'], sid)
+
+    def test_slow_calls(self):
+        self.interface = self.app.session_interface
+        self.interface._latency_budgets = {'find_one': 0.001}
+        self._set('data')
+        self.collection.latency = 0.01
+        try:
+            for _ in range(2):
+                r = self.client.get('/get')
+                self.assertEquals(r.data.decode('utf-8'), 'data')
+            self.assertEquals(self.breaker.state, 'open')
+        finally:
+            self.collection.latency = 0
+
+    def test_rejected_write_raised(self):
+        self._set('data')
+        self.app.testing = True
+        self.collection.error = OperationFailure('rejected')
+        for _ in range(3):
+            self.assertRaises(OperationFailure, self.client.get,
+                              '/set?d=other')
+        # The storage answers, so the breaker stays closed.
+        self.assertEquals(self.breaker.state, 'closed')
+        self.assertEquals(self.breaker.failures, 0)
+        self.assertFalse('session.degraded' in self.metrics.snapshot())
+
+    def test_without_breaker(self):
+        app = test_apps.create_app('memory')
+        app.testing = True
+        client = app.test_client()
+        self.collection.error = AutoReconnect()
+        self.assertRaises(AutoReconnect, client.get, '/set?d=data')
+
+
+class CachedDegradedCase(DegradedTestCase):
+    mode = 'cache'
+
+    def test_read_only(self):
+        sid = self._set('data')
+        self.collection.error = AutoReconnect()
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        r = self.client.get('/set?d=other')
+        self.assertFalse(get_session_sid(r))
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'data')
+        # Not cached sessions are empty.
+        self.app.session_interface._cache.delete(sid)
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), '')
+
+
+class QueuedDegradedCase(DegradedTestCase):
+    mode = 'queue'
+
+    def test_deferred_writes(self):
+        self._set('data')
+        self.collection.error = AutoReconnect()
+        self.client.get('/set?d=other')
+        r = self.client.get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'other')
+        self.assertEquals(self.metrics.snapshot()['save.deferred'], 1)
+        self.collection.error = None
+        self.breaker.reset_timeout = 0
+        # The trial call closes the breaker, the next request writes.
+        self.client.get('/get')
+        self.assertEquals(self.breaker.state, 'closed')
+        self.client.get('/get')
+        doc = self.collection.docs[0]
+        data = serializers.decode(doc.get('f'), doc['d'])
+        self.assertEquals(data['data'], 'other')
+
+    def _stored(self, sid):
+        doc = [doc for doc in self.collection.docs if doc['_id'] == sid][0]
+        return serializers.decode(doc.get('f'), doc['d'])
+
+    def _recover(self):
+        self.collection.error = None
+        self.breaker.reset_timeout = 0
+        # A new session, so the trial call doesn't flush.
+        self.app.test_client().get('/set?d=trial')
+        self.assertEquals(self.breaker.state, 'closed')
+
+    def test_flushed_in_batches(self):
+        self.app.session_interface._deferred_batch = 1
+        clients, sids = [], []
+        for _ in range(3):
+            client = self.app.test_client()
+            sids.append(get_session_sid(client.get('/set?d=data')))
+            clients.append(client)
+        self.collection.error = AutoReconnect()
+        for client in clients:
+            client.get('/set?d=other')
+        self._recover()
+        self.client.get('/nosession')
+        self.assertEquals([self._stored(sid)['data'] for sid in sids],
+                          ['other', 'data', 'data'])
+        # The session of the request is written first.
+        r = clients[2].get('/get')
+        self.assertEquals(r.data.decode('utf-8'), 'other')
+        self.assertEquals([self._stored(sid)['data'] for sid in sids],
+                          ['other', 'other', 'other'])
+
+    def test_rejected_deferred_write_dropped(self):
+        self._set('data')
+        self.collection.error = AutoReconnect()
+        self.client.get('/set?d=other')
+        self._recover()
+
+        def update(*args, **kwargs):
+            raise OperationFailure('rejected')
+        self.collection.update = update
+        r = self.client.get('/get')
+        self.assertEquals(r.status_code, 200)
+        del self.collection.update
+        self.client.get('/get')
+        self.assertEquals(self._stored(self.collection.docs[0]['_id']),
+                          {'data': 'data'})
+
+    def test_merged_with_concurrent_write(self):
+        sid = self._set('data')
+        self.collection.error = AutoReconnect()
+        self.client.get('/setkey/a?d=1')
+        self.client.get('/setkey/b?d=2')
+        self.client.get('/delkey/data')
+        self._recover()
+        # Another process writes the session meanwhile.
+        app = test_apps.create_app('memory')
+        client = app.test_client()
+        client.set_cookie('localhost:5000', key='session', value=sid)
+        client.get('/setkey/c?d=3')
+        self._get_with_cookie(sid)
+        self.assertEquals(self._stored(sid), {'a': '1', 'b': '2', 'c': '3'})
+        self.assertEquals(self.metrics.snapshot()['save.conflict'], 1)
+
+
 def suite():
     test_loader = unittest.TestLoader()
     suite = test_loader.suiteClass()
-    for interface in ['mongoengine', 'pymongo']:
+    for interface in ['mongoengine', 'pymongo', 'memory']:
         for base in [ZeroConfCase, ExpirationCase, MultipleAppsCase]:
             def wrapper_get_db_interface(i):
                 return lambda self: i
@@ -173,4 +1791,19 @@ def suite():
             cls = type(name, (base,), attrs)
             args = test_loader.getTestCaseNames(cls)
             suite.addTests(map(cls, args))
+    for cls in [WriteAvoidanceCase, AnonymousSessionCase,
+                ServerSideExpirationCase, CacheCase, SerializersCase,
+                KeyedValuesCase, KeyedFormatCase, SerializerOptionsCase,
+                DeltaUpdatesCase, LazySessionCase,
+                WriteBehindCase, MetricsCase, SidValidationCase,
+                SignedSidCase, HybridStorageCase, OptimisticConcurrencyCase,
+                OptimisticDeltaUpdatesCase, CollectionOptionsCase,
+                SecondaryReadsCase, SweeperCase, SpillCase, SharedCacheCase,
+                UserSessionsCase, SidStrategiesCase, SidStrategyCase,
+                MigrationCase, NamespacesCase, CircuitBreakerCase,
+                DegradedCase, CachedDegradedCase, QueuedDegradedCase]:
+        suite.addTests(map(cls, test_loader.getTestCaseNames(cls)))
+    if sys.version_info >= (3, 5):
+        from flask_mongo_sessions.tests import test_aio
+        suite.addTests(test_loader.loadTestsFromModule(test_aio))
     return suite
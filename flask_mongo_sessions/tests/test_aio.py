@@ -0,0 +1,225 @@
+"""Tests of the asynchronous session interface (Python 3.5+).
+
+They run against an in-memory collection with awaitable methods, so no
+MongoDB server is needed.
+"""
+import asyncio
+import re
+import unittest
+from datetime import datetime
+from datetime import timedelta
+from types import SimpleNamespace
+
+from flask import Flask
+from flask import request
+
+from flask_mongo_sessions import SessionCache
+from flask_mongo_sessions import SessionMetrics
+from flask_mongo_sessions.aio import AsyncMongoDBSessionInterface
+from flask_mongo_sessions.memory import MemoryDatabase
+
+
+class AsyncMemoryCollection(object):
+    """The subset of Motor collection API over MemoryCollection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, spec=None, projection=None):
+        return self.collection.find_one(spec, projection)
+
+    async def update_one(self, spec, update, upsert=False):
+        result = self.collection.update(spec, update, upsert=upsert)
+        return SimpleNamespace(acknowledged=True,
+                               matched_count=result['n'])
+
+    async def delete_one(self, spec):
+        result = self.collection.remove(spec)
+        return SimpleNamespace(acknowledged=True,
+                               deleted_count=result['n'])
+
+    async def delete_many(self, spec):
+        return await self.delete_one(spec)
+
+    async def count_documents(self, spec):
+        return len(list(self.collection.find(spec)))
+
+    def find(self, spec=None, projection=None):
+        return AsyncMemoryCursor(self.collection.find(spec, projection))
+
+    async def create_index(self, key, **kwargs):
+        self.collection.create_index(key, **kwargs)
+
+
+class AsyncMemoryCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def to_list(self, length):
+        return list(self.cursor)[:length]
+
+
+class AsyncMemoryDatabase(object):
+    def __init__(self):
+        self.db = MemoryDatabase('__test-db__')
+
+    def __getitem__(self, name):
+        return AsyncMemoryCollection(self.db[name])
+
+
+class AsyncTestCase(unittest.TestCase):
+    options = {}
+
+    def setUp(self):
+        self.app = Flask('testapp')
+        self.db = AsyncMemoryDatabase()
+        self.collection = self.db.db['sessions']
+        self.interface = AsyncMongoDBSessionInterface(
+            self.app, self.db, 'sessions', **self.options)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _request(self, sid, view):
+        """Open the session, pass it to `view` and save it. Returns the
+        SID from the response cookie."""
+        headers = {}
+        if sid:
+            headers['Cookie'] = 'session=' + sid
+        with self.app.test_request_context('/', headers=headers):
+            req = request._get_current_object()
+            session = self.loop.run_until_complete(
+                self.interface.open_session(self.app, req))
+            result = view(session)
+            response = self.app.response_class()
+            self.loop.run_until_complete(
+                self.interface.save_session(self.app, session, response))
+        cookies = response.headers.getlist('Set-Cookie')
+        m = re.search(r'session=(\w{32})', cookies[0]) if cookies else None
+        return (m.group(1) if m else None), result
+
+
+class AsyncInterfaceCase(AsyncTestCase):
+    def test_roundtrip(self):
+        def set_data(session):
+            session['data'] = 'value'
+        sid, _ = self._request(None, set_data)
+        self.assertTrue(sid)
+        _, data = self._request(sid, lambda session: session.get('data'))
+        self.assertEqual(data, 'value')
+        self.assertEqual(self.collection.docs[0]['v'], 2)
+
+    def test_expired(self):
+        def set_data(session):
+            session['data'] = 'value'
+        sid, _ = self._request(None, set_data)
+        self.collection.docs[0]['exp'] = datetime.utcnow() - timedelta(1)
+        _, data = self._request(sid, lambda session: session.get('data'))
+        self.assertEqual(data, None)
+
+    def test_removed(self):
+        def set_data(session):
+            session['data'] = 'value'
+        sid, _ = self._request(None, set_data)
+        self._request(sid, lambda session: session.clear())
+        self.assertEqual(self.collection.docs, [])
+
+
+class AsyncOptionsCase(AsyncTestCase):
+    def setUp(self):
+        self.cache = SessionCache()
+        self.metrics = SessionMetrics()
+        self.options = {'cache': self.cache, 'delta_updates': True,
+                        'metrics': self.metrics,
+                        'touch_interval': timedelta(minutes=5),
+                        'ttl_index': True}
+        super(AsyncOptionsCase, self).setUp()
+
+    def test_ttl_index(self):
+        self.loop.run_until_complete(self.interface.ensure_indexes())
+        self.assertEqual(self.collection.indexes,
+                         [('exp', {'expireAfterSeconds': 0})])
+
+    def test_cached_and_not_written(self):
+        def set_data(session):
+            session['data'] = 'value'
+        sid, _ = self._request(None, set_data)
+        self.collection.reset_calls()
+        _, data = self._request(sid, lambda session: session.get('data'))
+        self.assertEqual(data, 'value')
+        self.assertEqual(self.collection.calls, {})
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_metrics(self):
+        def set_data(session):
+            session['data'] = 'value'
+        sid, _ = self._request(None, set_data)
+        self._request(sid, set_data)
+        stats = self.metrics.snapshot()
+        self.assertEqual(stats['storage.update']['count'], 2)
+        self.assertEqual(stats['save.write'], 2)
+        self.assertEqual(stats['session.save']['count'], 2)
+
+
+class AsyncOptimisticCase(AsyncTestCase):
+    options = {'optimistic': True}
+
+    def test_concurrent_keys_kept(self):
+        self._concurrent_keys_kept('value')
+
+    def test_spilled_concurrent_keys_kept(self):
+        self.interface._spill_threshold = 100
+        self._concurrent_keys_kept('x' * 200)
+        spill = self.db.db['sessions.spill']
+        self.assertEqual([doc['_id'] for doc in spill.docs],
+                         [self.collection.docs[0]['spill']])
+
+    def _concurrent_keys_kept(self, value):
+        def set_data(session):
+            session['data'] = value
+        sid, _ = self._request(None, set_data)
+        loop = self.loop
+        interface = self.interface
+        with self.app.test_request_context(
+                '/', headers={'Cookie': 'session=' + sid}):
+            req = request._get_current_object()
+            first = loop.run_until_complete(
+                interface.open_session(self.app, req))
+            second = loop.run_until_complete(
+                interface.open_session(self.app, req))
+            first['first'] = 1
+            second['second'] = 2
+            for session in [first, second]:
+                loop.run_until_complete(interface.save_session(
+                    self.app, session, self.app.response_class()))
+        _, data = self._request(sid, dict)
+        self.assertEqual(data, {'data': value, 'first': 1, 'second': 2})
+
+
+class AsyncUserSessionsCase(AsyncTestCase):
+    options = {'user_key': 'user'}
+
+    def test_invalidate(self):
+        def log_in(session):
+            session['user'] = 'alice'
+        sids = [self._request(None, log_in)[0] for _ in range(2)]
+        self.assertEqual(sorted(self.loop.run_until_complete(
+            self.interface.user_sessions('alice'))), sorted(sids))
+        self.assertEqual(self.loop.run_until_complete(
+            self.interface.count_user_sessions('alice')), 2)
+        self.assertEqual(self.loop.run_until_complete(
+            self.interface.invalidate_user_sessions('alice')), 2)
+        self.assertEqual(self.collection.docs, [])
+
+    def test_invalidated_not_written_back(self):
+        def log_in(session):
+            session['user'] = 'alice'
+        sid, _ = self._request(None, log_in)
+
+        def invalidate_and_set(session):
+            self.loop.run_until_complete(
+                self.interface.invalidate_user_sessions('alice'))
+            session['other'] = 'value'
+        self.assertEqual(self._request(sid, invalidate_and_set)[0], None)
+        self.assertEqual(self.collection.docs, [])
@@ -4,12 +4,15 @@ from flask import Flask
 from flask import request
 from flask import session
 
-from flask.ext.pymongo import PyMongo
-from flask.ext.mongoengine import MongoEngine
+from flask_pymongo import PyMongo
+from flask_mongoengine import MongoEngine
 
 from flask_mongo_sessions import MongoDBSessionInterface
 
-def create_app(db_interface, app_name='testapp', db_name='__test-db__'):
+from flask_mongo_sessions import memory
+
+def create_app(db_interface, app_name='testapp', db_name='__test-db__',
+               **options):
     app = Flask(app_name)
     app.config['SERVER_NAME'] = 'localhost:5000'
 
@@ -18,12 +21,16 @@ def create_app(db_interface, app_name='testapp', db_name='__test-db__'):
         mongo = PyMongo(app)
         with app.app_context():
             app.session_interface = MongoDBSessionInterface(
-                app, mongo.db, 'sessions')
+                app, mongo.db, 'sessions', **options)
     elif db_interface == 'mongoengine':
         app.config['MONGODB_DB'] = db_name
         mongo = MongoEngine(app)
         app.session_interface = MongoDBSessionInterface(
-            app, mongo.connection[app.config['MONGODB_DB']], 'sessions')
+            app, mongo.connection[app.config['MONGODB_DB']], 'sessions',
+            **options)
+    elif db_interface == 'memory':
+        app.session_interface = MongoDBSessionInterface(
+            app, memory.get_database(db_name), 'sessions', **options)
 
     @app.route("/set")
     def set_session():
@@ -40,6 +47,29 @@ def create_app(db_interface, app_name='testapp', db_name='__test-db__'):
     def get_session():
         return session.get('data', '')
 
+    @app.route("/nosession")
+    def no_session():
+        return 'done'
+
+    @app.route("/setkey/<key>")
+    def set_key(key):
+        session[key] = request.args['d']
+        return 'done'
+
+    @app.route("/getkey/<key>")
+    def get_key(key):
+        return session.get(key, '')
+
+    @app.route("/delkey/<key>")
+    def del_key(key):
+        session.pop(key, None)
+        return 'done'
+
+    @app.route("/clear")
+    def clear_session():
+        session.clear()
+        return 'done'
+
     @app.route("/unicode/set")
     def unicode_set():
         session['foo'] = u'Alpenerstra\xdfe'
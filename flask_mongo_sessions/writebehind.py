@@ -0,0 +1,282 @@
+from __future__ import with_statement
+
+import atexit
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask_mongo_sessions.metrics import timed
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending(object):
+    __slots__ = ['update', 'upsert', 'entry', 'attempts']
+
+    def __init__(self, update, upsert, entry, attempts=0):
+        # None update means removal of the session.
+        self.update = update
+        self.upsert = upsert
+        self.entry = entry
+        # Number of failed attempts to write it.
+        self.attempts = attempts
+
+
+def _merge(old, new):
+    """Merge a pending write with a later one for the same session."""
+    if new.update is None:
+        # A removal supersedes everything before.
+        return new
+    if old.update is None:
+        # A complete rewrite of a removed session supersedes the removal,
+        # a partial update wouldn't match anything.
+        return new if new.upsert else old
+    if new.upsert:
+        # A complete rewrite supersedes an update, but increments of both
+        # are kept, so the version of the session is correct.
+        update = {}
+        if '$inc' in old.update:
+            update['$inc'] = old.update['$inc']
+    else:
+        update = dict(old.update)
+    for op, fields in new.update.items():
+        merged = dict(update.get(op, {}))
+        for field, value in fields.items():
+            if op == '$inc':
+                value += merged.get(field, 0)
+            merged[field] = value
+        update[op] = merged
+    return _Pending(update, old.upsert or new.upsert, new.entry,
+                    old.attempts)
+
+
+class WriteBehindQueue(object):
+    """Queue of session writes flushed to the database in the background.
+
+    Writes of the same session are coalesced while they wait. A background
+    thread flushes them with unordered bulk writes when `batch_size` writes
+    are pending or every `flush_interval` seconds. Requires PyMongo 3.0+.
+
+    At most `max_pending` sessions wait to be written. When the queue is
+    full a write is handled according to `overflow`:
+
+    - ``'block'`` waits until there is room in the queue;
+    - ``'sync'`` writes the session synchronously;
+    - ``'drop'`` discards the write.
+
+    If `read_your_writes` is true, sessions waiting to be written (or being
+    written) are read from the queue instead of the database.
+
+    Writes of a failed batch are queued again, merged with later writes of
+    the same sessions, and retried with the next batches. A write which
+    failed `max_retries` times is dropped. Batches are written one at
+    a time, :meth:`flush` waits for the one being written in the
+    background.
+    """
+
+    def __init__(self, max_pending=10000, batch_size=500, flush_interval=0.5,
+                 overflow='block', read_your_writes=True, max_retries=3):
+        if overflow not in ('block', 'sync', 'drop'):
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.read_your_writes = read_your_writes
+        self.max_retries = max_retries
+        self.flushed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._get_collection = None
+        self._metrics = None
+        self._pending = OrderedDict()
+        # Writes of the batch being flushed, by SID.
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        # Held while a batch is written: a later write of a session mustn't
+        # be done before an earlier one (or be overwritten by its retry).
+        self._flush_lock = threading.Lock()
+        self._has_pending = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def bind(self, get_collection, metrics=None):
+        """Set a callable which returns the collection to write to and
+        optional metrics which bulk writes are reported to."""
+        self._get_collection = get_collection
+        self._metrics = metrics
+
+    def put(self, sid, update, upsert=False, entry=None):
+        """Queue a write of the session.
+
+        `update` is an update document, None removes the session. `entry`
+        is what the session looks like after the write (a CacheEntry),
+        None if it's removed. Returns False if the write wasn't queued and
+        must be done synchronously.
+        """
+        pending = _Pending(update, upsert, entry)
+        with self._lock:
+            if self._closed:
+                return False
+            self._ensure_thread()
+            if sid in self._pending:
+                self._pending[sid] = _merge(self._pending[sid], pending)
+                return True
+            while len(self._pending) >= self.max_pending:
+                if self.overflow == 'sync':
+                    return False
+                elif self.overflow == 'drop':
+                    self.dropped += 1
+                    logger.warning('Session write queue is full, '
+                                   'write of %s is dropped', sid)
+                    return True
+                self._has_pending.notify()
+                self._has_room.wait()
+            self._pending[sid] = pending
+            if len(self._pending) >= self.batch_size:
+                self._has_pending.notify()
+        return True
+
+    def get(self, sid):
+        """Return a tuple of a flag if a write of the session is pending and
+        a copy of what the session will look like after it."""
+        with self._lock:
+            pending = self._pending.get(sid)
+            if pending is None:
+                pending = self._in_flight.get(sid)
+        if pending is None:
+            return False, None
+        entry = pending.entry
+        if entry is not None:
+            entry = entry._replace(data=copy.deepcopy(entry.data))
+        return True, entry
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all pending sessions synchronously, until a batch
+        fails."""
+        while self._flush_batch():
+            pass
+
+    def close(self):
+        """Stop the background thread and flush pending writes."""
+        with self._lock:
+            self._closed = True
+            self._has_pending.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self.flush()
+
+    def _ensure_thread(self):
+        # The thread doesn't survive fork(), so it's started in the process
+        # which writes. Writes queued before fork are the parent's business.
+        if self._pid != os.getpid():
+            if self._pid is not None:
+                self._pending.clear()
+                self._in_flight.clear()
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='session-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                deadline = time.time() + self.flush_interval
+                while not self._closed and len(self._pending) < \
+                        min(self.batch_size, self.max_pending):
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self._has_pending.wait(timeout)
+                if self._closed:
+                    return
+            self._flush_batch()
+
+    def _flush_batch(self):
+        """Write a batch of pending sessions, after the batch being
+        written by another thread (flush() may be called while the
+        background thread writes). Returns False if there was nothing to
+        write or the batch failed."""
+        with self._flush_lock:
+            return self._write_batch()
+
+    def _write_batch(self):
+        from pymongo import DeleteOne
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        from pymongo.errors import PyMongoError
+
+        with self._lock:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            # Sessions being written are still read from the queue.
+            self._in_flight.update(batch)
+            self._has_room.notify_all()
+        if not batch:
+            return False
+
+        requests = []
+        for sid, pending in batch:
+            if pending.update is None:
+                requests.append(DeleteOne({'_id': sid}))
+            else:
+                requests.append(UpdateOne({'_id': sid}, pending.update,
+                                          upsert=pending.upsert))
+        try:
+            timed(self._metrics, 'storage.bulk_write',
+                  self._get_collection().bulk_write, requests, ordered=False)
+        except BulkWriteError as e:
+            # Other writes of the unordered batch were done, only the failed
+            # ones are retried.
+            failed = sorted(set(error['index'] for error in
+                                e.details.get('writeErrors', [])))
+            self.errors += 1
+            logger.warning('Writing %d of %d sessions failed', len(failed),
+                           len(requests))
+            self._requeue([batch[i] for i in failed])
+            self._done(batch)
+            self.flushed += len(requests) - len(failed)
+            return False
+        except PyMongoError:
+            self.errors += 1
+            logger.exception('Writing %d sessions failed', len(requests))
+            self._requeue(batch)
+            return False
+        self._done(batch)
+        self.flushed += len(requests)
+        return True
+
+    def _done(self, batch):
+        with self._lock:
+            for sid, _ in batch:
+                self._in_flight.pop(sid, None)
+
+    def _requeue(self, batch):
+        """Queue writes of a failed batch again, before later writes of the
+        same sessions."""
+        with self._lock:
+            for sid, pending in batch:
+                self._in_flight.pop(sid, None)
+                pending.attempts += 1
+                if pending.attempts >= self.max_retries:
+                    self.dropped += 1
+                    logger.warning('Write of session %s is dropped after '
+                                   '%d attempts', sid, pending.attempts)
+                    continue
+                if sid in self._pending:
+                    pending = _merge(pending, self._pending[sid])
+                self._pending[sid] = pending
@@ -20,7 +20,7 @@ setup(
     maintainer_email='ivan0yurchenko@gmail.com',
     description='Server-side sessions for Flask with MongoDB',
     long_description=__doc__,
-    py_modules=['flask_mongo_sessions', 'flask_mongo_sessions.tests'],
+    packages=['flask_mongo_sessions', 'flask_mongo_sessions.tests'],
     zip_safe=False,
     include_package_data=True,
     platforms='any',
@@ -28,6 +28,9 @@ setup(
         'Flask>=0.8',
         'Flask-PyMongo',
     ],
+    extras_require={
+        'async': ['motor'],
+    },
     classifiers=[
         'Environment :: Web Environment',
         'Intended Audience :: Developers',